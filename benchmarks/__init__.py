@@ -0,0 +1 @@
+"""Benchmarks for the gear's own work (everything but qsirecon itself)."""
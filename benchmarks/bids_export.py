@@ -0,0 +1,143 @@
+"""Count the Flywheel API calls of a BIDS export.
+
+A curated project (--subjects subjects, each with --sessions sessions of a few
+acquisitions) is made on a fake Flywheel instance (see fake_flywheel), and exported
+with download_bids_dir: the whole project, one subject, and one session of one
+subject.  For each, the API calls made and the containers they returned are
+reported: "containers listed" by finders, a page at a time, and "containers
+fetched" one by one with get_* (none: the listings ask for the files' info, which
+holds their BIDS metadata).
+
+Exporting a part of a project should cost the same whatever the size of the
+project.  With --check, every partial export is also run on a project --growth
+times bigger, and the script exits with status 1 if it makes more calls or lists
+more containers there (as it does when the whole project is listed and filtered
+on the client).
+
+Usage:
+    python -m benchmarks.bids_export --subjects 20 --check
+"""
+
+import argparse
+import logging
+import sys
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+# pylint: disable=wrong-import-position
+from benchmarks.fake_flywheel import FakeClient
+from utils.flywheel_bids.export_bids import download_bids_dir
+
+# pylint: enable=wrong-import-position
+
+log = logging.getLogger(__name__)
+
+ACQUISITIONS = {"anat": "T1w", "dwi": "dwi", "fmap": "epi"}
+EXPORTS = {
+    "project": {},
+    "one subject": {"subjects": ["001"]},
+    "one session": {"subjects": ["001"], "sessions": ["01"]},
+}
+
+
+def make_project(scratch, n_subjects, n_sessions):
+    """A fake instance with a curated project, one small file per acquisition.
+
+    Returns:
+        client (FakeClient), project
+    """
+    client = FakeClient()
+    group = client.add("group", "bench")
+    project = client.add("project", "bench", parent=group)
+    project.info = {"BIDS": {"Name": "bench", "BIDSVersion": "1.4.0"}}
+    for ii in range(1, n_subjects + 1):
+        subject = client.add("subject", f"{ii:03d}", parent=project)
+        for jj in range(1, n_sessions + 1):
+            session = client.add("session", f"{jj:02d}", parent=subject)
+            for folder, suffix in ACQUISITIONS.items():
+                acquisition = client.add("acquisition", suffix, parent=session)
+                name = f"sub-{ii:03d}_ses-{jj:02d}_{suffix}.nii.gz"
+                data = Path(scratch) / name
+                data.write_bytes(b"\0" * 1024)
+                acquisition.add_file(
+                    data,
+                    info={
+                        "BIDS": {
+                            "Filename": name,
+                            "Folder": folder,
+                            "Path": f"sub-{ii:03d}/ses-{jj:02d}/{folder}",
+                        }
+                    },
+                )
+    return client, project
+
+
+def count_calls(scratch, n_subjects, n_sessions, **filters):
+    """Export the project (with filters), return the calls made by type."""
+    with tempfile.TemporaryDirectory(dir=scratch) as work:
+        client, project = make_project(work, n_subjects, n_sessions)
+        download_bids_dir(
+            client, project.id, "project", str(Path(work) / "bids"), **filters
+        )
+    return dict(client.calls)
+
+
+def regressions(scratch, n_subjects, n_sessions, growth, calls, **filters):
+    """The calls of a filtered export that grow on a project growth times bigger.
+
+    Args:
+        calls (dict): the calls of the export of the n_subjects project
+
+    Returns:
+        failures (list of str): one message per call that grew
+    """
+    bigger = count_calls(scratch, n_subjects * growth, n_sessions, **filters)
+    return [
+        f"{call} went from {calls.get(call, 0)} to {count} in a project "
+        f"{growth} times bigger"
+        for call, count in sorted(bigger.items())
+        if count > calls.get(call, 0)
+    ]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", 1)[0])
+    parser.add_argument("--subjects", type=int, default=20)
+    parser.add_argument("--sessions", type=int, default=2)
+    parser.add_argument("--growth", type=int, default=10)
+    parser.add_argument("--check", action="store_true")
+    parser.add_argument("--scratch", help="directory to work in (default: a temp dir)")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger("bids-exporter").setLevel(logging.WARNING)
+
+    failed = []
+    with tempfile.TemporaryDirectory(dir=args.scratch) as scratch:
+        for name, filters in EXPORTS.items():
+            calls = count_calls(scratch, args.subjects, args.sessions, **filters)
+            print(f"{name}:")
+            for call, count in sorted(calls.items()):
+                print(f"  {call:<30}{count:>8}")
+            if args.check and filters:
+                failed.extend(
+                    f"{name}: {failure}"
+                    for failure in regressions(
+                        scratch,
+                        args.subjects,
+                        args.sessions,
+                        args.growth,
+                        calls,
+                        **filters,
+                    )
+                )
+
+    for failure in failed:
+        print(f"REGRESSION {failure}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
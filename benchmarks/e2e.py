@@ -0,0 +1,257 @@
+"""Run the whole gear on synthetic data, and measure each of its phases.
+
+A synthetic qsiprep archive zip is made, attached to a session of a fake Flywheel
+instance (see fake_flywheel), and the gear is run as run.py's main does it:
+parse_config (which downloads and unzips the input), run (with stub_qsirecon as the
+BIDS app, which writes a qsirecon-shaped output and work tree) and post_run (which
+builds the archives).  For each phase, it reports the wall time, the peak resident
+memory of the gear and of the processes it started, and the bytes they read and
+wrote.
+
+Only the gear's own work is measured: the stub app writes its output as fast as the
+disk goes.
+
+Usage:
+    python -m benchmarks.e2e --subjects 4 --input-gb 2 --report e2e.json
+"""
+
+import argparse
+import json
+import logging
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import psutil
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+# pylint: disable=wrong-import-position
+from benchmarks.fake_flywheel import FakeClient, FakeContext
+from benchmarks.synthetic import make_qsiprep_zip
+from fw_gear_bids_qsirecon.main import prepare, run
+from fw_gear_bids_qsirecon.parser import parse_config
+from run import post_run
+from utils.containers import ContainerCache
+from utils.deletion import wait_for_deletions
+
+# pylint: enable=wrong-import-position
+
+log = logging.getLogger(__name__)
+
+STUB = Path(__file__).resolve().parent / "stub_qsirecon.py"
+GEAR_NAME = "bids-qsirecon"
+
+
+class PhaseMeter:
+    """Measure the wall time, peak memory and I/O of the gear and its children.
+
+    A thread samples the resident memory of this process and of all its
+    descendants.  I/O is read from the kernel's counters, this process' own and
+    those it adds up for the children that were waited for (all of them, by the end
+    of a phase).
+
+    Args:
+        name (str): name of the phase
+        interval (float): seconds between memory samples
+    """
+
+    def __init__(self, name, interval=0.1):
+        self.name = name
+        self.interval = interval
+        self.process = psutil.Process()
+        self.result = {}
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._peak_self = 0
+        self._peak_children = 0
+
+    def _io(self, proc):
+        try:
+            io = proc.io_counters()
+            return io.read_bytes, io.write_bytes
+        except (psutil.AccessDenied, AttributeError):
+            return 0, 0
+
+    def _sample(self):
+        while True:
+            self._peak_self = max(self._peak_self, self.process.memory_info().rss)
+            rss = 0
+            for proc in self.process.children(recursive=True):
+                try:
+                    rss += proc.memory_info().rss
+                except psutil.Error:
+                    continue
+            self._peak_children = max(self._peak_children, rss)
+            if self._stop_event.wait(self.interval):
+                return
+
+    def __enter__(self):
+        self._start = time.time()
+        self._start_io = self._io(self.process)
+        self._start_reaped = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop_event.set()
+        self._thread.join()
+        wall = time.time() - self._start
+        end_io = self._io(self.process)
+        reaped = resource.getrusage(resource.RUSAGE_CHILDREN)
+        # rusage counts 512 byte blocks
+        reaped_read = 512 * (reaped.ru_inblock - self._start_reaped.ru_inblock)
+        reaped_written = 512 * (reaped.ru_oublock - self._start_reaped.ru_oublock)
+        self.result = {
+            "wall (s)": round(wall, 2),
+            "peak rss gear (MiB)": round(self._peak_self / 1024**2, 1),
+            "peak rss children (MiB)": round(self._peak_children / 1024**2, 1),
+            "read (MiB)": round(
+                (end_io[0] - self._start_io[0] + reaped_read) / 1024**2, 1
+            ),
+            "written (MiB)": round(
+                (end_io[1] - self._start_io[1] + reaped_written) / 1024**2, 1
+            ),
+        }
+
+
+def make_instance(scratch, args):
+    """A fake instance with one session, its qsiprep output and the destination.
+
+    Returns:
+        client (FakeClient), destination, qsiprep_zip (FakeFile)
+    """
+    client = FakeClient()
+    group = client.add("group", "bench")
+    project = client.add("project", "bench", parent=group)
+    subject = client.add("subject", "sub-001", parent=project)
+    session = client.add("session", "ses-01", parent=subject)
+    qsiprep = client.add(
+        "analysis",
+        "qsiprep",
+        parent=session,
+        gear_info=argparse.Namespace(name="bids-qsiprep"),
+    )
+    destination = client.add("analysis", "qsirecon", parent=session)
+
+    zip_path = scratch / f"bids-qsiprep_sub-001_{qsiprep.id}.zip"
+    log.info("Writing %s", zip_path)
+    make_qsiprep_zip(
+        zip_path,
+        qsiprep.id,
+        n_subjects=args.subjects,
+        total_bytes=int(args.input_gb * 1024**3),
+        files_per_subject=args.files_per_subject,
+    )
+    return client, destination, qsiprep.add_file(zip_path)
+
+
+def run_gear(scratch, args):
+    """Run the gear's phases on a fake instance, return the measurements."""
+    client, destination, qsiprep_zip = make_instance(scratch, args)
+    output_dir = scratch / "output"
+    work_dir = scratch / "work"
+    output_dir.mkdir()
+    work_dir.mkdir()
+
+    os.environ.update(
+        {
+            "STUB_OUTPUT_BYTES": str(int(args.output_mb * 1024**2)),
+            "STUB_FIGURES": str(args.figures),
+            "STUB_WORK_NODES": str(args.work_nodes),
+            "STUB_WORK_FILE_BYTES": str(int(args.work_file_kb * 1024)),
+        }
+    )
+    context = FakeContext(
+        client,
+        destination,
+        output_dir,
+        work_dir,
+        config={
+            "gear-input-zip-mode": args.zip_mode,
+            "gear-save-intermediate-output": args.save_intermediate,
+            "gear-resource-sample-interval": 0,
+            "n_cpus": args.n_cpus,
+        },
+        inputs={"preprocessing-pipeline-zip": qsiprep_zip},
+    )
+
+    phases = {}
+    containers = ContainerCache(client)
+    _, parents = containers.hierarchy(destination.id)
+
+    with PhaseMeter("parse_config") as meter:
+        gear_options, app_options = parse_config(context, containers=containers)
+    phases[meter.name] = meter.result
+
+    gear_options["bids-app-binary"] = f"{sys.executable} {STUB}"
+    prepare(gear_options=gear_options, app_options=app_options)
+    app_options["participant_label"] = parents["subject"].label[len("sub-") :]
+
+    with PhaseMeter("run") as meter:
+        run(gear_options, app_options)
+    phases[meter.name] = meter.result
+
+    with PhaseMeter("post_run") as meter:
+        post_run(
+            gear_name=GEAR_NAME,
+            gear_options=gear_options,
+            analysis_output_dir=str(gear_options["output_analysis_id_dir"]),
+            run_label=parents["subject"].label,
+            errors=[],
+            warnings=[],
+        )
+        wait_for_deletions(timeout=600)
+    phases[meter.name] = meter.result
+
+    archives = {
+        path.name: path.stat().st_size for path in sorted(output_dir.glob("*.zip"))
+    }
+    return {
+        "parameters": vars(args),
+        "phases": phases,
+        "archives (bytes)": archives,
+        "api calls": dict(client.calls),
+    }
+
+
+def print_table(report):
+    columns = list(next(iter(report["phases"].values())))
+    print(f"{'phase':<14}" + "".join(f"{col:>26}" for col in columns))
+    for name, result in report["phases"].items():
+        print(f"{name:<14}" + "".join(f"{result[col]:>26}" for col in columns))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", 1)[0])
+    parser.add_argument("--subjects", type=int, default=1)
+    parser.add_argument("--files-per-subject", type=int, default=8)
+    parser.add_argument("--input-gb", type=float, default=0.5)
+    parser.add_argument("--output-mb", type=float, default=200)
+    parser.add_argument("--figures", type=int, default=50)
+    parser.add_argument("--work-nodes", type=int, default=200)
+    parser.add_argument("--work-file-kb", type=float, default=256)
+    parser.add_argument("--zip-mode", choices=["unzip", "stream"], default="unzip")
+    parser.add_argument("--save-intermediate", action="store_true")
+    parser.add_argument("--n-cpus", type=int, default=0)
+    parser.add_argument("--scratch", help="directory to work in (default: a temp dir)")
+    parser.add_argument("--report", help="write the measurements to this JSON file")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    with tempfile.TemporaryDirectory(dir=args.scratch) as scratch:
+        report = run_gear(Path(scratch), args)
+
+    print_table(report)
+    if args.report:
+        with open(args.report, "w") as fp:
+            json.dump(report, fp, indent=2)
+
+
+if __name__ == "__main__":
+    main()
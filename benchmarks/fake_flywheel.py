@@ -0,0 +1,339 @@
+"""A local stand-in for the Flywheel client and the gear context.
+
+Only what the gear (and the BIDS export) uses is implemented: containers are looked
+up by id in a dict, listed with a small subset of the finders' filter syntax, files
+are "downloaded" by copying them from local disk, and every API call is counted, so a
+benchmark can report how many round trips a real instance would see.  As the SDK's
+calls do, the client's calls return copies of the containers and files: callers may
+change them (e.g. pop keys from their info) without changing the instance.  As on a
+real instance, the files of listed containers come without their info (only
+``info_exists``) unless the listing asks for it with ``include_all_info``.
+
+Example:
+    .. code-block:: python
+
+        client = FakeClient()
+        project = client.add("project", "bench")
+        subject = client.add("subject", "sub-001", parent=project)
+        context = FakeContext(client, destination, output_dir, work_dir)
+        gear_options, app_options = parse_config(context)
+"""
+
+import collections
+import copy
+import datetime
+import json
+import re
+import shutil
+import threading
+from pathlib import Path
+from types import SimpleNamespace
+from zipfile import ZipFile
+
+MANIFEST = Path(__file__).resolve().parents[1] / "manifest.json"
+LEVELS = ["group", "project", "subject", "session", "acquisition", "analysis"]
+# containers per page of a finder's listing
+PAGE_SIZE = 1000
+# one "field=value" of a finder's filter, the value maybe quoted
+FILTER_TERM = re.compile(r'([\w.]+)=("[^"]*"|[^,]*)')
+
+
+class Parents(dict):
+    """Container parents, by level (as ``container.parents["subject"]``) or as
+    attributes (as ``container.parents.subject``); missing levels are None."""
+
+    def __missing__(self, key):
+        return None
+
+    def __getattr__(self, key):
+        return self[key]
+
+
+class _Fields:
+    """Read attributes as keys too (``container["label"]``, ``container.get("info")``),
+    as the SDK's models allow."""
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, "id" if key == "_id" else key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+
+class FakeFile(_Fields):
+    """A file attached to a container, backed by a local file."""
+
+    def __init__(self, client, path, parent, info=None):
+        self._client = client
+        self.path = Path(path)
+        self.name = self.path.name
+        self.id = f"{len(client.files) + 1:024x}"
+        self.file_id = self.id
+        self.version = 1
+        self.size = self.path.stat().st_size
+        self.hash = f"v0-fake-{self.id}"
+        self.info = info or {}
+        self.modified = datetime.datetime.now(datetime.timezone.utc)
+        self.parent_ref = {"id": parent.id, "type": parent.container_type}
+
+    def _copy(self, info=True):
+        file_obj = copy.copy(self)
+        file_obj.info = copy.deepcopy(self.info) if info else {}
+        file_obj.info_exists = bool(self.info)
+        return file_obj
+
+    def download(self, dest_file):
+        self._client.count("download_file")
+        shutil.copyfile(self.path, dest_file)
+
+
+class FakeContainer(_Fields):
+    """A project, subject, session... or analysis."""
+
+    def __init__(self, client, container_type, label, parent=None, **fields):
+        self._client = client
+        self.id = f"{len(client.containers) + 1:024x}"
+        self.label = label
+        self.container_type = container_type
+        self.type = container_type
+        self.files = []
+        self.info = {}
+        self.created = datetime.datetime.now()
+        self.gear_info = None
+        self.parents = Parents(parent.parents if parent else {})
+        if parent:
+            self.parents[parent.container_type] = parent.id
+            self.parent = SimpleNamespace(id=parent.id, type=parent.container_type)
+        else:
+            self.parent = None
+        if parent and parent.container_type == "subject":
+            self.subject = {"_id": parent.id, "code": parent.label, "label": parent.label}
+        self.children = []
+        for key, value in fields.items():
+            setattr(self, key, value)
+
+    def add_file(self, path, info=None):
+        file_obj = FakeFile(self._client, path, self, info=info)
+        self.files.append(file_obj)
+        self._client.files[file_obj.id] = file_obj
+        return file_obj
+
+    def _copy(self, files_info=True):
+        container = copy.copy(self)
+        container.info = copy.deepcopy(self.info)
+        container.files = [ff._copy(files_info) for ff in self.files]
+        return container
+
+    def get_file(self, name):
+        return next(ff for ff in self.files if ff.name == name)
+
+    def get_file_zip_info(self, name):
+        self._client.count("get_file_zip_info")
+        with ZipFile(self.get_file(name).path) as zip_file:
+            members = [
+                SimpleNamespace(path=info.filename, size=info.file_size)
+                for info in zip_file.infolist()
+            ]
+        return SimpleNamespace(members=members)
+
+    def download_file(self, name, dest_file):
+        self.get_file(name).download(dest_file)
+
+    def _children(self, container_type):
+        return _Finder([cc for cc in self.children if cc.container_type == container_type])
+
+    @property
+    def subjects(self):
+        return self._children("subject")
+
+    @property
+    def sessions(self):
+        if self.container_type == "project":
+            return _Finder(
+                [ss for sub in self.children for ss in sub.children if ss.type == "session"]
+            )
+        return self._children("session")
+
+    @property
+    def acquisitions(self):
+        return self._children("acquisition")
+
+    def reload(self):
+        self._client.count("reload")
+        return self
+
+
+class _Finder(list):
+    """The ``iter()`` and ``find()`` of a container's children."""
+
+    def iter(self):
+        return iter(self)
+
+    def find(self, query=None):
+        return list(self)
+
+
+class _QueryFinder:
+    """``client.sessions`` and the like: containers of one type, found with a filter
+    such as ``parents.project=<id>,label="ses-01"`` (only "=" is understood)."""
+
+    def __init__(self, client, container_type):
+        self._client = client
+        self.container_type = container_type
+
+    @staticmethod
+    def _value(container, field):
+        value = container
+        for key in field.split("."):
+            if isinstance(value, (dict, _Fields)):
+                value = value.get(key)
+            else:
+                return None
+        return value
+
+    def iter_find(self, query="", include_all_info=False, **kwargs):
+        terms = [
+            (field, value.strip('"')) for field, value in FILTER_TERM.findall(query)
+        ]
+        found = [
+            cc
+            for cc in self._client.containers.values()
+            if cc.container_type == self.container_type
+            and all(str(self._value(cc, field)) == value for field, value in terms)
+        ]
+        # one request per page
+        for _ in range(max(1, -(-len(found) // PAGE_SIZE))):
+            self._client.count(f"{self.container_type}s.iter_find")
+        self._client.count("containers listed", len(found))
+        return iter([cc._copy(files_info=include_all_info) for cc in found])
+
+    def find(self, query="", **kwargs):
+        return list(self.iter_find(query, **kwargs))
+
+
+class FakeClient:
+    """Containers and files in memory, with a count of every call."""
+
+    def __init__(self):
+        self.containers = {}
+        self.files = {}
+        self.calls = collections.Counter()
+        self._lock = threading.Lock()
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.calls[name] += n
+
+    @property
+    def subjects(self):
+        return _QueryFinder(self, "subject")
+
+    @property
+    def sessions(self):
+        return _QueryFinder(self, "session")
+
+    @property
+    def acquisitions(self):
+        return _QueryFinder(self, "acquisition")
+
+    def add(self, container_type, label, parent=None, **fields):
+        """Create a container (under parent) and return it."""
+        container = FakeContainer(self, container_type, label, parent, **fields)
+        self.containers[container.id] = container
+        if parent:
+            parent.children.append(container)
+        return container
+
+    def get(self, container_id):
+        self.count("get")
+        return self.containers[container_id]._copy()
+
+    def get_container(self, container_id):
+        self.count("get_container")
+        return self.containers[container_id]._copy()
+
+    def _get_typed(self, container_type, container_id):
+        self.count(f"get_{container_type}")
+        self.count("containers fetched")
+        container = self.containers[container_id]
+        assert container.container_type == container_type
+        return container._copy()
+
+    def get_project(self, container_id):
+        return self._get_typed("project", container_id)
+
+    def get_session(self, container_id):
+        return self._get_typed("session", container_id)
+
+    def get_acquisition(self, container_id):
+        return self._get_typed("acquisition", container_id)
+
+    def _download_file_from(self, container_id, name, dest_file):
+        self.containers[container_id].get_file(name).download(dest_file)
+
+    download_file_from_project = _download_file_from
+    download_file_from_session = _download_file_from
+    download_file_from_acquisition = _download_file_from
+
+    def get_file(self, file_id):
+        self.count("get_file")
+        return self.files[file_id]._copy()
+
+    def get_session_analyses(self, session_id):
+        self.count("get_session_analyses")
+        return [
+            cc for cc in self.containers[session_id].children if cc.type == "analysis"
+        ]
+
+
+class FakeContext:
+    """What the gear reads from a GearToolkitContext.
+
+    The config is the manifest's defaults, updated with config.
+
+    Args:
+        client (FakeClient): the client
+        destination (FakeContainer): the analysis the gear runs for
+        output_dir (Path): gear output directory
+        work_dir (Path): gear work directory
+        config (dict): config values that are not the default
+        inputs (dict): input name -> FakeFile
+    """
+
+    def __init__(self, client, destination, output_dir, work_dir, config=None, inputs=None):
+        with open(MANIFEST) as fp:
+            self.manifest = json.load(fp)
+        self.config = {
+            key: spec["default"]
+            for key, spec in self.manifest["config"].items()
+            if "default" in spec
+        }
+        self.config.update(config or {})
+        self.client = client
+        self.destination = {"id": destination.id, "type": "analysis"}
+        self.output_dir = Path(output_dir)
+        self.work_dir = Path(work_dir)
+        self.inputs = inputs or {}
+
+    def get_input(self, name):
+        file_obj = self.inputs.get(name)
+        if file_obj is None:
+            return None
+        return {
+            "hierarchy": dict(file_obj.parent_ref),
+            "object": {"file_id": file_obj.id, "version": file_obj.version},
+            "location": {"name": file_obj.name, "path": str(file_obj.path)},
+        }
+
+    def get_input_path(self, name):
+        file_obj = self.inputs.get(name)
+        return str(file_obj.path) if file_obj else None
@@ -0,0 +1,248 @@
+"""Time the functions that build the gear's output archives.
+
+Each packaging function is run on generated trees of different shapes:
+
+    many-small  many directories of small files (a nipype work dir)
+    few-huge    a few big images (qsirecon's derivatives)
+    deep-html   html reports linking to figures many directories down
+
+Half of every tree is written first and recorded as "unzipped input", so zip_output
+has files to exclude, as it does in the gear.  The throughput (MiB of the tree per
+second, best of --repeat runs) of every function and shape can be saved as a JSON
+baseline, and later runs compared to it: a throughput more than --threshold below
+the baseline is a regression, and the script exits with status 1.
+
+Baselines depend on the machine (cores, disk), so compare runs on the same one.
+
+Usage:
+    python -m benchmarks.packaging --save-baseline baseline.json
+    python -m benchmarks.packaging --compare baseline.json --threshold 0.2
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+# pylint: disable=wrong-import-position
+from benchmarks.synthetic import make_html_report, make_tree
+from utils.compression import CompressionPolicy
+from utils.flywheel_bids.results.zip_intermediate import (
+    zip_all_intermediate_output,
+    zip_selected,
+)
+from utils.flywheel_bids.results.zip_output import zip_output
+from utils.work_manifest import WorkDirManifest
+from utils.zip_htmls import zip_htmls
+
+# pylint: enable=wrong-import-position
+
+log = logging.getLogger(__name__)
+
+DESTINATION_ID = "0123456789abcdef01234567"
+TREE = "work"
+
+
+# each writes one half of a tree and returns its size (bytes)
+def make_many_small(root, scale):
+    return make_tree(root, max(1, int(200 * scale)), 25, 8 * 1024, depth=3)
+
+
+def make_few_huge(root, scale):
+    return make_tree(root, 2, 1, max(1024**2, int(128 * 1024**2 * scale)))
+
+
+def make_deep_html(root, scale):
+    report_dir = root / "figures"
+    for ii in range(max(1, int(10 * scale))):
+        make_html_report(report_dir, f"sub-{root.name}{ii:03d}", 100, depth=6)
+    return sum(ff.stat().st_size for ff in report_dir.rglob("*"))
+
+
+SHAPES = {
+    "many-small": make_many_small,
+    "few-huge": make_few_huge,
+    "deep-html": make_deep_html,
+}
+
+
+def bench_zip_output(tree, out_dir, workers, excluded):
+    # zip_output changes directory
+    cwd = os.getcwd()
+    try:
+        zip_output(
+            str(tree.parent),
+            tree.name,
+            str(out_dir / "output.zip"),
+            exclude_files=excluded,
+            policy=CompressionPolicy(),
+        )
+    finally:
+        os.chdir(cwd)
+
+
+def bench_zip_htmls(tree, out_dir, workers, excluded):
+    for report_dir in sorted(tree.glob("part*/figures")):
+        zip_htmls(str(out_dir), DESTINATION_ID, str(report_dir), workers=workers)
+
+
+def bench_zip_selected(tree, out_dir, workers, excluded):
+    zip_selected(
+        tree.parent,
+        tree.name,
+        out_dir / "selected.zip",
+        ["*.txt", "*.html"],
+        ["figures"],
+        CompressionPolicy(),
+        workers=workers,
+    )
+
+
+def bench_zip_all_intermediate_output(tree, out_dir, workers, excluded):
+    zip_all_intermediate_output(
+        DESTINATION_ID,
+        "bench",
+        str(out_dir),
+        str(tree),
+        "sub-001",
+        CompressionPolicy(),
+        workers=workers,
+    )
+
+
+FUNCTIONS = {
+    "zip_output": bench_zip_output,
+    "zip_htmls": bench_zip_htmls,
+    "zip_selected": bench_zip_selected,
+    "zip_all_intermediate_output": bench_zip_all_intermediate_output,
+}
+
+
+def run_benchmarks(scratch, shapes, functions, scale, repeat, workers):
+    """Time every function on every shape.
+
+    Returns:
+        results (dict): "shape/function" -> {"seconds", "MiB", "MiB/s"}
+    """
+    results = {}
+    for shape in shapes:
+        tree = scratch / shape / TREE
+        log.info("Making %s tree", shape)
+        # the first half is the "input", excluded from zip_output
+        written = SHAPES[shape](tree / "part0", scale)
+        excluded = WorkDirManifest.scan(tree.parent)
+        written += SHAPES[shape](tree / "part1", scale)
+        mib = written / 1024**2
+
+        for name in functions:
+            if name == "zip_htmls" and shape != "deep-html":
+                continue  # no reports in the other trees
+            best = None
+            for _ in range(repeat):
+                out_dir = Path(tempfile.mkdtemp(dir=scratch))
+                start = time.perf_counter()
+                FUNCTIONS[name](tree, out_dir, workers, excluded)
+                seconds = time.perf_counter() - start
+                shutil.rmtree(out_dir)
+                best = seconds if best is None else min(best, seconds)
+            results[f"{shape}/{name}"] = {
+                "seconds": round(best, 3),
+                "MiB": round(mib, 1),
+                "MiB/s": round(mib / best, 1),
+            }
+            log.info("%s/%s: %.1f MiB/s", shape, name, mib / best)
+        shutil.rmtree(tree.parent)
+    return results
+
+
+def compare(results, baseline, threshold):
+    """The benchmarks whose throughput dropped more than threshold below baseline.
+
+    Returns:
+        regressions (list of str)
+    """
+    regressions = []
+    for key, result in results.items():
+        base = baseline.get(key)
+        if not base:
+            continue
+        change = result["MiB/s"] / base["MiB/s"] - 1
+        line = f"{key:<42} {base['MiB/s']:>10.1f} {result['MiB/s']:>10.1f} {change:>+8.1%}"
+        if change < -threshold:
+            line += "  REGRESSION"
+            regressions.append(key)
+        print(line)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", 1)[0])
+    parser.add_argument("--shapes", nargs="*", choices=list(SHAPES), default=list(SHAPES))
+    parser.add_argument(
+        "--functions", nargs="*", choices=list(FUNCTIONS), default=list(FUNCTIONS)
+    )
+    parser.add_argument("--scale", type=float, default=1.0, help="size of the trees")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--scratch", help="directory to work in (default: a temp dir)")
+    parser.add_argument("--save-baseline", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON baseline to compare the results to")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="fraction of the baseline throughput that may be lost",
+    )
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s %(levelname)s %(message)s")
+    log.setLevel(logging.INFO)
+    # zip_selected warns about selectors a tree has nothing for
+    logging.getLogger("utils").setLevel(logging.ERROR)
+
+    with tempfile.TemporaryDirectory(dir=args.scratch) as scratch:
+        results = run_benchmarks(
+            Path(scratch), args.shapes, args.functions, args.scale, args.repeat, args.workers
+        )
+
+    report = {
+        "machine": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "workers": args.workers,
+            "scale": args.scale,
+        },
+        "results": results,
+    }
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as fp:
+            json.dump(report, fp, indent=2)
+
+    if args.compare:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)
+        if baseline["machine"].get("scale") != args.scale:
+            log.warning("The baseline was made with --scale %s", baseline["machine"].get("scale"))
+        print(f"{'benchmark':<42} {'base MiB/s':>10} {'MiB/s':>10} {'change':>8}")
+        regressions = compare(results, baseline["results"], args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regressions: {', '.join(regressions)}")
+            return 1
+    else:
+        for key, result in results.items():
+            print(f"{key:<42} {result['MiB/s']:>10.1f} MiB/s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,90 @@
+"""Stand-in for qsirecon: writes an output and work tree shaped like qsirecon's.
+
+It takes qsirecon's positional arguments (input dir, output dir, analysis level),
+ignores the options it does not need, prints nipype-like node messages (so the gear
+times the "stages") and writes:
+
+    <output dir>/derivatives/qsirecon-<workflow>/sub-*/ses-*/dwi/*  (images, tables)
+    <output dir>/derivatives/qsirecon-<workflow>/sub-*.html          (with figures)
+    <work dir>/qsirecon_wf/...                                       (nipype work)
+
+How much it writes is set with environment variables (see SIZES).
+"""
+
+import argparse
+import datetime
+import os
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from benchmarks.synthetic import make_html_report, make_nipype_work, write_file
+
+SIZES = {
+    # bytes of images per session
+    "STUB_OUTPUT_BYTES": 200 * 1024**2,
+    "STUB_IMAGES_PER_SESSION": 10,
+    "STUB_FIGURES": 50,
+    "STUB_WORK_NODES": 200,
+    "STUB_WORK_FILES_PER_NODE": 3,
+    "STUB_WORK_FILE_BYTES": 256 * 1024,
+    "STUB_SECONDS": 0,
+}
+WORKFLOWS = ["dsistudio_gqi", "mrtrix_singleshell_ss3t_ACT-hsvs"]
+
+
+def log_node(message):
+    stamp = datetime.datetime.now().strftime("%y%m%d-%H:%M:%S,%f")[:-3]
+    print(f"{stamp} nipype.workflow INFO:\n\t {message}", flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input_dir")
+    parser.add_argument("output_dir")
+    parser.add_argument("analysis_level")
+    parser.add_argument("--work-dir", "--work_dir", dest="work_dir", default="work")
+    parser.add_argument("--participant_label", "--participant-label", nargs="*")
+    args, _ = parser.parse_known_args()
+    sizes = {key: int(os.environ.get(key, default)) for key, default in SIZES.items()}
+
+    input_dir = Path(args.input_dir)
+    subjects = [
+        path.name
+        for path in sorted(input_dir.glob("sub-*"))
+        if path.is_dir()
+        and (not args.participant_label or path.name[4:] in args.participant_label)
+    ]
+
+    for workflow in WORKFLOWS:
+        node = f"qsirecon_wf.sub_wf.{workflow}_wf.recon"
+        log_node(f'[Node] Setting-up "{node}" in "{args.work_dir}".')
+        start = time.time()
+        deriv = Path(args.output_dir) / "derivatives" / f"qsirecon-{workflow}"
+        for subject in subjects:
+            sessions = sorted(path.name for path in (input_dir / subject).glob("ses-*"))
+            for session in sessions or ["ses-01"]:
+                dwi = deriv / subject / session / "dwi"
+                n_images = sizes["STUB_IMAGES_PER_SESSION"]
+                for ii in range(n_images):
+                    write_file(
+                        dwi / f"{subject}_{session}_model-{ii}_dwimap.nii.gz",
+                        sizes["STUB_OUTPUT_BYTES"] // n_images // len(WORKFLOWS),
+                    )
+                write_file(dwi / f"{subject}_{session}_connectivity.tsv", 64 * 1024, True)
+            make_html_report(deriv, subject, sizes["STUB_FIGURES"])
+        time.sleep(sizes["STUB_SECONDS"] / len(WORKFLOWS))
+        log_node(f'[Node] Finished "{node}", elapsed time {time.time() - start:.2f}s.')
+
+    make_nipype_work(
+        args.work_dir,
+        sizes["STUB_WORK_NODES"],
+        sizes["STUB_WORK_FILES_PER_NODE"],
+        sizes["STUB_WORK_FILE_BYTES"],
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""Generate synthetic inputs and outputs shaped like qsiprep's and qsirecon's.
+
+Image files are filled with random bytes (they are gzipped in real life, so they do
+not compress), text files with repetitive text (they compress well), so that the
+gear's packaging does the same work as on real data.
+"""
+
+import json
+import os
+import random
+from pathlib import Path
+from zipfile import ZIP_STORED, ZipFile
+
+CHUNK = 1024 * 1024
+LOREM = (
+    b"Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod "
+    b"tempor incididunt ut labore et dolore magna aliqua.\n"
+)
+
+
+def fill(fp, size, compressible=False):
+    """Write size bytes to an open file, random unless compressible."""
+    text = LOREM * (CHUNK // len(LOREM) + 1)
+    while size > 0:
+        step = min(size, CHUNK)
+        fp.write(text[:step] if compressible else os.urandom(step))
+        size -= step
+
+
+def write_file(path, size, compressible=False):
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "wb") as fp:
+        fill(fp, size, compressible)
+
+
+def qsiprep_members(n_subjects, n_sessions=1, files_per_subject=8):
+    """Paths (under qsiprep/) and kinds ("image" or "text") of a qsiprep output."""
+    members = [("qsiprep/dataset_description.json", "text")]
+    for sub in range(1, n_subjects + 1):
+        subject = f"sub-{sub:03d}"
+        members.append((f"qsiprep/{subject}.html", "text"))
+        members.append((f"qsiprep/{subject}/anat/{subject}_desc-preproc_T1w.nii.gz", "image"))
+        members.append((f"qsiprep/{subject}/anat/{subject}_desc-brain_mask.nii.gz", "image"))
+        for ses in range(1, n_sessions + 1):
+            prefix = f"qsiprep/{subject}/ses-{ses:02d}/dwi/{subject}_ses-{ses:02d}"
+            members.append((f"{prefix}_space-T1w_desc-preproc_dwi.nii.gz", "image"))
+            for suffix in ("dwi.bval", "dwi.bvec", "dwi.b", "confounds.tsv", "dwi.json"):
+                members.append((f"{prefix}_space-T1w_desc-preproc_{suffix}", "text"))
+            for ii in range(max(0, files_per_subject - 6)):
+                members.append((f"{prefix}_desc-extra{ii}_dwi.nii.gz", "image"))
+        for ii in range(3):
+            members.append((f"qsiprep/{subject}/figures/{subject}_fig{ii}.svg", "text"))
+    return members
+
+
+def make_qsiprep_zip(
+    zip_path, analysis_id, n_subjects, total_bytes, n_sessions=1, files_per_subject=8
+):
+    """Write a qsiprep archive zip (top directory named after the analysis id).
+
+    The images share total_bytes, text files are 4 KiB each.
+
+    Returns:
+        members (list of str): the paths in the zip
+    """
+    members = qsiprep_members(n_subjects, n_sessions, files_per_subject)
+    n_images = sum(1 for _, kind in members if kind == "image")
+    image_size = max(1, total_bytes // max(1, n_images))
+    with ZipFile(zip_path, "w", ZIP_STORED, allowZip64=True) as zip_file:
+        for path, kind in members:
+            size = image_size if kind == "image" else 4096
+            with zip_file.open(f"{analysis_id}/{path}", "w", force_zip64=True) as fp:
+                fill(fp, size, compressible=kind == "text")
+    return [path for path, _ in members]
+
+
+def make_html_report(report_dir, name, n_figures, depth=1, figure_size=20 * 1024):
+    """Write report_dir/<name>.html linking to n_figures svg files depth dirs down."""
+    links = []
+    for ii in range(n_figures):
+        sub_dirs = "/".join(f"level{level}" for level in range(depth))
+        rel = f"{name}/{sub_dirs}/figures/{name}_fig{ii}.svg"
+        write_file(Path(report_dir) / rel, figure_size, compressible=True)
+        links.append(f'<a href="{rel}"><img src="{rel}"/></a>')
+    with open(Path(report_dir) / f"{name}.html", "w") as fp:
+        fp.write("<html><body>\n" + "\n".join(links) + "\n</body></html>\n")
+
+
+def make_tree(root, n_dirs, files_per_dir, file_size, compressible_every=2, depth=2):
+    """Write n_dirs directories (depth levels deep) of files_per_dir files each.
+
+    Every compressible_every-th file is text, the others random.
+
+    Returns:
+        total_bytes (int)
+    """
+    total = 0
+    for dd in range(n_dirs):
+        parts = [f"d{dd % (level + 7)}_{level}" for level in range(depth - 1)]
+        dir_path = Path(root, *parts, f"node{dd}")
+        for ff in range(files_per_dir):
+            text = compressible_every and ff % compressible_every == 0
+            name = f"file{ff}.txt" if text else f"file{ff}.nii.gz"
+            write_file(dir_path / name, file_size, compressible=text)
+            total += file_size
+    return total
+
+
+def make_nipype_work(work_dir, n_nodes, files_per_node, file_size, seed=0):
+    """Write a nipype-like work dir with a resource_monitor.json.
+
+    Returns:
+        node_names (list of str)
+    """
+    rng = random.Random(seed)
+    names = []
+    monitor = {key: [] for key in ("time", "name", "interface", "rss_GiB", "vms_GiB")}
+    monitor.update({"cpus": [], "mapnode": [], "params": []})
+    clock = 1.7e9
+    for ii in range(n_nodes):
+        workflow = f"qsirecon_wf.sub_wf.recon_{ii % 5}_wf"
+        node = f"node_{ii}"
+        names.append(f"{workflow}.{node}")
+        node_dir = Path(work_dir, *workflow.split("."), node)
+        for ff in range(files_per_node):
+            write_file(node_dir / f"out_{ff}.nii.gz", file_size)
+        write_file(node_dir / "_report" / "report.rst", 2048, compressible=True)
+        write_file(node_dir / f"result_{node}.pklz", 4096)
+        for _ in range(3):
+            clock += rng.uniform(1, 10)
+            monitor["time"].append(clock)
+            monitor["name"].append(f"{workflow}.{node}")
+            monitor["interface"].append("Stub")
+            monitor["rss_GiB"].append(rng.uniform(0.1, 4))
+            monitor["vms_GiB"].append(rng.uniform(1, 8))
+            monitor["cpus"].append(rng.uniform(50, 400))
+            monitor["mapnode"].append(0)
+            monitor["params"].append("")
+    monitor_file = Path(work_dir, "qsirecon_wf", "resource_monitor.json")
+    monitor_file.parent.mkdir(parents=True, exist_ok=True)
+    with open(monitor_file, "w") as fp:
+        json.dump(monitor, fp)
+    return names
@@ -3,14 +3,19 @@
 import logging
 from pathlib import Path
 from typing import List, Tuple
-import json
-import re
 import os
+import tempfile
 from flywheel_gear_toolkit.interfaces.command_line import (
     build_command_list,
     exec_command,
 )
 
+from utils.compression import CompressionPolicy
+from utils.incremental_zip import IncrementalPackager
+from utils.metadata import update_analysis_info
+from utils.resource_sampler import ResourceSampler
+from utils.stage_timing import StageTimer, stream_command
+
 log = logging.getLogger(__name__)
 
 
@@ -36,9 +41,6 @@ def generate_command(
     # (PV: Not sure if this is the case anymore. Their template seems to
     # suggest so, but not the general documentation.)
     cmd = [
-        "/usr/bin/time",
-        "-v",
-        "--output=time_output.txt",
         str(gear_options["bids-app-binary"]),
         str(gear_options["input-dir"]),
         str(gear_options["output_analysis_id_dir"]),
@@ -137,38 +139,57 @@ def run(gear_options: dict, app_options: dict) -> int:
     # This is what it is all about
     log.info(os.environ)
 
-    exec_command(
-        command,
-        environ=os.environ,
-        dry_run=gear_options["dry-run"],
-        shell=True,
-        cont_output=True,
-    )
+    # Sample the resources used by the app's process tree while it runs
+    output_dir = gear_options["output-dir"]
+    sampler = None
+    if gear_options["resource-sample-interval"] and not gear_options["dry-run"]:
+        sampler = ResourceSampler(
+            Path(output_dir) / "resource_usage.csv",
+            interval=gear_options["resource-sample-interval"],
+        )
+        sampler.start()
+
+    # Compress the output files qsirecon is done with while it still runs
+    packager = None
+    if gear_options["incremental-zip-quiet-period"] and not gear_options["dry-run"]:
+        gear_options["staging-dir"] = tempfile.mkdtemp(
+            prefix="staged_output-", dir=Path(gear_options["work-dir"]).parent
+        )
+        packager = IncrementalPackager(
+            output_dir,
+            gear_options["destination-id"],
+            gear_options["staging-dir"],
+            quiet_period=gear_options["incremental-zip-quiet-period"],
+            policy=CompressionPolicy(
+                text_level=gear_options["zip-text-compression-level"]
+            ),
+            exclude_files=gear_options["unzipped-files"],
+        )
+        packager.start()
+
+    # Time the workflow nodes from the app's log as it is printed
+    timer = StageTimer()
+
+    try:
+        if gear_options["dry-run"]:
+            exec_command(command, environ=os.environ, dry_run=True, shell=True)
+        else:
+            stream_command(command, environ=os.environ, on_line=timer.feed)
+    finally:
+        info = {}
+        if packager:
+            gear_options["staged-output"] = packager.stop()
+        if sampler:
+            sampler.stop()
+            # Save resources used in metadata on analysis
+            info["resources used"] = sampler.summary(n_cpus=app_options.get("n_cpus"))
+        if timer.nodes:
+            timer.write_csv(Path(output_dir) / "stage_timings.csv")
+            info["stage timings"] = timer.summary()
+        if info:
+            update_analysis_info(output_dir, info)
 
     # if we made it this far, return success:
     run_error = 0
 
-    # Save time, etc. resources used in metadata on analysis
-    output_dir = gear_options["output-dir"]
-    if Path("time_output.txt").exists():  # some tests won't have this file
-        metadata = {
-            "analysis": {"info": {"resources used": {}, }, },
-        }
-        with open("time_output.txt") as file:
-            for line in file:
-                if ":" in line:
-                    if (
-                            "Elapsed" in line
-                    ):  # special case "Elapsed (wall clock) time (h:mm:ss or m:ss): 0:08.11"
-                        sline = re.split(r"\):", line)
-                        sline[0] += ")"
-                    else:
-                        sline = line.split(":")
-                    key = sline[0].strip()
-                    val = sline[1].strip(' "\n')
-                    metadata["analysis"]["info"]["resources used"][key] = val
-        with open(f"{output_dir}/.metadata.json", "w") as fff:
-            json.dump(metadata, fff)
-            log.info(f"Wrote {output_dir}/.metadata.json")
-
     return run_error
@@ -3,7 +3,14 @@ from typing import Tuple
 
 from flywheel_gear_toolkit import GearToolkitContext
 
+from utils.checkpoint import Checkpoint, checkpoint_key
+from utils.containers import ContainerCache
+from utils.download_cache import DownloadCache, cache_key, cached_download
 from utils.fly.set_performance_config import set_mem_gb, set_n_cpus
+from utils.zip_remote import RangeNotSupported, fetch_zip_members, member_selector
+from utils.zip_stream import stream_download_and_extract
+from utils.work_manifest import WorkDirManifest
+import urllib.parse
 import tempfile
 import subprocess as sp
 from flywheel_gear_toolkit import GearToolkitContext
@@ -15,9 +22,14 @@ log = logging.getLogger(__name__)
 
 def parse_config(
     gear_context: GearToolkitContext,
+    containers: ContainerCache = None,
 ) -> Tuple[dict, dict]:
     """Parse the config and other options from the context, both gear and app options.
 
+    Args:
+        gear_context: the gear context
+        containers: cache of the containers already fetched in this run
+
     Returns:
         gear_options: options for the gear
         app_options: options to pass to the app
@@ -37,13 +49,46 @@ def parse_config(
         "intermediate-files": gear_context.config.get("gear-intermediate-files"),
         "intermediate-folders": gear_context.config.get("gear-intermediate-folders"),
         "keep-output": gear_context.config.get("gear-keep-output"),
+        "templateflow-shared-dir": gear_context.config.get(
+            "gear-templateflow-shared-dir"
+        ),
+        "input-zip-mode": gear_context.config.get("gear-input-zip-mode") or "unzip",
+        "resource-sample-interval": gear_context.config.get(
+            "gear-resource-sample-interval", 10
+        ),
+        "checkpoint-dir": gear_context.config.get("gear-checkpoint-dir"),
+        "checkpoint-max-age-days": gear_context.config.get(
+            "gear-checkpoint-max-age-days", 7
+        ),
+        "checkpoint-max-gb": gear_context.config.get("gear-checkpoint-max-gb", 500),
+        "zip-text-compression-level": gear_context.config.get(
+            "gear-zip-text-compression-level", 6
+        ),
+        "download-cache-dir": gear_context.config.get("gear-download-cache-dir"),
+        "download-cache-max-gb": gear_context.config.get(
+            "gear-download-cache-max-gb", 200
+        ),
+        "incremental-zip-quiet-period": gear_context.config.get(
+            "gear-incremental-zip-quiet-period", 0
+        ),
+        "batch-sessions": gear_context.config.get("gear-batch-sessions") or "",
+        "batch-max-parallel": gear_context.config.get("gear-batch-max-parallel", 0),
         "dry-run": gear_context.config.get("gear-dry-run"),
         "output-dir": gear_context.output_dir,
         "destination-id": gear_context.destination["id"],
         "work-dir": gear_context.work_dir,
         "client": gear_context.client,
+        "containers": containers or ContainerCache(gear_context.client),
     }
 
+    # files downloaded by other jobs on this node are linked, not downloaded again
+    gear_options["download-cache"] = None
+    if gear_options["download-cache-dir"]:
+        gear_options["download-cache"] = DownloadCache(
+            gear_options["download-cache-dir"],
+            max_gb=gear_options["download-cache-max-gb"],
+        )
+
     # set the output dir name for the BIDS app:
     gear_options["output_analysis_id_dir"] = (
         gear_options["output-dir"] / gear_options["destination-id"] / Path("bids")
@@ -83,36 +128,93 @@ def parse_config(
     app_options = {key: gear_context.config.get(key) for key in app_options_keys}
 
     app_options["n_cpus"] = set_n_cpus(app_options["n_cpus"] or 0)
+    # the gear's own parallel steps (e.g. building archives) use the same limit
+    gear_options["n-cpus"] = app_options["n_cpus"]
     # qsiprep only takes integers:
     app_options["mem_mb"] = int(1024 * set_mem_gb((app_options["mem_mb"] or 0) / 1024))
 
+    # The members selective mode keeps (see RECON_INPUT_PATTERNS) are laid out as
+    # in QSIPrep's derivatives: from other pipelines, it would keep almost nothing
+    if gear_options["input-zip-mode"] == "selective" and (
+        app_options["input-type"] or "qsiprep"
+    ) != "qsiprep":
+        log.warning(
+            "gear-input-zip-mode selective only works with QSIPrep input, "
+            'not input-type "%s": using stream instead',
+            app_options["input-type"],
+        )
+        gear_options["input-zip-mode"] = "stream"
+
     rs_path = gear_context.get_input_path("recon-spec")
     if rs_path:
         app_options["recon-spec"] = rs_path
 
     preproc_path = gear_context.get_input("preprocessing-pipeline-zip")
+    inputs_dir = gear_options["work-dir"]
+    gear_options["checkpoint"] = None
+    gear_options["pipeline-gear"] = None
     if preproc_path:
         analysis = gear_context.client.get_container(preproc_path["hierarchy"]["id"])
         file = gear_context.client.get_file(preproc_path["object"]["file_id"])
-        download_and_unzip_inputs(analysis, file, gear_options["work-dir"])
+        # in batch mode, each session's input is the output of this same gear
+        gear_options["pipeline-gear"] = analysis.gear_info.name
+
+    if preproc_path and not gear_options["batch-sessions"]:
+        if gear_options["checkpoint-dir"]:
+            # keep inputs and the app's work dir where a retry of this job finds them
+            key = checkpoint_key(
+                gear_options["destination-id"], file.id, file.version, app_options
+            )
+            gear_options["checkpoint"] = Checkpoint.open(
+                gear_options["checkpoint-dir"],
+                key,
+                max_age_days=gear_options["checkpoint-max-age-days"],
+                max_gb=gear_options["checkpoint-max-gb"],
+            )
+        checkpoint = gear_options["checkpoint"]
+        if checkpoint:
+            inputs_dir = checkpoint.inputs_dir
+
+        if checkpoint and checkpoint.inputs_complete:
+            log.info("Using inputs kept in checkpoint %s", checkpoint.path)
+        else:
+            participant_label = None
+            if gear_options["input-zip-mode"] == "selective":
+                # only the subject this job runs for is fetched from the zip
+                _, parents = gear_options["containers"].hierarchy(
+                    gear_options["destination-id"]
+                )
+                participant_label = parents["subject"].label
+            download_and_unzip_inputs(
+                analysis,
+                file,
+                inputs_dir,
+                mode=gear_options["input-zip-mode"],
+                workers=app_options["n_cpus"],
+                client=gear_context.client,
+                participant_label=participant_label,
+                cache=gear_options["download-cache"],
+            )
+            if gear_options["download-cache"]:
+                gear_options["download-cache"].summary()
+            if checkpoint:
+                checkpoint.mark_inputs_complete()
 
     work_dir = gear_options["work-dir"]
-    if work_dir:
+    if gear_options["checkpoint"]:
+        app_options["work-dir"] = gear_options["checkpoint"].work_dir
+    elif work_dir:
         app_options["work-dir"] = work_dir
+    gear_options["app-work-dir"] = app_options.get("work-dir", work_dir)
 
     # get input directory for gear
-    gear_options["input-dir"] = os.path.join(gear_options["work-dir"], "".join([x for x in next(os.walk(gear_options["work-dir"]))[1] if x in ["qsiprep","ukb","hcpya"]]))
+    gear_options["input-dir"] = find_input_dir(inputs_dir)
 
     #always add resource monitor
     app_options["resource-monitor"] = True
 
-    # pull original file structure
-    orig = []
-    for path, subdirs, files in os.walk(gear_options["work-dir"]):
-        for name in files:
-            orig.append(os.path.join(path, name))
-
-    gear_options["unzipped-files"] = orig
+    # pull original file structure (paths relative to the work dir)
+    gear_options["unzipped-files"] = WorkDirManifest.scan(gear_options["work-dir"])
 
     # matplotlib workaround for multiple runs on same hpc node
     environ = os.environ
@@ -122,13 +224,175 @@ def parse_config(
     return gear_options, app_options
 
 
+def batch_session_ids(client, destination, batch_sessions):
+    """Ids of the sessions to run in batch mode.
+
+    Args:
+        client: flywheel client (or ContainerCache)
+        destination: the analysis container the gear runs for
+        batch_sessions (string): space or comma separated session ids, or "all" for
+            all the sessions in the analysis' parent (project or subject)
+
+    Returns:
+        session_ids (list of string)
+    """
+    if batch_sessions.strip().lower() == "all":
+        parent = client.get(destination.parent.id)
+        return [session.id for session in parent.sessions.iter()]
+    return batch_sessions.replace(",", " ").split()
+
+
+def session_options(gear_options, app_options, session_id, n_cpus, mem_mb):
+    """Gear and app options to run one session of a batch.
+
+    The session gets its own inputs, work and output directories (under the gear's
+    work dir) and its share of the CPUs and memory.  Its input is the most recent
+    zip output by the gear that produced the "preprocessing-pipeline-zip" input.
+
+    Args:
+        gear_options (dict): options for the gear (the whole batch)
+        app_options (dict): options for the app (the whole batch)
+        session_id (string): session to run
+        n_cpus (int): CPUs for this session
+        mem_mb (int): memory (MiB) for this session
+
+    Returns:
+        gear_options (dict), app_options (dict), run_label (string)
+    """
+    client = gear_options["client"]
+    session, parents = gear_options["containers"].hierarchy(session_id)
+    subject = parents["subject"]
+    run_label = f"{subject.label}_{session.label}"
+
+    session_dir = Path(gear_options["work-dir"]) / "batch" / session.id
+    inputs_dir = session_dir / "inputs"
+    work_dir = session_dir / "work"
+    output_dir = session_dir / "output"
+    for path in (work_dir, output_dir):
+        path.mkdir(parents=True, exist_ok=True)
+
+    analysis, file_obj = latest_pipeline_zip(
+        client, session.id, gear_options["pipeline-gear"]
+    )
+    log.info("%s: using %s from analysis %s", run_label, file_obj.name, analysis.label)
+    download_and_unzip_inputs(
+        analysis,
+        file_obj,
+        inputs_dir,
+        mode=gear_options["input-zip-mode"],
+        workers=n_cpus,
+        client=client,
+        participant_label=subject.label,
+        cache=gear_options["download-cache"],
+    )
+
+    batch_gear_options = dict(gear_options)
+    batch_gear_options.update(
+        {
+            "batch-dir": session_dir,
+            "output-dir": output_dir,
+            "output_analysis_id_dir": output_dir
+            / gear_options["destination-id"]
+            / Path("bids"),
+            "work-dir": work_dir,
+            "app-work-dir": work_dir,
+            "input-dir": find_input_dir(inputs_dir),
+            "n-cpus": n_cpus,
+            "checkpoint": None,
+            # one sampler follows the whole batch
+            "resource-sample-interval": 0,
+            "unzipped-files": WorkDirManifest.scan(session_dir),
+        }
+    )
+
+    batch_app_options = dict(app_options)
+    batch_app_options.update(
+        {
+            "n_cpus": n_cpus,
+            "mem_mb": mem_mb,
+            "work-dir": work_dir,
+            # BIDS-Apps take only the (subject) label, without the "sub-" part
+            "participant_label": subject.label[len("sub-") :]
+            if subject.label.startswith("sub-")
+            else subject.label,
+        }
+    )
+
+    return batch_gear_options, batch_app_options, run_label
+
+
 # SUPPORT FUNCTIONS !!
-def download_and_unzip_inputs(parent_obj, file_obj, path):
+def find_input_dir(inputs_dir):
+    """Directory with the preprocessing pipeline output, in the unzipped inputs."""
+    return os.path.join(
+        inputs_dir,
+        "".join(
+            [
+                x
+                for x in next(os.walk(inputs_dir))[1]
+                if x in ["qsiprep", "ukb", "hcpya"]
+            ]
+        ),
+    )
+
+
+def latest_pipeline_zip(client, session_id, gear_name):
+    """Most recent zip output by gear_name in a session.
+
+    Args:
+        client: flywheel client
+        session_id (string): session to look in
+        gear_name (string): name of the preprocessing gear (e.g. "bids-qsiprep")
+
+    Returns:
+        analysis, file_obj
+
+    Raises:
+        ValueError: if the session has no such zip
+    """
+    analyses = [
+        analysis
+        for analysis in client.get_session_analyses(session_id)
+        if analysis.gear_info and analysis.gear_info.name == gear_name
+    ]
+    for analysis in sorted(analyses, key=lambda aa: aa.created, reverse=True):
+        # the main output zip, not the html reports or the intermediate work
+        zips = [
+            ff
+            for ff in analysis.files or []
+            if ff.name.endswith(".zip")
+            and not ff.name.endswith(".html.zip")
+            and "_work_" not in ff.name
+        ]
+        if zips:
+            return analysis, zips[0]
+    raise ValueError(f"Session {session_id} has no zip output by {gear_name}")
+
+
+def download_and_unzip_inputs(
+    parent_obj,
+    file_obj,
+    path,
+    mode="unzip",
+    workers=1,
+    client=None,
+    participant_label=None,
+    cache=None,
+):
     """
     unzip_inputs unzips the contents of zipped gear output into the working
     directory.
     Args:
-        zip_filename (string): The file to be unzipped
+        parent_obj: container the zip file is attached to
+        file_obj: the zip file to download and unzip
+        path (string): directory to unzip into
+        mode (string): "unzip" to download, then unzip, "stream" to extract
+            members while the file is downloading, or "selective" to fetch only the
+            members qsirecon needs with range requests
+        workers (int): number of threads used to write extracted files
+        client: flywheel client, used to build the file's URL ("selective")
+        participant_label (string): subject to fetch ("selective")
+        cache (DownloadCache): where the zip may already be, from an earlier job
     """
     rc = 0
     outpath = []
@@ -139,16 +403,54 @@ def download_and_unzip_inputs(parent_obj, file_obj, path):
     if ".zip" not in file_obj.name:
         return
 
+    # the zip is the same as long as its id and version are
+    download = cached_download(
+        cache, cache_key(file_obj.id, file_obj.version), file_obj.download
+    )
+
     # next check if the zip file is organized with analysis id as top dir
     zip_info = parent_obj.get_file_zip_info(file_obj.name)
     zip_top_dir = Path(zip_info.members[0].path).parts[0]
-    if len(zip_top_dir) == 24:
+    strip_top_dir = len(zip_top_dir) == 24
+    if mode == "selective":
+        url, headers = file_url_and_headers(client, parent_obj.id, file_obj.name)
+        try:
+            fetch_zip_members(
+                url,
+                path if strip_top_dir else os.path.join(path, "files"),
+                member_selector(participant_label),
+                headers=headers,
+                strip_top_dir=strip_top_dir,
+                workers=workers,
+            )
+            return str(path) if strip_top_dir else os.path.join(path, "files")
+        except RangeNotSupported as exc:
+            log.warning("Cannot fetch selected zip members (%s), streaming it", exc)
+            mode = "stream"
+
+    if mode == "stream":
+        # extract straight into the destination while downloading, the archive
+        # zip's top (analysis id) directory is dropped on the way
+        if not strip_top_dir:
+            path = os.path.join(path, "files")
+            os.makedirs(path, exist_ok=True)
+        with tempfile.TemporaryDirectory(dir=path) as tempdir:
+            log.info("Downloading and unzipping file, %s", file_obj.name)
+            stream_download_and_extract(
+                download,
+                os.path.join(tempdir, file_obj.name),
+                path,
+                strip_top_dir=strip_top_dir,
+                workers=workers,
+            )
+            log.info("Done unzipping.")
+    elif len(zip_top_dir) == 24:
         # this is an archive zip and needs to be handled special
         with tempfile.TemporaryDirectory(dir=path) as tempdir:
             zipfile = os.path.join(tempdir, file_obj.name)
 
             # download zip
-            file_obj.download(zipfile)
+            download(zipfile)
 
             # use linux "unzip" methods in shell in case symbolic links exist
             log.info("Unzipping file, %s", os.path.basename(zipfile))
@@ -171,7 +473,7 @@ def download_and_unzip_inputs(parent_obj, file_obj, path):
         os.makedirs(path, exist_ok=True)
         zipfile = os.path.join(path, file_obj.name)
         # download zip
-        file_obj.download(zipfile)
+        download(zipfile)
         # use linux "unzip" methods in shell in case symbolic links exist
         log.info("Unzipping file, %s", os.path.basename(zipfile))
         cmd = ["unzip", "-qq", "-o", zipfile, "-d", path]
@@ -182,6 +484,25 @@ def download_and_unzip_inputs(parent_obj, file_obj, path):
     return str(path)
 
 
+def file_url_and_headers(client, container_id, file_name):
+    """URL and authorization header to read a file attached to a container.
+
+    Args:
+        client: flywheel client
+        container_id (string): id of the container the file is attached to
+        file_name (string): name of the file
+
+    Returns:
+        url (string), headers (dict)
+    """
+    config = client.api_client.configuration
+    url = "{}/containers/{}/files/{}".format(
+        config.host.rstrip("/"), container_id, urllib.parse.quote(file_name)
+    )
+    headers = {"Authorization": config.get_api_key_with_prefix("Authorization")}
+    return url, headers
+
+
 def run_command_with_retry(cmd, retries=3, delay=1, cwd=os.getcwd()):
     """Runs a command with retries and delay on failure."""
 
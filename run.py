@@ -3,7 +3,6 @@
 import json
 import logging
 import os
-import shutil
 import sys
 from pathlib import Path
 from typing import List, Tuple, Union
@@ -12,23 +11,45 @@ from utils.flywheel_bids.results.zip_intermediate import (
     zip_all_intermediate_output,
     zip_intermediate_selected,
 )
+from utils.flywheel_bids.results.zip_output import zip_output
 from utils.flywheel_bids.utils.download_run_level import download_bids_for_runlevel
 from utils.flywheel_bids.utils.run_level import get_analysis_run_level_and_hierarchy
 from flywheel_gear_toolkit import GearToolkitContext
 from flywheel_gear_toolkit.licenses.freesurfer import install_freesurfer_license
 from flywheel_gear_toolkit.utils.file import sanitize_filename
 from flywheel_gear_toolkit.utils.metadata import Metadata
-from flywheel_gear_toolkit.utils.zip_tools import zip_output
 
 # This design with the main interfaces separated from a gear module (with main and
 # parser) allows the gear module to be publishable, so it can then be imported in
 # another project, which enables chaining multiple gears together.
 from fw_gear_bids_qsirecon.main import prepare, run
-from fw_gear_bids_qsirecon.parser import parse_config
+from fw_gear_bids_qsirecon.parser import (
+    batch_session_ids,
+    parse_config,
+    session_options,
+)
 from utils.dry_run import pretend_it_ran
-from utils.zip_htmls import zip_htmls
-
+from utils.zip_htmls import html_archive_jobs
+
+from utils.batch import collect_session_output, plan_slots, run_batch
+from utils.compression import CompressionPolicy
+from utils.containers import ContainerCache
+from utils.deletion import (
+    delete_in_background,
+    delete_tree,
+    tombstone_dir,
+    wait_for_deletions,
+)
+from utils.metadata import update_analysis_info
+from utils.packaging import ArchiveJob, run_archive_jobs
+from utils.resource_report import write_resource_report
+from utils.resource_sampler import ResourceSampler
 from utils.singularity import run_in_tmp_dir
+from utils.templateflow import (
+    build_manifest,
+    shared_templateflow_dir,
+    stage_templateflow,
+)
 
 # The gear is split up into 2 main components. The run.py file which is executed
 # when the container runs. The run.py file then imports the rest of the gear as a
@@ -41,8 +62,6 @@ log = logging.getLogger(__name__)
 FREESURFER_HOME = "/opt/freesurfer"
 # FREESURFER_HOME = "./freesurfer"
 
-os.chdir("/flywheel/v0")
-
 
 # pylint: disable=too-many-arguments
 def post_run(
@@ -67,47 +86,116 @@ def post_run(
     #  <gear_name>_<project|subject|session label>_<analysis.id>.zip
     zip_file_name = f"{gear_name}_{run_label}_{gear_options['destination-id']}.zip"
 
-    exclude_files = [i.replace(str(gear_options["work-dir"]) + os.sep, '') for i in set(gear_options["unzipped-files"])]
+    # paths relative to the work dir, with O(1) lookups
+    exclude_files = gear_options["unzipped-files"]
 
-    zip_output(
-        str(gear_options["output-dir"]),
-        gear_options["destination-id"],
-        zip_file_name,
-        dry_run=gear_options["dry-run"],
-        exclude_files=exclude_files,
+    # What each node used, next to qsirecon's html so it is zipped (and viewable)
+    # with it
+    html_dirs = sorted(
+        glob.glob(str(Path(analysis_output_dir) / "derivatives" / "qsirecon*"))
     )
+    # (the outputs are zipped whatever happens to it)
+    try:
+        resource_report = write_resource_report(
+            gear_options["app-work-dir"],
+            html_dirs[0] if html_dirs else analysis_output_dir,
+        )
+    except Exception as exc:  # pylint: disable=broad-except
+        log.warning("Could not write the resource report: %s", exc)
+        resource_report = None
+
+    # Already compressed files are stored, text is compressed at the configured level
+    policy = CompressionPolicy(text_level=gear_options["zip-text-compression-level"])
+
+    # Each archive is built by its own process, so they run at the same time
+    archive_jobs = [
+        ArchiveJob(
+            "output",
+            zip_output,
+            (
+                str(gear_options["output-dir"]),
+                gear_options["destination-id"],
+                os.path.join(gear_options["output-dir"], zip_file_name),
+            ),
+            {
+                "dry_run": gear_options["dry-run"],
+                "exclude_files": exclude_files,
+                "policy": policy,
+                # files compressed while the app ran
+                "staged": gear_options.get("staged-output"),
+            },
+        )
+    ]
 
     # zip any .html files in output/<analysis_id>/
-    for html_dir in glob.glob(str(Path(analysis_output_dir) / "derivatives" / "qsirecon*")):
-        zip_htmls(str(gear_options["output-dir"]), gear_options["destination-id"], html_dir)
+    archive_jobs.extend(
+        html_archive_jobs(
+            gear_options["output-dir"], gear_options["destination-id"], html_dirs
+        )
+    )
 
     # possibly save ALL intermediate output
     if gear_options["save-intermediate-output"]:
-        zip_all_intermediate_output(
-            gear_options["destination-id"],
-            gear_name,
-            gear_options["output-dir"],
-            gear_options["work-dir"],
-            run_label,
+        archive_jobs.append(
+            ArchiveJob(
+                "intermediate",
+                zip_all_intermediate_output,
+                (
+                    gear_options["destination-id"],
+                    gear_name,
+                    gear_options["output-dir"],
+                    gear_options["app-work-dir"],
+                    run_label,
+                    policy,
+                ),
+            )
         )
 
     # possibly save intermediate files and folders
-    zip_intermediate_selected(
-        gear_options["intermediate-files"],
-        gear_options["intermediate-folders"],
-        gear_options["destination-id"],
-        gear_name,
-        gear_options["output-dir"],
-        gear_options["work-dir"],
-        run_label,
+    archive_jobs.append(
+        ArchiveJob(
+            "intermediate selected",
+            zip_intermediate_selected,
+            (
+                gear_options["intermediate-files"],
+                gear_options["intermediate-folders"],
+                gear_options["destination-id"],
+                gear_name,
+                gear_options["output-dir"],
+                gear_options["app-work-dir"],
+                run_label,
+                policy,
+            ),
+        )
     )
 
+    # Each archive process gets its share of the CPUs for its compression threads
+    n_cpus = gear_options["n-cpus"]
+    n_jobs = max(1, min(n_cpus, len(archive_jobs)))
+    for job in archive_jobs:
+        job.kwargs["workers"] = max(1, n_cpus // n_jobs)
+    timings, compression = run_archive_jobs(archive_jobs, n_cpus)
+    info = {
+        "archive times (s)": {name: round(tt, 2) for name, tt in timings.items()},
+        "archive compression": {
+            name: summary for name, summary in compression.items() if summary
+        },
+    }
+    if resource_report:
+        info["node resources"] = resource_report
+    update_analysis_info(gear_options["output-dir"], info)
+
+    # trees are moved out of the output dir, then deleted
+    tomb_dir = tombstone_dir(gear_options["work-dir"])
+    if gear_options.get("staging-dir"):
+        delete_in_background(gear_options["staging-dir"], tomb_dir)
+
     # clean up: remove output that was zipped
     if Path(analysis_output_dir).exists():
         if not gear_options["keep-output"]:
 
             log.debug('removing output directory "%s"', str(analysis_output_dir))
-            shutil.rmtree(analysis_output_dir)
+            delete_in_background(analysis_output_dir, tomb_dir)
 
         else:
             log.info('NOT removing output directory "%s"', str(analysis_output_dir))
@@ -137,6 +225,103 @@ def post_run(
 # pylint: enable=too-many-arguments
 
 
+def run_batch_sessions(
+    gear_name: str, gear_options: dict, app_options: dict, session_ids: List[str]
+) -> int:
+    """Run and package several sessions, dividing the resources between them.
+
+    Each session is run the way a single-session job would run it (see main), in
+    its own directory under the work dir, and its archives are moved to the gear
+    output directory.
+
+    Args:
+        gear_name (str): gear name, used in the output file names
+        gear_options (dict): gear options
+        app_options (dict): options for the app
+        session_ids (list[str]): sessions to run
+
+    Returns:
+        e_code (int): 0 if all sessions succeeded
+    """
+    slots = plan_slots(
+        gear_options["n-cpus"],
+        app_options["mem_mb"],
+        len(session_ids),
+        gear_options["batch-max-parallel"],
+    )
+
+    def run_session(session_id, slot):
+        errors = []
+        warnings = []
+        session_gear_options, session_app_options, run_label = session_options(
+            gear_options, app_options, session_id, slot.n_cpus, slot.mem_mb
+        )
+
+        if gear_options["dry-run"]:
+            e_code = 0
+            pretend_it_ran(session_gear_options, session_app_options)
+        else:
+            try:
+                e_code = run(session_gear_options, session_app_options)
+            except RuntimeError as exc:
+                e_code = 1
+                errors.append(str(exc))
+                log.critical(exc)
+                log.exception("Unable to execute command for %s.", run_label)
+
+        post_run(
+            gear_name=gear_name,
+            gear_options=session_gear_options,
+            analysis_output_dir=str(session_gear_options["output_analysis_id_dir"]),
+            run_label=run_label,
+            errors=errors,
+            warnings=warnings,
+        )
+        info = collect_session_output(
+            session_gear_options["output-dir"], gear_options["output-dir"], run_label
+        )
+        if not gear_options["keep-output"]:
+            delete_in_background(
+                session_gear_options["batch-dir"], tombstone_dir(gear_options["work-dir"])
+            )
+        return run_label, e_code, info
+
+    sampler = None
+    if gear_options["resource-sample-interval"] and not gear_options["dry-run"]:
+        sampler = ResourceSampler(
+            Path(gear_options["output-dir"]) / "resource_usage.csv",
+            interval=gear_options["resource-sample-interval"],
+        )
+        sampler.start()
+    try:
+        results = run_batch(session_ids, slots, run_session)
+    finally:
+        if sampler:
+            sampler.stop()
+
+    sessions_info = {}
+    failed = []
+    for session_id, result in results.items():
+        if isinstance(result, Exception):
+            failed.append(session_id)
+            sessions_info[session_id] = {"error": str(result)}
+            continue
+        run_label, e_code, info = result
+        if e_code != 0:
+            failed.append(run_label)
+        sessions_info[run_label] = dict(info, **{"exit code": e_code})
+
+    info = {"batch sessions": sessions_info}
+    if sampler:
+        info["resources used"] = sampler.summary(n_cpus=gear_options["n-cpus"])
+    update_analysis_info(gear_options["output-dir"], info)
+
+    if failed:
+        log.error("%d of %d sessions failed: %s", len(failed), len(results), failed)
+        return 1
+    return 0
+
+
 # pylint: disable=too-many-locals,too-many-statements
 def main(context: GearToolkitContext):
     FWV0 = Path.cwd()
@@ -151,9 +336,14 @@ def main(context: GearToolkitContext):
     return_code = 0
 
     """Parses config and runs."""
-    # For now, don't allow runs at the project level:
-    destination = context.client.get(context.destination["id"])
-    if destination.parent.type == "project":
+    # Containers are fetched once for the whole run, the destination's parents all
+    # at the same time
+    containers = ContainerCache(context.client)
+    destination, parents = containers.hierarchy(context.destination["id"])
+
+    # For now, don't allow runs at the project level (except in batch mode):
+    batch_sessions = context.config.get("gear-batch-sessions")
+    if destination.parent.type == "project" and not batch_sessions:
         log.exception(
             "This version of the gear does not run at the project level. "
             "Try running it for each individual subject."
@@ -170,7 +360,7 @@ def main(context: GearToolkitContext):
 
     # Call the fw_gear_bids_qsiprep.parser.parse_config function
     # to extract the args, kwargs from the context (e.g. config.json).
-    gear_options, app_options = parse_config(context)
+    gear_options, app_options = parse_config(context, containers=containers)
 
     # #adding the usual environment call
     # environ = get_and_log_environment()
@@ -197,16 +387,20 @@ def main(context: GearToolkitContext):
     )
 
     # TemplateFlow seems to be baked in to the container since 2021-10-07 16:25:12 so this is not needed...actually, it is for now...
-    templateflow_dir = FWV0 / "templateflow"
-    templateflow_dir.mkdir(parents=True, exist_ok=True)
+    orig = Path("/home/qsiprep/.cache/templateflow/")
+    templateflow_manifest = build_manifest(orig)
+    if gear_options["templateflow-shared-dir"]:
+        # Reuse templates staged by earlier jobs on this node
+        templateflow_dir = shared_templateflow_dir(
+            gear_options["templateflow-shared-dir"], templateflow_manifest[1]
+        )
+    else:
+        templateflow_dir = FWV0 / "templateflow"
+    # Fill writable templateflow directory with links to the existing templates so
+    # they don't have to be downloaded (or copied)
+    stage_templateflow(orig, templateflow_dir, manifest=templateflow_manifest)
     os.environ["SINGULARITYENV_TEMPLATEFLOW_HOME"] = str(templateflow_dir)
     os.environ["TEMPLATEFLOW_HOME"] = str(templateflow_dir)
-    orig = Path("/home/qsiprep/.cache/templateflow/")
-    # Fill writable templateflow directory with existing templates so they don't have to be downloaded
-    templates = list(orig.glob("*"))
-    for tt in templates:
-        # (templateflow_dir / tt.name).symlink_to(tt)
-        shutil.copytree(tt, templateflow_dir / tt.name, dirs_exist_ok = True)
 
     prepare_errors, prepare_warnings = prepare(
         gear_options=gear_options,
@@ -215,12 +409,20 @@ def main(context: GearToolkitContext):
     errors += prepare_errors
     warnings += prepare_warnings
 
+    if batch_sessions and len(errors) == 0:
+        # shared set-up is done, now run the sessions in this container
+        e_code = run_batch_sessions(
+            context.manifest["name"],
+            gear_options,
+            app_options,
+            batch_session_ids(containers, destination, batch_sessions),
+        )
+        log.info("Batch is done.  Returning %s", e_code)
+        return e_code
+
     if len(errors) == 0:
-        destination = gear_context.client.get(gear_context.destination["id"])
-        subject = gear_context.client.get(destination.parents.subject)
-        session = gear_context.client.get(destination.parents.session)
-        subject_label = subject.label
-        session_label = session.label
+        subject_label = parents["subject"].label
+        session_label = parents["session"].label
 
         # For BIDS-Apps that run at the participant level, set the
         # "participant_label" from the container from which it was launched.
@@ -272,6 +474,10 @@ def main(context: GearToolkitContext):
         warnings=warnings,
     )
 
+    # keep the app's work dir for a retry, unless the run succeeded
+    if gear_options["checkpoint"]:
+        gear_options["checkpoint"].close(success=e_code == 0)
+
     gear_builder = context.manifest.get("custom").get("gear-builder")
     # gear_builder.get("image") should be something like:
     # flywheel/bids-qsiprep:0.0.1_0.15.1
@@ -290,6 +496,9 @@ def main(context: GearToolkitContext):
 
 # Only execute if file is run as main, not when imported by another module
 if __name__ == "__main__":  # pragma: no cover
+    # the gear runs from its own directory (not when imported, e.g. by benchmarks)
+    os.chdir("/flywheel/v0")
+
     # Get access to gear config, inputs, and sdk client if enabled.
     with GearToolkitContext() as gear_context:
 
@@ -317,14 +526,23 @@ if __name__ == "__main__":  # pragma: no cover
 
         # Pass the gear context into main function defined above.
         return_code = main(gear_context)
+        deletion_wait = gear_context.config.get("gear-deletion-wait", 0)
     # clean up (might be necessary when running in a shared computing environment)
     if scratch_dir:
+        # The processes deleting in the background are killed with the (Slurm) job,
+        # and the scratch dir is on shared storage: finish the deletions (after
+        # waiting for them, if asked to), then delete the scratch dir (with any
+        # tombstones in it) before exiting
+        wait_for_deletions(deletion_wait, finish=True)
         log.debug("Removing scratch directory")
         for thing in scratch_dir.glob("*"):
             if thing.is_symlink():
                 thing.unlink()  # don't remove anything links point to
                 log.debug("unlinked %s", thing.name)
-        shutil.rmtree(scratch_dir)
-        log.debug("Removed %s", scratch_dir)
+        delete_tree(scratch_dir)
+
+    # trees are deleted in the background, wait (a while) only if asked to
+    elif deletion_wait:
+        wait_for_deletions(deletion_wait)
 
     sys.exit(return_code)
@@ -0,0 +1,64 @@
+"""The Flywheel API calls of a BIDS export, counted on a fake instance."""
+
+import pytest
+
+from benchmarks import fake_flywheel
+from benchmarks.bids_export import (
+    ACQUISITIONS,
+    EXPORTS,
+    count_calls,
+    make_project,
+    regressions,
+)
+from utils.flywheel_bids.export_bids import download_bids_dir
+
+PARTIAL = {name: filters for name, filters in EXPORTS.items() if filters}
+
+
+@pytest.mark.parametrize("filters", PARTIAL.values(), ids=PARTIAL.keys())
+def test_partial_export_calls_do_not_grow_with_project(tmp_path, filters):
+    calls = count_calls(tmp_path, 4, 2, **filters)
+
+    assert regressions(tmp_path, 4, 2, 5, calls, **filters) == []
+
+
+@pytest.mark.parametrize("filters", EXPORTS.values(), ids=EXPORTS.keys())
+def test_files_info_comes_with_listings(tmp_path, filters):
+    calls = count_calls(tmp_path, 4, 2, **filters)
+
+    # only the project, fetched for its own files
+    assert calls["containers fetched"] == 1
+    assert [call for call in calls if call.startswith("get_")] == ["get_project"]
+
+
+def test_files_info_fetched_when_listings_omit_it(tmp_path, monkeypatch):
+    iter_find = fake_flywheel._QueryFinder.iter_find
+
+    def without_info(self, query="", include_all_info=False, **kwargs):
+        return iter_find(self, query, **kwargs)
+
+    monkeypatch.setattr(fake_flywheel._QueryFinder, "iter_find", without_info)
+
+    calls = count_calls(tmp_path, 2, 2)
+
+    # a server that ignores include_all_info: the project and every acquisition
+    # (the sessions have no files)
+    assert calls["containers fetched"] == 1 + 2 * 2 * len(ACQUISITIONS)
+
+
+def test_export_again_keeps_dataset(tmp_path):
+    client, project = make_project(tmp_path, 2, 2)
+    bids_dir = tmp_path / "bids"
+
+    for _ in range(2):
+        download_bids_dir(client, project.id, "project", str(bids_dir))
+
+        exported = sorted(
+            str(path.relative_to(bids_dir)) for path in bids_dir.rglob("*.nii.gz")
+        )
+        assert exported == [
+            f"sub-{sub}/ses-{ses}/{folder}/sub-{sub}_ses-{ses}_{suffix}.nii.gz"
+            for sub in ("001", "002")
+            for ses in ("01", "02")
+            for folder, suffix in sorted(ACQUISITIONS.items())
+        ]
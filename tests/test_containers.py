@@ -0,0 +1,126 @@
+"""Fetch Flywheel containers once per run, counted on a fake instance."""
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from benchmarks.fake_flywheel import FakeClient
+from utils.containers import ContainerCache
+from utils.flywheel_bids.utils.run_level import get_analysis_run_level_and_hierarchy
+
+
+class SlowClient(FakeClient):
+    """A fake instance that takes latency seconds per get."""
+
+    def __init__(self, latency=0.02):
+        super().__init__()
+        self.latency = latency
+
+    def get(self, container_id):
+        time.sleep(self.latency)
+        return super().get(container_id)
+
+
+@pytest.fixture
+def client():
+    return SlowClient()
+
+
+def make_hierarchy(client):
+    """A project with a subject, session and acquisition, and an analysis of the
+    session."""
+    project = client.add("project", "test")
+    project.parents["group"] = "lab"
+    subject = client.add("subject", "sub-01", parent=project)
+    session = client.add("session", "ses-01", parent=subject)
+    acquisition = client.add("acquisition", "dwi", parent=session)
+    analysis = client.add("analysis", "qsirecon", parent=session)
+    return project, subject, session, acquisition, analysis
+
+
+def test_each_container_fetched_once(client):
+    containers = make_hierarchy(client)
+    ids = [container.id for container in containers]
+    cache = ContainerCache(client)
+
+    # many threads asking for the same containers at the same time
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        fetched = list(pool.map(cache.get, ids * 4))
+    fetched += list(cache.prefetch(ids + ids).values())
+
+    assert client.calls["get"] == len(ids)
+    assert [container.id for container in fetched] == ids * 5
+
+
+def test_failed_fetch_is_not_cached(client):
+    cache = ContainerCache(client)
+
+    with pytest.raises(KeyError):
+        cache.get("later")
+
+    project = client.add("project", "test")
+    client.containers["later"] = client.containers.pop(project.id)
+    assert cache.get("later").label == "test"
+    assert client.calls["get"] == 2
+
+
+def test_parents_resolved_from_cache(client):
+    project, subject, session, acquisition, analysis = make_hierarchy(client)
+    cache = ContainerCache(client)
+
+    destination, parents = cache.hierarchy(analysis.id)
+
+    assert destination.id == analysis.id
+    assert {level: parent.id for level, parent in parents.items()} == {
+        "project": project.id,
+        "subject": subject.id,
+        "session": session.id,
+    }
+    assert client.calls["get"] == 4
+
+    # the acquisition has the same parents: only itself is fetched
+    _, parents = cache.hierarchy(acquisition.id)
+
+    assert parents["session"].id == session.id
+    assert client.calls["get"] == 5
+
+
+def test_parents_fetched_at_the_same_time():
+    client = SlowClient(latency=0.2)
+    analysis = make_hierarchy(client)[-1]
+
+    start = time.monotonic()
+    ContainerCache(client).hierarchy(analysis.id)
+
+    # the analysis, then its three parents together
+    assert time.monotonic() - start < 3 * 0.2
+
+
+def test_run_level_lookup_makes_no_extra_calls(client):
+    analysis = make_hierarchy(client)[-1]
+    cache = ContainerCache(client)
+    cache.hierarchy(analysis.id)
+    calls = dict(client.calls)
+
+    hierarchy = get_analysis_run_level_and_hierarchy(cache, analysis.id)
+
+    assert dict(client.calls) == calls
+    assert hierarchy == {
+        "run_level": "session",
+        "run_label": "ses-01",
+        "group": "lab",
+        "project_label": "test",
+        "subject_label": "sub-01",
+        "session_label": "ses-01",
+        "acquisition_label": None,
+    }
+
+
+def test_run_level_lookup_with_client(client):
+    analysis = make_hierarchy(client)[-1]
+
+    hierarchy = get_analysis_run_level_and_hierarchy(client, analysis.id)
+
+    assert hierarchy["run_label"] == "ses-01"
+    assert client.calls["get"] == 4
@@ -0,0 +1,199 @@
+"""Download the files of a BIDS export from a fake Flywheel instance that is slow
+and fails on demand."""
+
+import errno
+import os
+import time
+
+import flywheel
+import pytest
+
+from benchmarks.fake_flywheel import FakeClient
+from utils.download_cache import DownloadCache, cache_key
+from utils.flywheel_bids import export_bids
+
+
+class SlowClient(FakeClient):
+    """A fake instance that takes latency seconds per download, and raises the
+    errors in failures[name] (one per try) before downloading name."""
+
+    def __init__(self, latency=0.02, failures=None):
+        super().__init__()
+        self.latency = latency
+        self.failures = failures or {}
+        self.active = 0
+        self.max_active = 0
+
+    def _download_file_from(self, container_id, name, dest_file):
+        self.count(f"download {name}")
+        with self._lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        try:
+            time.sleep(self.latency)
+            if self.failures.get(name):
+                raise self.failures[name].pop(0)
+            super()._download_file_from(container_id, name, dest_file)
+        finally:
+            with self._lock:
+                self.active -= 1
+
+    download_file_from_project = _download_file_from
+    download_file_from_session = _download_file_from
+    download_file_from_acquisition = _download_file_from
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    """Retry at once."""
+    monkeypatch.setattr(
+        export_bids.with_retries, "__defaults__", (export_bids.DOWNLOAD_RETRIES, 0.0)
+    )
+
+
+def plan_downloads(client, tmp_path, n_files):
+    """One acquisition with n_files files, planned as download_bids_dir does.
+
+    Returns:
+        filepath_downloads (dict), files (list of FakeFile)
+    """
+    project = client.add("project", "test")
+    acquisition = client.add("acquisition", "dwi", parent=project)
+    (tmp_path / "src").mkdir()
+    (tmp_path / "bids").mkdir()
+    files = []
+    downloads = {}
+    for ii in range(n_files):
+        src = tmp_path / "src" / f"sub-01_run-{ii:02d}_dwi.nii.gz"
+        src.write_bytes(os.urandom(1024))
+        file_obj = acquisition.add_file(src)
+        dest = str(tmp_path / "bids" / file_obj.name)
+        downloads[dest] = {
+            "args": (acquisition.id, file_obj.name, dest),
+            "modified": file_obj.modified,
+        }
+        files.append(file_obj)
+    filepath_downloads = {
+        "project": {},
+        "session": {},
+        "acquisition": downloads,
+        "sidecars": {},
+    }
+    return filepath_downloads, files
+
+
+def tries(client, file_obj):
+    return client.calls[f"download {file_obj.name}"]
+
+
+def test_downloads_bounded_and_mtime_kept(tmp_path):
+    client = SlowClient()
+    filepath_downloads, files = plan_downloads(client, tmp_path, 12)
+
+    export_bids.download_bids_files(client, filepath_downloads, False, workers=3)
+
+    assert client.max_active == 3
+    for file_obj in files:
+        dest = tmp_path / "bids" / file_obj.name
+        assert dest.read_bytes() == file_obj.path.read_bytes()
+        assert int(dest.stat().st_mtime) == export_bids.timestamp_to_int(
+            file_obj.modified
+        )
+
+
+@pytest.mark.parametrize(
+    "error", [flywheel.ApiException(status=503), ConnectionError("reset by peer")]
+)
+def test_retry_when_busy_or_disconnected(tmp_path, error):
+    client = SlowClient()
+    filepath_downloads, files = plan_downloads(client, tmp_path, 4)
+    client.failures[files[0].name] = [error, error]
+
+    export_bids.download_bids_files(client, filepath_downloads, False, workers=2)
+
+    assert tries(client, files[0]) == 3
+    assert all(tries(client, file_obj) == 1 for file_obj in files[1:])
+    assert (tmp_path / "bids" / files[0].name).exists()
+
+
+@pytest.mark.parametrize(
+    "error",
+    [
+        flywheel.ApiException(status=404),
+        PermissionError(errno.EACCES, "Permission denied"),
+        OSError(errno.ENOSPC, "No space left on device"),
+    ],
+)
+def test_no_retry_when_missing_or_local_error(tmp_path, error):
+    client = SlowClient()
+    filepath_downloads, files = plan_downloads(client, tmp_path, 1)
+    client.failures[files[0].name] = [error]
+
+    with pytest.raises(type(error)):
+        export_bids.download_bids_files(client, filepath_downloads, False, workers=1)
+
+    assert tries(client, files[0]) == 1
+
+
+def test_failure_cancels_pending_downloads(tmp_path):
+    client = SlowClient()
+    filepath_downloads, files = plan_downloads(client, tmp_path, 20)
+    client.failures[files[0].name] = [flywheel.ApiException(status=404)]
+
+    with pytest.raises(flywheel.ApiException):
+        export_bids.download_bids_files(client, filepath_downloads, False, workers=2)
+
+    started = sum(tries(client, file_obj) for file_obj in files)
+    # the downloads running when the first one failed finish, the others never start
+    assert started <= 4
+
+
+def test_cached_files_are_not_written_through_links(tmp_path):
+    client = SlowClient(latency=0)
+    filepath_downloads, files = plan_downloads(client, tmp_path, 2)
+    # a json file, which the sidecar of the first image replaces
+    json_src = tmp_path / "src" / files[0].name.replace(".nii.gz", ".json")
+    json_src.write_text('{"EchoTime": 0.1}')
+    acquisition = client.containers[files[0].parent_ref["id"]]
+    json_file = acquisition.add_file(json_src)
+    json_dest = str(tmp_path / "bids" / json_file.name)
+    filepath_downloads["acquisition"][json_dest] = {
+        "args": (acquisition.id, json_file.name, json_dest),
+        "modified": json_file.modified,
+    }
+    filepath_downloads["sidecars"][json_dest] = {
+        "args": (
+            {"EchoTime": 0.2, "BIDS": {}},
+            str(tmp_path / "bids" / files[0].name),
+            "BIDS",
+        )
+    }
+    cache = DownloadCache(tmp_path / "cache")
+
+    def cached(file_obj):
+        key = cache_key(acquisition.id, file_obj.name, file_obj.modified)
+        return cache.root / "files" / key
+
+    export_bids.download_bids_files(client, filepath_downloads, False, cache=cache)
+
+    for file_obj in files:
+        dest = tmp_path / "bids" / file_obj.name
+        assert os.path.samefile(dest, cached(file_obj))
+        assert int(dest.stat().st_mtime) == export_bids.timestamp_to_int(
+            file_obj.modified
+        )
+    assert cached(json_file).read_text() == '{"EchoTime": 0.1}'
+    assert '"EchoTime": 0.2' in (tmp_path / "bids" / json_file.name).read_text()
+
+
+def test_create_json_replaces_linked_file(tmp_path):
+    shared = tmp_path / "shared.json"
+    shared.write_text("{}")
+    os.link(shared, tmp_path / "sub-01_T1w.json")
+
+    export_bids.create_json(
+        {"RepetitionTime": 2.0}, str(tmp_path / "sub-01_T1w.nii.gz"), "BIDS"
+    )
+
+    assert shared.read_text() == "{}"
+    assert "RepetitionTime" in (tmp_path / "sub-01_T1w.json").read_text()
@@ -0,0 +1,39 @@
+"""Zip html reports into archives Flywheel can show."""
+
+from zipfile import ZipFile
+
+from utils.packaging import run_archive_jobs
+from utils.zip_htmls import html_archive_jobs
+
+
+def make_reports(qsirecon_dir, names):
+    """Write an html report linking to a figure for each name."""
+    (qsirecon_dir / "figures").mkdir(parents=True)
+    for name in names:
+        figure = f"figures/{name}_{qsirecon_dir.name}.svg"
+        (qsirecon_dir / figure).write_text("<svg/>")
+        (qsirecon_dir / f"{name}.html").write_text(
+            f'<html><a href="{figure}">{qsirecon_dir.name}</a></html>'
+        )
+
+
+def test_same_report_name_in_two_dirs(tmp_path):
+    output_dir = tmp_path / "output"
+    output_dir.mkdir()
+    html_dirs = [tmp_path / f"qsirecon-{label}" for label in "abc"]
+    make_reports(html_dirs[0], ["sub-001"])
+    make_reports(html_dirs[1], ["sub-001", "sub-002"])
+    make_reports(html_dirs[2], ["sub-003"])
+
+    jobs = html_archive_jobs(str(output_dir), "dest", html_dirs)
+    run_archive_jobs(jobs, n_workers=3)
+
+    assert [job.after for job in jobs] == [[], ["html qsirecon-a"], []]
+    with ZipFile(output_dir / "sub-001_dest.html.zip") as zf:
+        assert zf.testzip() is None
+        assert zf.namelist() == ["index.html", "figures/sub-001_qsirecon-b.svg"]
+    assert sorted(path.name for path in output_dir.iterdir()) == [
+        "sub-001_dest.html.zip",
+        "sub-002_dest.html.zip",
+        "sub-003_dest.html.zip",
+    ]
@@ -0,0 +1,32 @@
+"""Zip the gear output."""
+
+import os
+from zipfile import ZipFile
+
+from utils.flywheel_bids.results.zip_output import zip_output
+
+
+def test_relative_zip_name_is_in_root_dir(tmp_path, monkeypatch):
+    output_dir = tmp_path / "output"
+    (output_dir / "analysis" / "sub-001").mkdir(parents=True)
+    (output_dir / "analysis" / "sub-001" / "dwi.txt").write_text("dwi")
+    (tmp_path / "elsewhere").mkdir()
+    monkeypatch.chdir(tmp_path / "elsewhere")
+
+    zip_output(str(output_dir), "analysis", "result.zip")
+
+    assert os.listdir(tmp_path / "elsewhere") == []
+    with ZipFile(output_dir / "result.zip") as zf:
+        assert zf.read("analysis/sub-001/dwi.txt") == b"dwi"
+
+
+def test_absolute_zip_name(tmp_path, monkeypatch):
+    output_dir = tmp_path / "output"
+    (output_dir / "analysis").mkdir(parents=True)
+    (output_dir / "analysis" / "report.html").write_text("<html/>")
+    monkeypatch.chdir(tmp_path)
+
+    zip_output(str(output_dir), "analysis", str(output_dir / "result.zip"))
+
+    with ZipFile(output_dir / "result.zip") as zf:
+        assert zf.namelist() == ["analysis/report.html"]
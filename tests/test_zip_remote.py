@@ -0,0 +1,99 @@
+"""Extract members of a zip served by a local HTTP server with range support."""
+
+import threading
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from benchmarks.synthetic import make_qsiprep_zip
+from utils.zip_remote import RangeNotSupported, fetch_zip_members, member_selector
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """Serve one file, honoring "Range: bytes=a-b" unless ranges is False."""
+
+    def __init__(self, *args, data, served, ranges=True, **kwargs):
+        self.data = data
+        self.served = served
+        self.ranges = ranges
+        super().__init__(*args, **kwargs)
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        first, last = 0, len(self.data) - 1
+        header = self.headers.get("Range")
+        if self.ranges and header:
+            start, end = header[len("bytes=") :].split("-")
+            first, last = int(start), min(int(end), last)
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {first}-{last}/{len(self.data)}")
+        else:
+            self.send_response(200)
+        body = self.data[first : last + 1]
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except ConnectionError:
+            # the client hangs up on a whole file it did not ask for
+            return
+        self.served.append(len(body))
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def serve(tmp_path):
+    """Start a server for a qsiprep zip, yield (url, bytes served, zip size)."""
+    servers = []
+
+    def start(ranges=True):
+        zip_path = tmp_path / "qsiprep.zip"
+        make_qsiprep_zip(zip_path, "analysis", n_subjects=3, total_bytes=15 * 1024**2)
+        data = zip_path.read_bytes()
+        served = []
+        handler = partial(RangeHandler, data=data, served=served, ranges=ranges)
+        server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        url = f"http://127.0.0.1:{server.server_address[1]}/qsiprep.zip"
+        return url, served, len(data)
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_fetch_zip_members_one_subject(serve, tmp_path, workers):
+    url, served, size = serve()
+    dest = tmp_path / "dest"
+
+    names = fetch_zip_members(
+        url,
+        dest,
+        member_selector(participant_label="sub-002"),
+        strip_top_dir=True,
+        workers=workers,
+    )
+
+    extracted = sorted(
+        str(path.relative_to(dest)) for path in dest.rglob("*") if path.is_file()
+    )
+    assert extracted == sorted(name.split("/", 1)[1] for name in names)
+    assert "qsiprep/dataset_description.json" in extracted
+    assert any("/anat/" in name for name in extracted)
+    assert any("/dwi/" in name for name in extracted)
+    assert all("sub-001" not in name and "sub-003" not in name for name in extracted)
+    assert not any("/figures/" in name or name.endswith(".html") for name in extracted)
+    # one subject of three: about a third of the file is downloaded
+    assert sum(served) < size / 2
+
+
+def test_fetch_zip_members_without_range_support(serve, tmp_path):
+    url, _, _ = serve(ranges=False)
+
+    with pytest.raises(RangeNotSupported):
+        fetch_zip_members(url, tmp_path / "dest", member_selector())
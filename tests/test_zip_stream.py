@@ -0,0 +1,125 @@
+"""Extract zip archives while they are being downloaded."""
+
+import os
+import stat
+from zipfile import ZIP_BZIP2, ZIP_DEFLATED, ZIP_STORED, ZipFile, ZipInfo
+
+import pytest
+
+from utils import zip_stream
+from utils.zip_stream import punch_hole, stream_download_and_extract
+
+CHUNK = 256 * 1024
+
+
+def make_zip(zip_path, unsupported=False):
+    """An archive zip with random and text members, a symbolic link and (if
+    unsupported) a member the streaming reader cannot read.
+
+    Returns:
+        members (dict): path (without the top directory) -> content
+    """
+    members = {}
+    for ii in range(8):
+        members[f"sub-01/dwi/image{ii}.nii.gz"] = os.urandom(512 * 1024)
+        members[f"sub-01/dwi/text{ii}.tsv"] = b"1\t2\t3\n" * 20000
+    with ZipFile(zip_path, "w") as zf:
+        for ii, (name, data) in enumerate(members.items()):
+            if unsupported and ii == 8:
+                zf.writestr(f"analysis/{name}", data, compress_type=ZIP_BZIP2)
+            else:
+                method = ZIP_DEFLATED if name.endswith(".tsv") else ZIP_STORED
+                zf.writestr(f"analysis/{name}", data, compress_type=method)
+        link = ZipInfo("analysis/sub-01/dwi/link.nii.gz")
+        link.external_attr = (stat.S_IFLNK | 0o777) << 16
+        zf.writestr(link, "image0.nii.gz")
+    return members
+
+
+def copy_in_chunks(src, fail_after=None):
+    """A download function writing src in chunks, failing after fail_after bytes."""
+
+    def download(dest):
+        with open(src, "rb") as fp_in, open(dest, "wb") as fp_out:
+            while True:
+                if fail_after is not None and fp_out.tell() >= fail_after:
+                    raise ConnectionError("connection reset by peer")
+                chunk = fp_in.read(CHUNK)
+                if not chunk:
+                    break
+                fp_out.write(chunk)
+                fp_out.flush()
+
+    return download
+
+
+@pytest.mark.parametrize("unsupported", [False, True])
+def test_stream_download_and_extract(tmp_path, unsupported):
+    members = make_zip(tmp_path / "source.zip", unsupported)
+    dest = tmp_path / "dest"
+
+    stream_download_and_extract(
+        copy_in_chunks(tmp_path / "source.zip"),
+        tmp_path / "download.zip",
+        dest,
+        strip_top_dir=True,
+        workers=4,
+    )
+
+    for name, data in members.items():
+        assert (dest / name).read_bytes() == data
+    link = dest / "sub-01" / "dwi" / "link.nii.gz"
+    assert os.readlink(link) == "image0.nii.gz"
+
+
+def test_disk_space_of_read_data_is_freed(tmp_path, monkeypatch):
+    with open(tmp_path / "probe", "wb") as fp:
+        fp.write(b"\0" * CHUNK)
+        fp.flush()
+        if not punch_hole(fp.fileno(), 0, CHUNK):
+            pytest.skip("cannot punch holes in files here")
+    monkeypatch.setattr(zip_stream, "RELEASE_SIZE", CHUNK)
+    make_zip(tmp_path / "source.zip")
+
+    stream_download_and_extract(
+        copy_in_chunks(tmp_path / "source.zip"),
+        tmp_path / "download.zip",
+        tmp_path / "dest",
+        strip_top_dir=True,
+    )
+
+    downloaded = os.stat(tmp_path / "download.zip")
+    assert downloaded.st_size == os.path.getsize(tmp_path / "source.zip")
+    assert downloaded.st_blocks * 512 < downloaded.st_size / 4
+
+
+def test_download_error_is_raised(tmp_path):
+    make_zip(tmp_path / "source.zip")
+
+    with pytest.raises(ConnectionError):
+        stream_download_and_extract(
+            copy_in_chunks(tmp_path / "source.zip", fail_after=3 * CHUNK),
+            tmp_path / "download.zip",
+            tmp_path / "dest",
+            strip_top_dir=True,
+        )
+
+
+def test_linked_archive_is_left_alone(tmp_path, monkeypatch):
+    monkeypatch.setattr(zip_stream, "RELEASE_SIZE", CHUNK)
+    members = make_zip(tmp_path / "source.zip")
+    size = os.path.getsize(tmp_path / "source.zip")
+
+    # as a DownloadCache does: the archive is a link to the cached file
+    stream_download_and_extract(
+        lambda dest: os.link(tmp_path / "source.zip", dest),
+        tmp_path / "download.zip",
+        tmp_path / "dest",
+        strip_top_dir=True,
+    )
+
+    assert os.stat(tmp_path / "source.zip").st_blocks * 512 >= size
+    with ZipFile(tmp_path / "source.zip") as zf:
+        assert zf.testzip() is None
+    for name, data in members.items():
+        assert (tmp_path / "dest" / name).read_bytes() == data
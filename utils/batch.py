@@ -0,0 +1,150 @@
+"""Run several sessions in one container, sharing its CPUs and memory.
+
+Setting up the gear (starting the container, staging TemplateFlow, installing the
+FreeSurfer license) is done once for the whole batch.  The CPUs and memory are then
+divided into slots, and each session runs in a free slot with that slot's share of
+the resources, so several qsirecon processes run at the same time.  A session's
+output is packaged on its own (as if it had been run by its own job) and moved to the
+gear output directory.
+
+Example:
+    .. code-block:: python
+
+        slots = plan_slots(n_cpus=32, mem_mb=128000, n_sessions=len(sessions))
+        results = run_batch(sessions, slots, run_session)
+"""
+
+import json
+import logging
+import queue
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+# Below this, qsirecon spends more time waiting than it gains from running sessions
+# at the same time
+MIN_CPUS_PER_SESSION = 4
+MIN_MEM_MB_PER_SESSION = 8192
+
+
+@dataclass
+class Slot:
+    """Share of the resources one session runs with.
+
+    Attributes:
+        index: number of the slot
+        n_cpus: CPUs for the session
+        mem_mb: memory (MiB) for the session
+    """
+
+    index: int
+    n_cpus: int
+    mem_mb: int
+
+
+def plan_slots(n_cpus, mem_mb, n_sessions, max_parallel=0):
+    """Divide the CPUs and memory between the sessions that run at the same time.
+
+    Args:
+        n_cpus (int): CPUs available to the whole batch
+        mem_mb (int): memory (MiB) available to the whole batch
+        n_sessions (int): number of sessions in the batch
+        max_parallel (int): maximum number of sessions run at the same time.  If 0,
+            as many as fit with MIN_CPUS_PER_SESSION and MIN_MEM_MB_PER_SESSION.
+
+    Returns:
+        slots (list of Slot)
+    """
+    if not max_parallel:
+        max_parallel = min(
+            n_cpus // MIN_CPUS_PER_SESSION, mem_mb // MIN_MEM_MB_PER_SESSION
+        )
+    n_parallel = max(1, min(n_sessions, max_parallel, n_cpus))
+
+    slots = []
+    for ii in range(n_parallel):
+        # spread the remainder, so no CPU is left unused
+        cpus = n_cpus // n_parallel + (1 if ii < n_cpus % n_parallel else 0)
+        slots.append(Slot(index=ii, n_cpus=cpus, mem_mb=mem_mb // n_parallel))
+
+    log.info(
+        "Running %d sessions, %d at a time: %s",
+        n_sessions,
+        n_parallel,
+        ", ".join(f"{ss.n_cpus} CPUs/{ss.mem_mb} MiB" for ss in slots),
+    )
+    return slots
+
+
+def run_batch(items, slots, run_one):
+    """Call run_one(item, slot) for every item, one item per slot at a time.
+
+    Items are started in order, each as soon as a slot is free.  An exception raised
+    by run_one is logged and returned as that item's result, so one failed session
+    does not stop the others.
+
+    Args:
+        items (list): the sessions to run (hashable)
+        slots (list of Slot): see plan_slots
+        run_one (callable): function running one item in a slot
+
+    Returns:
+        results (dict): what run_one returned (or raised), by item
+    """
+    free_slots = queue.Queue()
+    for slot in slots:
+        free_slots.put(slot)
+
+    def run_in_slot(item):
+        slot = free_slots.get()
+        try:
+            log.info("Starting %s in slot %d", item, slot.index)
+            return run_one(item, slot)
+        finally:
+            free_slots.put(slot)
+
+    with ThreadPoolExecutor(max_workers=len(slots)) as pool:
+        futures = {item: pool.submit(run_in_slot, item) for item in items}
+
+    results = {}
+    for item, future in futures.items():
+        try:
+            results[item] = future.result()
+        except Exception as exc:  # pylint: disable=broad-except
+            log.exception("Running %s failed", item)
+            results[item] = exc
+    return results
+
+
+def collect_session_output(session_output_dir, output_dir, run_label):
+    """Move a session's archives to the gear output directory.
+
+    The session's analysis metadata is returned instead of moved, so that all
+    sessions can be merged into one .metadata.json.  A file whose name is already
+    taken by another session is prefixed with run_label.
+
+    Args:
+        session_output_dir (Path): output directory the session was packaged in
+        output_dir (Path): gear output directory
+        run_label (str): label of the session, unique in the batch
+
+    Returns:
+        info (dict): the session's "analysis.info" metadata
+    """
+    info = {}
+    for path in sorted(Path(session_output_dir).iterdir()):
+        if not path.is_file():
+            continue
+        if path.name == ".metadata.json":
+            with open(path) as fff:
+                info = json.load(fff).get("analysis", {}).get("info", {})
+            continue
+        dest = Path(output_dir) / path.name
+        if dest.exists():
+            dest = Path(output_dir) / f"{run_label}_{path.name}"
+        shutil.move(str(path), dest)
+        log.debug("Moved %s to %s", path.name, dest)
+    return info
@@ -0,0 +1,246 @@
+"""Keep qsirecon's work directory between attempts of the same job.
+
+When a job dies late (spot preemption, a transient failure), the retry normally
+starts from zero because work/ is deleted with the gear's scratch space.  With a
+checkpoint directory on node-local or shared storage, the unzipped inputs and the
+nipype work directory are kept in a directory named after the destination, the
+input file (id and version) and a hash of the app options.  A retry of the same job
+finds them there, skips the download and lets nipype skip the nodes that already
+finished.
+
+The inputs have to be kept as well as the nipype work directory: nipype hashes the
+path and time stamp of input files, so re-downloading them would invalidate the
+cache.
+
+Checkpoints are deleted (in the background, see utils.deletion) when the run
+succeeds.  Old checkpoints are evicted by age, then oldest first until the total size
+is under the limit, using the sizes recorded when their jobs ended.  A checkpoint
+that is in use is locked, so it is never evicted from under a running job.
+
+Example:
+    .. code-block:: python
+
+        key = checkpoint_key(destination_id, file_id, file_version, app_options)
+        checkpoint = Checkpoint.open(cache_root, key)
+        ...
+        checkpoint.close(success=e_code == 0)
+"""
+
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import time
+from pathlib import Path
+
+from utils.deletion import TOMBSTONE_DIR_NAME, delete_in_background
+
+log = logging.getLogger(__name__)
+
+INFO_NAME = ".fw_checkpoint.json"
+LOCK_NAME = ".fw_checkpoint.lock"
+INPUTS_DONE_NAME = ".fw_inputs_complete"
+
+# These change how fast qsirecon runs, not what it computes
+IGNORED_APP_OPTIONS = ("n_cpus", "mem_mb", "verbose", "work-dir", "resource-monitor")
+
+
+def _hash_value(value):
+    """Hash files by content, everything else by value."""
+    if isinstance(value, (str, Path)) and os.path.isfile(value):
+        sha = hashlib.sha256()
+        with open(value, "rb") as fp:
+            for block in iter(lambda: fp.read(1024 * 1024), b""):
+                sha.update(block)
+        return sha.hexdigest()
+    return str(value)
+
+
+def checkpoint_key(destination_id, file_id, file_version, app_options):
+    """Name of the checkpoint for a job.
+
+    Args:
+        destination_id (str): id of the analysis container
+        file_id (str): id of the preprocessing-pipeline-zip input file
+        file_version (int): version of that file
+        app_options (dict): options for the BIDS-App
+
+    Returns:
+        key (str)
+    """
+    options = {
+        key: _hash_value(val)
+        for key, val in sorted(app_options.items())
+        if key not in IGNORED_APP_OPTIONS
+    }
+    options_hash = hashlib.sha256(
+        json.dumps(options, sort_keys=True).encode("utf8")
+    ).hexdigest()
+    return f"{destination_id}_{file_id}_v{file_version}_{options_hash[:12]}"
+
+
+def _dir_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def _read_info(path):
+    try:
+        with open(Path(path) / INFO_NAME) as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_info(path, info):
+    """Write a checkpoint's info, which also marks it as recently used."""
+    tmp = Path(path) / f"{INFO_NAME}.tmp"
+    with open(tmp, "w") as fp:
+        json.dump(info, fp)
+    os.replace(tmp, Path(path) / INFO_NAME)
+
+
+def _recorded_size(path):
+    """Size of a checkpoint, as recorded when its last job ended.
+
+    The size of a checkpoint whose job was killed first is measured, and recorded
+    (without marking it as used) unless a job is using it.
+    """
+    info = _read_info(path)
+    if info is not None and "size" in info:
+        return info["size"]
+    size = _dir_size(path)
+    lock = _try_lock(path) if info is not None else None
+    if lock is not None:
+        last_used = (path / INFO_NAME).stat().st_mtime
+        _write_info(path, {**info, "size": size})
+        os.utime(path / INFO_NAME, (last_used, last_used))
+        lock.close()
+    return size
+
+
+def _try_lock(path):
+    """Lock the checkpoint at path, return the open lock file or None if in use."""
+    lock = open(Path(path) / LOCK_NAME, "a")
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock.close()
+        return None
+    return lock
+
+
+def evict_checkpoints(cache_root, max_age_days, max_gb, keep=None):
+    """Delete checkpoints that are too old, then the oldest ones while too big.
+
+    Args:
+        cache_root (Path): directory holding the checkpoints
+        max_age_days (float): delete checkpoints not used for longer than this
+        max_gb (float): total size (GiB) to keep the checkpoints under
+        keep (str): name of a checkpoint never to delete
+    """
+    cache_root = Path(cache_root)
+    if not cache_root.exists():
+        return
+
+    checkpoints = []
+    for path in cache_root.iterdir():
+        if not (path / INFO_NAME).exists() or path.name == keep:
+            continue
+        checkpoints.append(((path / INFO_NAME).stat().st_mtime, path))
+    checkpoints.sort()
+
+    now = time.time()
+    sizes = {path: _recorded_size(path) for _, path in checkpoints}
+    total = sum(sizes.values())
+    if keep and (cache_root / keep / INFO_NAME).exists():
+        total += _recorded_size(cache_root / keep)
+
+    for last_used, path in checkpoints:
+        too_old = now - last_used > max_age_days * 24 * 3600
+        too_big = total > max_gb * 1024**3
+        if not (too_old or too_big):
+            continue
+        lock = _try_lock(path)
+        if lock is None:
+            log.debug("Checkpoint %s is in use, not evicting it", path.name)
+            continue
+        log.info(
+            "Evicting checkpoint %s (%s)", path.name, "too old" if too_old else "size"
+        )
+        delete_in_background(path, cache_root / TOMBSTONE_DIR_NAME)
+        lock.close()
+        total -= sizes[path]
+
+
+class Checkpoint:
+    """A locked checkpoint directory for the running job.
+
+    Attributes:
+        path (Path): the checkpoint directory
+        inputs_dir (Path): where the unzipped inputs are kept
+        work_dir (Path): the app's (nipype) work directory
+    """
+
+    def __init__(self, path, lock):
+        self.path = Path(path)
+        self.inputs_dir = self.path / "inputs"
+        self.work_dir = self.path / "work"
+        self._lock = lock
+
+    @classmethod
+    def open(cls, cache_root, key, max_age_days=7, max_gb=500):
+        """Create or reuse the checkpoint named key, evicting old ones first.
+
+        Returns:
+            checkpoint (Checkpoint), or None if another job is using it
+        """
+        cache_root = Path(cache_root)
+        evict_checkpoints(cache_root, max_age_days, max_gb, keep=key)
+
+        path = cache_root / key
+        path.mkdir(parents=True, exist_ok=True)
+        lock = _try_lock(path)
+        if lock is None:
+            log.warning("Checkpoint %s is used by another job, not using it", key)
+            return None
+
+        info = _read_info(path)
+        if info is not None:
+            info["attempts"] += 1
+            log.info("Resuming from checkpoint %s (attempt %d)", key, info["attempts"])
+        else:
+            info = {"key": key, "created": time.time(), "attempts": 1}
+            log.info("Creating checkpoint %s", key)
+        _write_info(path, info)
+
+        checkpoint = cls(path, lock)
+        checkpoint.inputs_dir.mkdir(exist_ok=True)
+        checkpoint.work_dir.mkdir(exist_ok=True)
+        return checkpoint
+
+    @property
+    def inputs_complete(self):
+        """True if the inputs were completely unzipped by an earlier attempt."""
+        return (self.path / INPUTS_DONE_NAME).exists()
+
+    def mark_inputs_complete(self):
+        (self.path / INPUTS_DONE_NAME).touch()
+
+    def close(self, success):
+        """Release the checkpoint, deleting it if the run succeeded."""
+        if success:
+            log.info("Run succeeded, removing checkpoint %s", self.path.name)
+            delete_in_background(self.path, self.path.parent / TOMBSTONE_DIR_NAME)
+        else:
+            log.info("Keeping checkpoint %s for a retry", self.path.name)
+            info = _read_info(self.path) or {"key": self.path.name, "attempts": 1}
+            _write_info(self.path, {**info, "size": _dir_size(self.path)})
+        self._lock.close()
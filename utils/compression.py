@@ -0,0 +1,136 @@
+"""Decide how each file is compressed in the output archives.
+
+Most of the bytes qsirecon writes are already compressed (.nii.gz, .mif.gz,
+.trk.gz, images), so DEFLATE only burns CPU on them.  A CompressionPolicy stores
+those as they are, compresses text and HTML at a configurable level, and, for
+anything else, compresses a sample of the file to see if it is worth it.  It keeps
+count of its decisions and how many bytes they saved.
+
+Example:
+    .. code-block:: python
+
+        policy = CompressionPolicy(text_level=9)
+        with ZipFile(dest_zip, "w", ZIP_DEFLATED) as outzip:
+            policy.write(outzip, "sub-01/dwi/sub-01_dwi.nii.gz")
+        info = policy.summary()
+"""
+
+import logging
+import os
+import zlib
+from zipfile import ZIP_DEFLATED, ZIP_STORED
+
+log = logging.getLogger(__name__)
+
+# Files that are already compressed
+COMPRESSED_SUFFIXES = (
+    ".gz",
+    ".bz2",
+    ".xz",
+    ".zst",
+    ".zip",
+    ".mgz",
+    ".npz",
+    ".pklz",
+    ".png",
+    ".jpg",
+    ".jpeg",
+    ".gif",
+    ".svgz",
+    ".mp4",
+    ".webm",
+)
+
+# Text and HTML files, which compress well
+TEXT_SUFFIXES = (
+    ".html",
+    ".htm",
+    ".svg",
+    ".js",
+    ".css",
+    ".json",
+    ".tsv",
+    ".csv",
+    ".txt",
+    ".log",
+    ".md",
+    ".rst",
+    ".toml",
+    ".yml",
+    ".yaml",
+    ".py",
+    ".bval",
+    ".bvec",
+    ".b",
+)
+
+
+class CompressionPolicy:
+    """Pick stored or deflated (and the level) for each file written to a zip.
+
+    Args:
+        text_level (int): DEFLATE level for text and HTML files
+        default_level (int): DEFLATE level for other files that are worth compressing
+        sample_size (int): bytes of unknown files to test-compress
+        min_saving (float): fraction of the sample that compression must save
+    """
+
+    def __init__(
+        self, text_level=6, default_level=6, sample_size=64 * 1024, min_saving=0.1
+    ):
+        self.text_level = text_level
+        self.default_level = default_level
+        self.sample_size = sample_size
+        self.min_saving = min_saving
+        self.stats = {}
+
+    def choose(self, path):
+        """Return (decision, compress_type, compresslevel) for the file at path."""
+        name = os.path.basename(path).lower()
+        if name.endswith(COMPRESSED_SUFFIXES):
+            return "stored (compressed type)", ZIP_STORED, None
+        if name.endswith(TEXT_SUFFIXES):
+            return "deflated (text)", ZIP_DEFLATED, self.text_level
+
+        try:
+            with open(path, "rb") as fp:
+                sample = fp.read(self.sample_size)
+        except OSError:
+            sample = b""
+        if len(sample) < 512:
+            # too small to bother with
+            return "stored (small)", ZIP_STORED, None
+        compressed = zlib.compress(sample, 1)
+        if len(compressed) > (1 - self.min_saving) * len(sample):
+            return "stored (sampled)", ZIP_STORED, None
+        return "deflated (sampled)", ZIP_DEFLATED, self.default_level
+
+    def write(self, zip_file, filename, arcname=None):
+        """Write filename to the open ZipFile zip_file, as the policy says."""
+        if os.path.isdir(filename):
+            zip_file.write(filename, arcname)
+            return
+        decision, compress_type, level = self.choose(filename)
+        zip_file.write(
+            filename, arcname, compress_type=compress_type, compresslevel=level
+        )
+        self.record(decision, zip_file.filelist[-1])
+
+    def record(self, decision, zip_info):
+        """Count a file that was written to a zip."""
+        stats = self.stats.setdefault(decision, {"files": 0, "bytes": 0, "saved": 0})
+        stats["files"] += 1
+        stats["bytes"] += zip_info.file_size
+        stats["saved"] += zip_info.file_size - zip_info.compress_size
+
+    def summary(self):
+        """Decisions made so far: number of files, bytes and bytes saved for each."""
+        for decision, stats in self.stats.items():
+            log.info(
+                "%s: %d files, %.1f MiB, saved %.1f MiB",
+                decision,
+                stats["files"],
+                stats["bytes"] / 1024**2,
+                stats["saved"] / 1024**2,
+            )
+        return {decision: dict(stats) for decision, stats in self.stats.items()}
@@ -0,0 +1,101 @@
+"""Fetch Flywheel containers once per run, the ancestors of a container at once.
+
+Every ``client.get`` is a round trip to the Flywheel API, and on a busy instance each
+takes hundreds of ms.  A ContainerCache remembers every container it fetched for the
+life of the run, and fetches all the ancestors of a container (project, subject,
+session...) at the same time instead of one after the other.
+
+Anything with a ``get(container_id)`` method can back the cache, e.g. a dict-based
+fake client when running without a Flywheel instance.
+
+Example:
+    .. code-block:: python
+
+        containers = ContainerCache(context.client)
+        destination, parents = containers.hierarchy(context.destination["id"])
+        subject_label = parents["subject"].label
+"""
+
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+# the group is only an id in the parents, it is not fetched
+HIERARCHY_LEVELS = ["project", "subject", "session", "acquisition"]
+
+
+class ContainerCache:
+    """Memoizing, thread-safe wrapper around a client's ``get``.
+
+    Args:
+        client: flywheel client (or anything with a get(container_id) method)
+        max_workers (int): maximum number of containers fetched at the same time
+    """
+
+    def __init__(self, client, max_workers=8):
+        self.client = client
+        self.max_workers = max_workers
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    def _future(self, container_id):
+        """The future holding container_id, and True if the caller must fetch it."""
+        with self._lock:
+            future = self._futures.get(container_id)
+            if future is not None:
+                return future, False
+            future = Future()
+            self._futures[container_id] = future
+            return future, True
+
+    def get(self, container_id):
+        """Return the container, fetching it only the first time it is asked for.
+
+        If the fetch fails, the error is raised and the container is not cached, so
+        a later call tries again.
+        """
+        future, owner = self._future(container_id)
+        if owner:
+            try:
+                future.set_result(self.client.get(container_id))
+            except BaseException as exc:
+                with self._lock:
+                    del self._futures[container_id]
+                future.set_exception(exc)
+        return future.result()
+
+    def prefetch(self, container_ids):
+        """Fetch the containers at the same time.
+
+        Returns:
+            containers (dict): the containers by id
+        """
+        container_ids = [cid for cid in dict.fromkeys(container_ids) if cid]
+        if len(container_ids) <= 1:
+            return {cid: self.get(cid) for cid in container_ids}
+        workers = min(self.max_workers, len(container_ids))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            containers = list(pool.map(self.get, container_ids))
+        return dict(zip(container_ids, containers))
+
+    def hierarchy(self, container_id):
+        """Return a container and all its ancestors.
+
+        The container is fetched first (it says who its parents are), then all the
+        parents at the same time.
+
+        Returns:
+            container, parents (dict: level -> container, for the levels it has)
+        """
+        container = self.get(container_id)
+        parent_ids = {
+            level: container.parents[level]
+            for level in HIERARCHY_LEVELS
+            if container.parents[level]
+        }
+        fetched = self.prefetch(parent_ids.values())
+        return container, {
+            level: fetched[parent_id] for level, parent_id in parent_ids.items()
+        }
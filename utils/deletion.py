@@ -0,0 +1,220 @@
+"""Delete big directory trees without making the gear wait.
+
+Deleting the output and scratch trees (nipype work directories, derivatives) can
+take minutes, during which the job holds its node.  Instead, a tree is first renamed
+to a "tombstone" in a directory set aside for them (outside the gear's output, so a
+tree that is half deleted when the job is torn down is never uploaded), which is
+instant and frees its name, and a detached process deletes the tombstone, unlinking
+the files of many directories at the same time.  A tree that cannot be renamed there
+(e.g. it is on another filesystem) is deleted right away instead.
+
+The gear does not wait for the deletions, unless it is asked to wait a while before
+it exits.  Where the deleting processes cannot outlive the job (a Slurm job's
+processes are all killed when it ends), what is left is then deleted before exiting
+(see wait_for_deletions).
+
+Example:
+    .. code-block:: python
+
+        tomb_dir = tombstone_dir(work_dir)
+        delete_in_background(output_dir, tomb_dir)
+        ...
+        wait_for_deletions(timeout=300)
+"""
+
+import logging
+import os
+import shutil
+import subprocess as sp
+import sys
+import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+TOMBSTONE_PREFIX = ".fw_deleting-"
+TOMBSTONE_DIR_NAME = ".fw_deleting"
+DELETE_WORKERS = 8
+
+# deletions started by this process, that may still be running
+_PENDING = []
+
+
+def tombstone_dir(work_dir):
+    """Where the gear's trees are moved to be deleted: next to its work dir (and so
+    outside its output dir)."""
+    return Path(work_dir).resolve().parent / TOMBSTONE_DIR_NAME
+
+
+def tombstone(path, tomb_dir):
+    """Move path into tomb_dir, under a hidden name, so it can be deleted later.
+
+    Returns:
+        tombstone (Path): the new name, or None if it cannot be moved there
+    """
+    path = Path(path)
+    dead = Path(tomb_dir) / f"{TOMBSTONE_PREFIX}{path.name}-{uuid.uuid4().hex[:8]}"
+    try:
+        Path(tomb_dir).mkdir(parents=True, exist_ok=True)
+        os.rename(path, dead)
+    except OSError as exc:
+        log.debug("Cannot move %s to %s: %s", path, tomb_dir, exc)
+        return None
+    return dead
+
+
+def _clear_dir(dir_path):
+    """Unlink everything in a directory but its subdirectories, and return those."""
+    subdirs = []
+    with os.scandir(dir_path) as entries:
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                else:
+                    os.unlink(entry.path)
+            except FileNotFoundError:
+                pass
+    return subdirs
+
+
+def delete_tree(path, workers=DELETE_WORKERS):
+    """Delete a directory tree, clearing many of its directories at the same time.
+
+    Symbolic links are removed, not followed.
+    """
+    path = str(path)
+    cleared = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = {pool.submit(_clear_dir, path): path}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                dir_path = pending.pop(future)
+                cleared.append(dir_path)
+                try:
+                    subdirs = future.result()
+                except OSError as exc:
+                    log.warning("Cannot clear %s: %s", dir_path, exc)
+                    continue
+                for subdir in subdirs:
+                    pending[pool.submit(_clear_dir, subdir)] = subdir
+
+    # a directory is cleared after its parent, so this removes children first
+    for dir_path in reversed(cleared):
+        try:
+            os.rmdir(dir_path)
+        except OSError:
+            pass
+
+    if os.path.lexists(path):
+        # whatever could not be removed above (e.g. permissions), try once more
+        shutil.rmtree(path, ignore_errors=True)
+
+
+class Deletion:
+    """A tree being deleted by a detached process.
+
+    Attributes:
+        path (Path): the tree's tombstone
+    """
+
+    def __init__(self, path, process):
+        self.path = Path(path)
+        self._process = process
+
+    def done(self):
+        return self._process.poll() is not None
+
+    def wait(self, timeout=None):
+        """Wait at most timeout seconds for the deletion, return True if it is done."""
+        try:
+            self._process.wait(timeout=timeout)
+        except sp.TimeoutExpired:
+            return False
+        return True
+
+    def finish(self):
+        """Stop the deleting process and delete what is left of the tree here."""
+        if not self.done():
+            self._process.kill()
+            self._process.wait()
+        delete_tree(self.path)
+
+
+def delete_in_background(path, tomb_dir):
+    """Tombstone a tree and delete it in a process that outlives the gear.
+
+    If the tree cannot be moved to tomb_dir, it is deleted before returning.
+
+    Args:
+        path (str or Path): the tree to delete
+        tomb_dir (str or Path): where to move it (see tombstone_dir), on the same
+            filesystem and outside the gear's output
+
+    Returns:
+        deletion (Deletion), or None if there is nothing left to delete
+    """
+    if not os.path.lexists(path):
+        return None
+    if os.path.islink(path) or not os.path.isdir(path):
+        os.unlink(path)
+        return None
+
+    dead = tombstone(path, tomb_dir)
+    if dead is None:
+        log.info("Deleting %s", path)
+        delete_tree(path)
+        return None
+    # run from the gear's directory, so "utils" can be imported
+    process = sp.Popen(
+        [sys.executable, "-m", "utils.deletion", str(dead)],
+        cwd=Path(__file__).resolve().parents[1],
+        stdin=sp.DEVNULL,
+        stdout=sp.DEVNULL,
+        stderr=sp.DEVNULL,
+        start_new_session=True,
+    )
+    log.info("Deleting %s in the background (pid %d)", path, process.pid)
+    deletion = Deletion(dead, process)
+    _PENDING.append(deletion)
+    return deletion
+
+
+def wait_for_deletions(timeout, finish=False):
+    """Wait at most timeout seconds (in total) for the background deletions.
+
+    Args:
+        timeout (float): seconds to wait
+        finish (bool): delete what is left after timeout here, for when the deleting
+            processes will not outlive the job
+
+    Returns:
+        done (bool): True if all deletions finished
+    """
+    deadline = time.time() + timeout
+    for deletion in list(_PENDING):
+        # (a deleting process that was killed leaves the rest of its tree)
+        if deletion.wait(timeout=max(0, deadline - time.time())) and not (
+            os.path.lexists(deletion.path)
+        ):
+            _PENDING.remove(deletion)
+    if not _PENDING:
+        return True
+
+    paths = ", ".join(str(deletion.path) for deletion in _PENDING)
+    if not finish:
+        log.warning("Still deleting after %s s: %s", timeout, paths)
+        return False
+    log.info("Still deleting after %s s, finishing before exiting: %s", timeout, paths)
+    for deletion in list(_PENDING):
+        deletion.finish()
+        _PENDING.remove(deletion)
+    return True
+
+
+if __name__ == "__main__":
+    for tree in sys.argv[1:]:
+        delete_tree(tree)
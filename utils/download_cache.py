@@ -0,0 +1,212 @@
+"""Node-local cache of downloaded Flywheel files, shared between jobs.
+
+Jobs that run on the same node against the same project download the same files
+(project-level BIDS files, the same preprocessing zip) again and again.  With a
+DownloadCache, a file is downloaded once into a shared directory, named after the
+file's id and version (which change whenever its content does), and every job gets
+a hard link to it (or a copy, if the cache is on another filesystem).
+
+Cached files are made read-only, since all the links share them, and get their
+modification time when they are cached: it is never changed through a link (the
+cache may belong to another user).  A file that the job will write to is copied
+instead of linked, so writing to it cannot change the cached file.  Each entry is
+locked while it is downloaded or linked, so two jobs never download the same file at
+the same time and an entry is never evicted while it is being used.  When the cache
+grows over its size limit, the least recently used entries are evicted.
+
+Example:
+    .. code-block:: python
+
+        cache = DownloadCache("/scratch/fw_download_cache", max_gb=200)
+        key = cache_key(file_obj.id, file_obj.version)
+        cache.fetch(key, dest_path, file_obj.download)
+"""
+
+import fcntl
+import hashlib
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+EVICT_LOCK_NAME = ".evict.lock"
+
+
+def cache_key(*parts):
+    """Name of a cache entry: the file id and version (or anything naming its content).
+
+    Returns:
+        key (str)
+    """
+    return hashlib.sha256("\0".join(str(part) for part in parts).encode()).hexdigest()
+
+
+def _lock(path, blocking=True):
+    """Lock the file at path, return it open (or None if it is locked and not blocking)."""
+    lock = open(path, "a")
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+    except OSError:
+        lock.close()
+        return None
+    return lock
+
+
+def link_or_copy(src, dest, copy=False):
+    """Hard link src to dest, or copy it (keeping its modification time) if asked to
+    or if they are not on the same filesystem."""
+    dest = Path(dest)
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    if dest.exists() or dest.is_symlink():
+        dest.unlink()
+    if not copy:
+        try:
+            os.link(src, dest)
+            return
+        except OSError:
+            pass
+    shutil.copyfile(src, dest)
+    mtime = os.stat(src).st_mtime
+    os.utime(dest, (mtime, mtime))
+
+
+class DownloadCache:
+    """Directory of downloaded files, shared by the jobs on a node.
+
+    Args:
+        root (str or Path): the cache directory
+        max_gb (float): total size (GiB) to keep the cache under
+    """
+
+    def __init__(self, root, max_gb=200):
+        self.root = Path(root)
+        self.max_gb = max_gb
+        for sub_dir in ("files", "used", "locks", "tmp"):
+            (self.root / sub_dir).mkdir(parents=True, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+        self._count_lock = threading.Lock()
+        self._remove_stale_tmp()
+
+    def _remove_stale_tmp(self, max_age_hours=24):
+        """Delete partial downloads left by jobs that were killed."""
+        now = time.time()
+        for path in (self.root / "tmp").iterdir():
+            try:
+                if now - path.stat().st_mtime > max_age_hours * 3600:
+                    path.unlink()
+            except OSError:
+                pass
+
+    def _paths(self, key):
+        return (
+            self.root / "files" / key,
+            self.root / "used" / key,
+            self.root / "locks" / key,
+        )
+
+    def fetch(self, key, dest, download, mtime=None, copy=False):
+        """Put the file named key at dest, downloading it only if it is not cached.
+
+        Args:
+            key (str): name of the entry (see cache_key)
+            dest (str or Path): where the file is wanted
+            download (callable): called with a path, writes the file there
+            mtime (float): modification time given to the file when it is cached
+                (the key must change with it)
+            copy (bool): copy the file to dest instead of linking it, for a file
+                that will be written to
+
+        Returns:
+            hit (bool): True if the file was already cached
+        """
+        data, used, lock_path = self._paths(key)
+        lock = _lock(lock_path)
+        try:
+            hit = data.exists()
+            with self._count_lock:
+                if hit:
+                    self.hits += 1
+                else:
+                    self.misses += 1
+            if not hit:
+                tmp = self.root / "tmp" / f"{key}-{uuid.uuid4().hex[:8]}"
+                try:
+                    download(str(tmp))
+                    if mtime is not None:
+                        os.utime(tmp, (mtime, mtime))
+                    os.chmod(tmp, 0o444)
+                    os.replace(tmp, data)
+                finally:
+                    if tmp.exists():
+                        tmp.unlink()
+            # the time of last use, for eviction (the data's mtime is the file's)
+            used.touch()
+            link_or_copy(data, dest, copy=copy)
+        finally:
+            lock.close()
+
+        if not hit:
+            self.evict()
+        return hit
+
+    def evict(self):
+        """Delete least recently used entries while the cache is too big."""
+        evict_lock = _lock(self.root / EVICT_LOCK_NAME, blocking=False)
+        if evict_lock is None:
+            return  # another job is evicting
+        try:
+            entries = []
+            total = 0
+            for data in (self.root / "files").iterdir():
+                try:
+                    size = data.stat().st_size
+                except OSError:
+                    continue  # just evicted
+                try:
+                    last_used = (self.root / "used" / data.name).stat().st_mtime
+                except OSError:
+                    last_used = 0
+                entries.append((last_used, data.name, size))
+                total += size
+
+            max_bytes = self.max_gb * 1024**3
+            for _, key, size in sorted(entries):
+                if total <= max_bytes:
+                    break
+                data, used, lock_path = self._paths(key)
+                lock = _lock(lock_path, blocking=False)
+                if lock is None:
+                    continue  # in use
+                try:
+                    log.debug("Evicting %s from the download cache", key)
+                    for path in (data, used):
+                        if path.exists():
+                            path.unlink()
+                    total -= size
+                finally:
+                    lock.close()
+        finally:
+            evict_lock.close()
+
+    def summary(self):
+        """Hits and misses so far."""
+        log.info("Download cache: %d hits, %d misses", self.hits, self.misses)
+        return {"hits": self.hits, "misses": self.misses}
+
+
+def cached_download(cache, key, download):
+    """A download callable that goes through the cache (or download itself, if None).
+
+    Returns:
+        download (callable): called with a path, puts the file there
+    """
+    if cache is None:
+        return download
+    return lambda dest: cache.fetch(key, dest, download)
+
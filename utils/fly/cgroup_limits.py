@@ -0,0 +1,181 @@
+"""Find the CPUs and memory actually available to the gear.
+
+Inside Kubernetes or Slurm containers, os.cpu_count() and psutil report the whole
+host, not what the job was given.  The effective limits are the smallest of:
+
+    - the host (os.cpu_count() and psutil.virtual_memory().available)
+    - the cpuset the process may run on (sched_getaffinity)
+    - the cgroup v2 cpu.max / memory.max, or the cgroup v1 cpu.cfs_quota_us /
+      memory.limit_in_bytes (minus the memory the cgroup already uses, but for the
+      page cache that can be reclaimed), of the process' cgroup and all its
+      ancestors
+
+Each function returns the limit and a short description of where it came from.
+"""
+
+import logging
+import math
+import os
+from pathlib import Path
+
+import psutil
+
+log = logging.getLogger(__name__)
+
+CGROUP_ROOT = Path("/sys/fs/cgroup")
+
+# cgroup v1 reports "no limit" as a huge number
+V1_UNLIMITED = 2**60
+
+
+def _read(path):
+    try:
+        return Path(path).read_text().strip()
+    except (OSError, ValueError):
+        return None
+
+
+def _memory_stat(cgroup_dir, key):
+    """A value of a cgroup's memory.stat, or 0 if it is not there."""
+    for line in (_read(cgroup_dir / "memory.stat") or "").splitlines():
+        name, _, value = line.partition(" ")
+        if name == key:
+            try:
+                return int(value)
+            except ValueError:
+                return 0
+    return 0
+
+
+def _cgroup_dirs(controller):
+    """Directories that may hold the files of a cgroup controller for this process.
+
+    For every hierarchy the controller is in (the cgroup v2 one, or its v1 one), the
+    process' own cgroup (from /proc/self/cgroup) and all its ancestors up to the
+    root of the hierarchy: a limit may be set at any level (e.g. Slurm sets the job's
+    limits on job_<id>, above the step and task cgroups the process is in).  Only the
+    root is found in a container with a cgroup namespace, which sees its own cgroup
+    as the root.
+    """
+    mounts = {}
+    proc_cgroup = _read("/proc/self/cgroup") or ""
+    for line in proc_cgroup.splitlines():
+        parts = line.split(":", 2)
+        if len(parts) != 3:
+            continue
+        _, controllers, path = parts
+        if controllers == "":  # cgroup v2
+            roots = [CGROUP_ROOT, CGROUP_ROOT / "unified"]
+        elif controller in controllers.split(","):
+            roots = [CGROUP_ROOT / controllers, CGROUP_ROOT / controller]
+            if controller == "cpu":
+                roots.append(CGROUP_ROOT / "cpu,cpuacct")
+        else:
+            continue
+        for root in roots:
+            mounts.setdefault(root, path.lstrip("/"))
+    for root in (CGROUP_ROOT, CGROUP_ROOT / controller):
+        mounts.setdefault(root, "")
+
+    dirs = []
+    for root, path in mounts.items():
+        if not root.is_dir():
+            continue
+        cgroup_dir = root / path
+        while cgroup_dir != root:
+            if cgroup_dir.is_dir():
+                dirs.append(cgroup_dir)
+            cgroup_dir = cgroup_dir.parent
+        dirs.append(root)
+    return list(dict.fromkeys(dirs))
+
+
+def cgroup_cpu_limit():
+    """CPUs allowed by the cgroup CPU quotas (the smallest of the process' cgroup and
+    its ancestors), or None if there is no quota."""
+    limits = []
+    for cgroup_dir in _cgroup_dirs("cpu"):
+        cpu_max = _read(cgroup_dir / "cpu.max")
+        if cpu_max:
+            quota, _, period = cpu_max.partition(" ")
+            if quota != "max":
+                limits.append(int(quota) / int(period or 100000))
+            continue
+
+        quota = _read(cgroup_dir / "cpu.cfs_quota_us")
+        period = _read(cgroup_dir / "cpu.cfs_period_us")
+        if quota and period and int(quota) > 0:
+            limits.append(int(quota) / int(period))
+    return min(limits) if limits else None
+
+
+def cgroup_memory_available():
+    """Bytes the cgroup memory limits still allow (the least of the process' cgroup
+    and its ancestors), or None if there is no limit.
+
+    The page cache that can be reclaimed (inactive files) is not counted as used: on
+    a node doing a lot of I/O, it would make the cgroup look full.
+    """
+    available = []
+    for cgroup_dir in _cgroup_dirs("memory"):
+        limit = _read(cgroup_dir / "memory.max")
+        if limit is not None:
+            usage = _read(cgroup_dir / "memory.current")
+            inactive_file = _memory_stat(cgroup_dir, "inactive_file")
+        else:
+            limit = _read(cgroup_dir / "memory.limit_in_bytes")
+            usage = _read(cgroup_dir / "memory.usage_in_bytes")
+            inactive_file = _memory_stat(cgroup_dir, "total_inactive_file")
+        if limit is None or limit == "max" or int(limit) >= V1_UNLIMITED:
+            continue
+        used = max(0, int(usage or 0) - inactive_file)
+        available.append(max(0, int(limit) - used))
+    return min(available) if available else None
+
+
+def effective_cpu_count():
+    """Number of CPUs the gear can really use.
+
+    Returns:
+        n_cpus (int), source (str)
+    """
+    candidates = [(os.cpu_count() or 1, "os.cpu_count()")]
+
+    if hasattr(os, "sched_getaffinity"):
+        candidates.append((len(os.sched_getaffinity(0)), "cpuset"))
+
+    quota = cgroup_cpu_limit()
+    if quota:
+        # a fraction of a CPU still gets one thread
+        candidates.append((max(1, math.floor(quota)), "cgroup cpu quota"))
+
+    n_cpus, source = min(candidates, key=lambda cc: cc[0])
+    log.info(
+        "CPU limits: %s; using %d (%s)",
+        ", ".join(f"{src}={val}" for val, src in candidates),
+        n_cpus,
+        source,
+    )
+    return n_cpus, source
+
+
+def effective_memory_available():
+    """Bytes of memory the gear can really use.
+
+    Returns:
+        mem_bytes (int), source (str)
+    """
+    candidates = [(psutil.virtual_memory().available, "psutil available")]
+
+    cgroup_available = cgroup_memory_available()
+    if cgroup_available is not None:
+        candidates.append((cgroup_available, "cgroup memory limit"))
+
+    mem_bytes, source = min(candidates, key=lambda cc: cc[0])
+    log.info(
+        "Memory limits: %s; using %.2f GiB (%s)",
+        ", ".join(f"{src}={val / 1024**3:.2f} GiB" for val, src in candidates),
+        mem_bytes / 1024**3,
+        source,
+    )
+    return mem_bytes, source
@@ -1,9 +1,8 @@
 """Utils to set gear performance."""
 
 import logging
-import os
 
-import psutil
+from utils.fly.cgroup_limits import effective_cpu_count, effective_memory_available
 
 log = logging.getLogger(__name__)
 
@@ -12,6 +11,8 @@ def set_n_cpus(n_cpus):
     """Set --n_cpus (number of threads) to pass to BIDS App.
 
     Use the given number unless it is too big.  Use the max available if zero.
+    What is available takes the cgroup CPU quota and the cpuset into account
+    (see utils.fly.cgroup_limits), not just the size of the host.
 
     The user may want to set these number to less than the maximum if using a
     shared compute resource.
@@ -22,8 +23,8 @@ def set_n_cpus(n_cpus):
     Returns:
         n_cpus (int) which will become part of the command line command
     """
-    os_cpu_count = os.cpu_count()
-    log.info("os.cpu_count() = %d", os_cpu_count)
+    os_cpu_count, source = effective_cpu_count()
+    log.info("%d CPUs available (limited by %s)", os_cpu_count, source)
     if n_cpus:
         if n_cpus > os_cpu_count:
             log.warning("n_cpus > number available, using max %d", os_cpu_count)
@@ -41,6 +42,8 @@ def set_mem_gb(mem_gb):
     """Set --mem_gb (maximum memory to use) to pass to BIDS App.
 
     Use the given number unless it is too big.  Use the max available if zero.
+    What is available takes the cgroup memory limit into account (see
+    utils.fly.cgroup_limits), not just the memory of the host.
 
     The user may want to set these number to less than the maximum if using a
     shared compute resource.
@@ -53,16 +56,17 @@ def set_mem_gb(mem_gb):
     """
     # TO-DO: maybe we should modify "set_mem_gb" so that we never go above 90-95% of
     #  the available mem in the system
-    psutil_mem_gb = int(psutil.virtual_memory().available / (1024**3))
-    log.info(f"psutil.virtual_memory().available= {psutil_mem_gb:5.2f} GiB")
+    mem_bytes, source = effective_memory_available()
+    available_mem_gb = int(mem_bytes / (1024**3))
+    log.info("%d GiB available (limited by %s)", available_mem_gb, source)
     if mem_gb:
-        if mem_gb > psutil_mem_gb:
-            log.warning("mem_gb > number available, using max %d GiB", psutil_mem_gb)
-            mem_gb = psutil_mem_gb
+        if mem_gb > available_mem_gb:
+            log.warning("mem_gb > number available, using max %d GiB", available_mem_gb)
+            mem_gb = available_mem_gb
         else:
             log.info("mem_gb using %d GiB from config", mem_gb)
     else:  # Default is to use all memory available
-        mem_gb = psutil_mem_gb
-        log.info("using mem_gb = %d GiB (maximum available)", psutil_mem_gb)
+        mem_gb = available_mem_gb
+        log.info("using mem_gb = %d GiB (maximum available)", available_mem_gb)
 
     return mem_gb
@@ -1,22 +1,53 @@
 import argparse
+import hashlib
 import json
 import logging
 import os
+import random
 import re
+import socket
 import sys
+import threading
+import time
 import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import dateutil.parser
 import flywheel
+import requests
 
 from flywheel_bids.supporting_files import errors, utils
 from flywheel_bids.supporting_files.errors import BIDSExportError
+from utils.download_cache import DownloadCache, cache_key
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("bids-exporter")
 
 EPOCH = dateutil.parser.parse("1970-01-01 00:00:0Z")
 
+# Number of files downloaded at the same time
+DOWNLOAD_WORKERS = 8
+# Tries after the first one, and the delay (s) before the first retry (it doubles)
+DOWNLOAD_RETRIES = 4
+DOWNLOAD_BACKOFF = 1.0
+# HTTP statuses worth trying again
+RETRY_STATUS = (408, 429, 500, 502, 503, 504)
+# Errors of the connection to the server (not of the local disk) worth retrying
+RETRY_ERRORS = (
+    ConnectionError,
+    TimeoutError,
+    socket.timeout,
+    requests.ConnectionError,
+    requests.Timeout,
+    requests.exceptions.ChunkedEncodingError,
+)
+# Seconds between progress messages
+PROGRESS_INTERVAL = 10
+# Containers fetched at the same time when a listing left out their files' info
+FETCH_WORKERS = 8
+# Record of the files an export wrote, kept in the BIDS directory
+MANIFEST_NAME = ".fw_bids_manifest"
+
 
 def validate_dirname(dirname):
     """
@@ -69,7 +100,7 @@ def get_metadata(ctx, namespace):
     return ctx["info"][namespace]
 
 
-def is_file_excluded_options(namespace, src_data, replace):
+def is_file_excluded_options(namespace, src_data, replace, manifest=None):
     def is_file_excluded(f, fpath):
         metadata = get_metadata(f, namespace)
         if not metadata:
@@ -84,8 +115,15 @@ def is_file_excluded_options(namespace, src_data, replace):
             if path and path.startswith("sourcedata"):
                 return True
 
+        # The file is part of the export, whether it is downloaded or not
+        if manifest is not None:
+            manifest.add(f, fpath)
+
         # Check if file already exists
         if os.path.isfile(fpath):
+            if manifest is not None and manifest.recorded(fpath):
+                # Written by an earlier export: replace it only if it changed
+                return manifest.is_current(fpath)
             if not replace:
                 return True
             # Check if the file already exists and whether it is up to date
@@ -191,39 +229,334 @@ def create_json(meta_info, path, namespace):
     for key, value in ns_data.get("set_info", {}).items():
         meta_info[key] = value
 
-    # Remove extension of path and replace with .json
+    # Write out contents to JSON file (replacing it: it may be a link to a file
+    # in the download cache)
+    json_path = sidecar_path(path)
+    with open(json_path + ".tmp", "w") as outfile:
+        json.dump(meta_info, outfile, sort_keys=True, indent=4)
+    os.replace(json_path + ".tmp", json_path)
+
+
+def sidecar_path(path):
+    """
+    The JSON sidecar of a file: its path with the extension replaced by .json
+    """
     ext = utils.get_extension(path)
-    new_path = path[: -len(ext)] + ".json"
+    return path[: -len(ext)] + ".json"
 
-    # Write out contents to JSON file
-    with open(new_path, "w") as outfile:
-        json.dump(meta_info, outfile, sort_keys=True, indent=4)
 
+class BidsManifest:
+    """
+    Record (in .fw_bids_manifest) of the files an export wrote in a BIDS
+    directory: the Flywheel file id, version, size and hash of each path, and
+    a digest of its sidecar's info.
+
+    An export compares the files it maps to what the last one recorded, so only
+    the files that changed on Flywheel are downloaded again (whatever their
+    mtime is), and the files the last export wrote that are not part of the
+    dataset anymore are deleted.  Files the manifest does not record (e.g. a
+    directory exported before there was a manifest) are handled as before.
+
+    The files are only pruned if the last export was of the same container with
+    the same filters: otherwise the records of both are kept.
+    """
+
+    def __init__(self, outdir, scope):
+        self.outdir = outdir
+        self.path = os.path.join(outdir, MANIFEST_NAME)
+        self.scope = scope
+        self.old_scope = None
+        self.old = {}
+        self.new = {}
+        if os.path.isfile(self.path):
+            try:
+                with open(self.path) as fp:
+                    data = json.load(fp)
+                self.old_scope = data["scope"]
+                self.old = data["files"]
+            except (OSError, ValueError, KeyError) as exc:
+                logger.warning(f"Ignoring unreadable {self.path}: {exc}")
+
+    def _key(self, path):
+        return os.path.relpath(path, self.outdir)
+
+    @staticmethod
+    def _info_digest(f):
+        info = f.get("info")
+        if not info:
+            return None
+        dump = json.dumps(info, sort_keys=True, default=str)
+        return hashlib.sha1(dump.encode()).hexdigest()
+
+    def add(self, f, path):
+        """Record that the export maps Flywheel file f to path."""
+        self.new[self._key(path)] = {
+            "file_id": f.get("file_id"),
+            "version": f.get("version"),
+            "size": f.get("size"),
+            "hash": f.get("hash"),
+            "sidecar": self._info_digest(f),
+        }
+
+    def recorded(self, path):
+        """True if the last export wrote path."""
+        return self._key(path) in self.old
+
+    def is_current(self, path):
+        """True if path is what the last export wrote and it has not changed since."""
+        key = self._key(path)
+        old, new = self.old.get(key), self.new.get(key)
+        if not old or not new:
+            return False
+        fields = ("file_id", "version", "size", "hash")
+        if any(old[field] != new[field] for field in fields):
+            return False
+        if new["size"] is not None and os.path.getsize(path) != new["size"]:
+            return False  # truncated or changed locally
+        return True
+
+    def sidecar_is_current(self, path):
+        """True if the sidecar of path was written from the same info."""
+        old, new = self.old.get(self._key(path)), self.new.get(self._key(path))
+        if not old or not new:
+            return True  # not exported, or before there was a manifest
+        sidecar = new["sidecar"]
+        return old["sidecar"] == sidecar and (
+            sidecar is None or os.path.isfile(sidecar_path(path))
+        )
 
-def download_bids_files(fw, filepath_downloads, dry_run):
+    def prune(self):
+        """Delete the files the last export wrote that are not mapped anymore."""
+        if self.old_scope != self.scope:
+            # another container or other filters: the rest is not stale
+            self.new = {**self.old, **self.new}
+            return
+        for key in sorted(set(self.old) - set(self.new)):
+            path = os.path.join(self.outdir, key)
+            logger.info(f"Removing {key}, which is not in the dataset anymore")
+            stale = [path]
+            sidecar = sidecar_path(path)
+            if self.old[key]["sidecar"] and self._key(sidecar) not in self.new:
+                stale.append(sidecar)
+            for stale_path in stale:
+                if os.path.isfile(stale_path):
+                    os.remove(stale_path)
+            # and the directories it leaves empty
+            dirname = os.path.dirname(path)
+            while dirname != self.outdir and os.path.isdir(dirname):
+                if os.listdir(dirname):
+                    break
+                os.rmdir(dirname)
+                dirname = os.path.dirname(dirname)
+
+    def save(self):
+        """Write the manifest (once the files it records are all in place)."""
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as fp:
+            json.dump({"scope": self.scope, "files": self.new}, fp, sort_keys=True)
+        os.replace(tmp, self.path)
+
+
+def is_retryable(exc):
     """
-    filepath_downloads: {container_type: {filepath: {'args': (tuple of args for sdk download function), 'modified': file modified attr}}}
-        args[0] = id
-        args[1] = name from the platform
-        args[2] = name at dest
-        modified = Different, time-based representations of the last changes to the file
+    True if a download that failed with exc may work if tried again
+    (connection problems, the server being busy or unavailable), False
+    for the others, local errors such as a full disk included.
     """
-    # Download all project files
-    logger.info("Downloading project files")
-    for f in filepath_downloads["project"]:
-        args = filepath_downloads["project"][f]["args"]
+    if isinstance(exc, flywheel.ApiException):
+        return exc.status is None or exc.status in RETRY_STATUS
+    return isinstance(exc, RETRY_ERRORS)
 
-        modified = filepath_downloads["project"][f]["modified"]
-        logger.info(f"Downloading project file: {args[1]}")
-        # For dry run, don't actually download
-        if dry_run:
-            logger.info(f"  to {args[2]}")
-            continue
-        fw.download_file_from_project(*args)
-        # Set the mtime of the downloaded file to the 'modified' timestamp in seconds
-        modified_time = float(timestamp_to_int(modified))
-        os.utime(f, (modified_time, modified_time))
 
+def with_retries(func, args, name, retries=DOWNLOAD_RETRIES, backoff=DOWNLOAD_BACKOFF):
+    """
+    Call func(*args), trying again after an exponential (jittered) delay
+    while it fails with an error that is worth retrying.
+    """
+    for attempt in range(retries + 1):
+        try:
+            return func(*args)
+        except Exception as exc:
+            if attempt == retries or not is_retryable(exc):
+                raise
+            delay = backoff * 2**attempt * random.uniform(0.5, 1.5)
+            logger.warning(f"Downloading {name} failed ({exc}), retrying in {delay:.1f} s")
+            time.sleep(delay)
+
+
+class DownloadProgress:
+    """
+    Count finished downloads and log how far along they are, at most every
+    `interval` seconds (and at the end), instead of once per file.
+    """
+
+    def __init__(self, label, total, interval=PROGRESS_INTERVAL):
+        self.label = label
+        self.total = total
+        self.interval = interval
+        self.done = 0
+        self.bytes = 0
+        self.start = self.last_log = time.time()
+        self.lock = threading.Lock()
+
+    def update(self, path):
+        with self.lock:
+            self.done += 1
+            try:
+                self.bytes += os.path.getsize(path)
+            except OSError:
+                pass
+            now = time.time()
+            if self.done == self.total or now - self.last_log >= self.interval:
+                self.last_log = now
+                elapsed = max(now - self.start, 1e-6)
+                logger.info(
+                    f"Downloaded {self.done}/{self.total} {self.label} files, "
+                    f"{self.bytes / 1024**2:.1f} MiB in {elapsed:.1f} s "
+                    f"({self.bytes / 1024**2 / elapsed:.1f} MiB/s)"
+                )
+
+
+def list_containers(finder, fields=None, **parents):
+    """
+    All the containers of a finder (e.g. `fw.acquisitions`) under the given
+    parents (e.g. `session=<id>`) and with the given field values (e.g.
+    `{"label": "ses-01"}`), filtered by the server and fetched a page at a time
+    instead of one request per container.  They come with their info and their
+    files' info (`include_all_info`), which listings otherwise leave out.
+    """
+    query = [f"parents.{level}={cid}" for level, cid in parents.items()]
+    query += [f'{field}="{value}"' for field, value in (fields or {}).items()]
+    return list(finder.iter_find(",".join(query), include_all_info=True))
+
+
+def list_project_sessions(fw, project_id, subjects=None, sessions=None):
+    """
+    The sessions of a project, only those of the given subjects (codes) and
+    with the given labels if there are any: the server is asked for just those,
+    so exporting one subject does not list the whole project.
+    """
+    if not subjects and not sessions:
+        return list_containers(fw.sessions, project=project_id)
+
+    if subjects:
+        queries = [
+            {"project": project_id, "fields": {"subject.code": code}}
+            for code in subjects
+        ]
+    else:
+        queries = [{"project": project_id}]
+    if sessions:
+        queries = [
+            dict(query, fields={**query.get("fields", {}), "label": label})
+            for query in queries
+            for label in sessions
+        ]
+
+    with ThreadPoolExecutor(max_workers=min(FETCH_WORKERS, len(queries))) as pool:
+        found = pool.map(lambda query: list_containers(fw.sessions, **query), queries)
+        # a session matching more than one query is only listed once
+        return list({ses["_id"]: ses for listed in found for ses in listed}.values())
+
+
+def files_info_missing(container):
+    """
+    True if a listing left out the info of some of the container's files
+    (it has to be fetched on its own to get their BIDS metadata).
+    """
+    return any(
+        f.get("info_exists") and not f.get("info") for f in container.get("files") or []
+    )
+
+
+def with_files_info(get, containers, workers=FETCH_WORKERS):
+    """
+    The containers with their files and the files' info: the ones that a
+    listing returned incomplete (a server that ignores `include_all_info`, see
+    list_containers) are fetched again with `get`, at the same time.
+    """
+    incomplete = [
+        ix
+        for ix, container in enumerate(containers)
+        if container.get("files") is None or files_info_missing(container)
+    ]
+    if not incomplete:
+        return containers
+    logger.debug(f"Fetching {len(incomplete)} containers for their files' info")
+    containers = list(containers)
+    with ThreadPoolExecutor(max_workers=min(workers, len(incomplete))) as pool:
+        fetched = pool.map(lambda ix: get(containers[ix]["_id"]), incomplete)
+        for ix, container in zip(incomplete, fetched):
+            containers[ix] = container
+    return containers
+
+
+def load_session_acquisitions(fw, session_ids, project_id=None):
+    """
+    The acquisitions of the sessions, indexed by session id.
+
+    With project_id (when all the project's sessions are wanted), they are
+    listed at once for the whole project; otherwise session by session, at
+    the same time.
+    """
+    if project_id:
+        acquisitions = list_containers(fw.acquisitions, project=project_id)
+    elif session_ids:
+        with ThreadPoolExecutor(
+            max_workers=min(FETCH_WORKERS, len(session_ids))
+        ) as pool:
+            acquisitions = [
+                acq
+                for acqs in pool.map(
+                    lambda sid: list_containers(fw.acquisitions, session=sid),
+                    session_ids,
+                )
+                for acq in acqs
+            ]
+    else:
+        acquisitions = []
+
+    index = {}
+    for acq in acquisitions:
+        index.setdefault(acq["parents"]["session"], []).append(acq)
+    return index
+
+
+def written_after_download(ft, path):
+    """
+    True for the files that may be written to once downloaded: the project's
+    files (.bidsignore is appended to, a zip is unzipped) and the text files
+    that sidecars may replace.
+    """
+    return ft == "project" or path.endswith((".json", ".tsv"))
+
+
+def download_one_file(fw, ft, path, download, cache=None):
+    """
+    Download one file with `fw.download_file_from_<ft>`, then set its mtime to
+    its 'modified' timestamp (and unzip it, for a zip file attached to the project).
+    With a cache, the file is only downloaded if no job on this node did already
+    (the same container, name and modified time mean the same content): the
+    cached file gets the mtime, and is linked, or copied if it may be written to.
+    """
+    args = download["args"]
+    logger.debug(f"Downloading {ft} file: {args[1]}")
+    download_file = getattr(fw, "download_file_from_" + ft)
+    # The 'modified' timestamp in seconds, for the mtime of the downloaded file
+    modified_time = float(timestamp_to_int(download["modified"]))
+    if cache:
+        cache.fetch(
+            cache_key(args[0], args[1], download["modified"]),
+            args[2],
+            lambda dest: with_retries(download_file, (args[0], args[1], dest), args[1]),
+            mtime=modified_time,
+            copy=written_after_download(ft, args[2]),
+        )
+    else:
+        with_retries(download_file, args, args[1])
+        os.utime(path, (modified_time, modified_time))
+
+    if ft == "project":
         # If zipfile is attached to project, unzip...
         path = args[2]
         zip_pattern = re.compile("[a-zA-Z0-9]+(.zip)")
@@ -235,24 +568,60 @@ def download_bids_files(fw, filepath_downloads, dry_run):
             # Remove the zipfile
             os.remove(path)
 
-    for ft in ["session", "acquisition", "sidecars"]:
+
+def download_bids_files(
+    fw, filepath_downloads, dry_run, workers=DOWNLOAD_WORKERS, cache=None
+):
+    """
+    filepath_downloads: {container_type: {filepath: {'args': (tuple of args for sdk download function), 'modified': file modified attr}}}
+        args[0] = id
+        args[1] = name from the platform
+        args[2] = name at dest
+        modified = Different, time-based representations of the last changes to the file
+    workers: number of files downloaded at the same time
+    cache: DownloadCache shared with the other jobs on this node (optional)
+
+    The files of each container type are downloaded concurrently, one type after the
+    other (project, session, acquisition), then the sidecars are written, so a file
+    planned for the same path in two types ends up as it would one at a time.
+    """
+    for ft in ["project", "session", "acquisition", "sidecars"]:
         # Download all files for the looped filetype
         logger.info(f"Downloading {ft} files")
-        for f in filepath_downloads[ft]:
-            args = filepath_downloads[ft][f]["args"]
-            logger.info(f"Downloading {ft} file: {args[1]}")
-            # For dry run, don't actually download
-            if dry_run:
+        if dry_run:
+            for f in filepath_downloads[ft]:
+                args = filepath_downloads[ft][f]["args"]
+                logger.info(f"Downloading {ft} file: {args[1]}")
+                # For dry run, don't actually download
                 logger.info(f"  to {args[2]}")
-                continue
-            if ft == "sidecars":
-                create_json(*args)
-            else:
-                modified = filepath_downloads[ft][f]["modified"]
-                getattr(fw, "download_file_from_" + ft)(*args)
-                # Set the mtime of the downloaded file to the 'modified' timestamp in seconds
-                modified_time = float(timestamp_to_int(modified))
-                os.utime(f, (modified_time, modified_time))
+            continue
+
+        if ft == "sidecars":
+            for f in filepath_downloads[ft]:
+                create_json(*filepath_downloads[ft][f]["args"])
+            continue
+
+        progress = DownloadProgress(ft, len(filepath_downloads[ft]))
+        errors = []
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            futures = {
+                pool.submit(download_one_file, fw, ft, f, download, cache): f
+                for f, download in filepath_downloads[ft].items()
+            }
+            for future in as_completed(futures):
+                if future.cancelled():
+                    continue
+                try:
+                    future.result()
+                    progress.update(futures[future])
+                except Exception as exc:
+                    logger.error(f"Could not download {futures[future]}: {exc}")
+                    errors.append(exc)
+                    # don't start the others, the export has failed
+                    for pending in futures:
+                        pending.cancel()
+        if errors:
+            raise errors[0]
 
 
 def download_bids_dir(
@@ -267,6 +636,8 @@ def download_bids_dir(
     sessions=[],
     folders=[],
     validation_requested=True,
+    download_workers=DOWNLOAD_WORKERS,
+    download_cache=None,
 ):
     """
 
@@ -274,12 +645,27 @@ def download_bids_dir(
     project_id: ID of the project to download
     outdir: path to directory to download files to, string
     src_data: Option to include sourcedata when downloading
+    download_workers: number of files downloaded at the same time
+    download_cache: DownloadCache shared with the other jobs on this node
 
     """
 
     # Define namespace
     namespace = "BIDS"
-    is_file_excluded = is_file_excluded_options(namespace, src_data, replace)
+    # What the last export of this directory wrote
+    manifest = BidsManifest(
+        outdir,
+        {
+            "container": [container_type, container_id],
+            "subjects": sorted(subjects or []),
+            "sessions": sorted(sessions or []),
+            "folders": sorted(folders or []),
+            "src_data": bool(src_data),
+        },
+    )
+    is_file_excluded = is_file_excluded_options(
+        namespace, src_data, replace, manifest=manifest
+    )
 
     # Files and the corresponding download arguments separated by parent container
     filepath_downloads = {
@@ -342,8 +728,10 @@ def download_bids_dir(
         filepath_downloads["sidecars"][path] = {
             "args": (project["info"][namespace], path, namespace)
         }
-        # Get project sessions
-        project_sessions = fw.get_project_sessions(container_id)
+        # Get project sessions (only the ones asked for), a page at a time
+        project_sessions = list_project_sessions(
+            fw, container_id, subjects=subjects, sessions=sessions
+        )
     elif container_type == "session":
         project_sessions = [fw.get_session(container_id)]
     else:
@@ -352,6 +740,7 @@ def download_bids_dir(
     if project_sessions:
         logger.info("Processing session files")
         all_acqs = []
+        selected_sessions = []
         for proj_ses in project_sessions:
             # Skip session if we're filtering to the list of sessions
             if sessions and proj_ses.get("label") not in sessions:
@@ -367,11 +756,23 @@ def download_bids_dir(
                 if subj_code not in subjects:
                     continue
 
-            # Get true session if files aren't already retrieved, in order to access file info
-            if proj_ses.get("files"):
-                session = proj_ses
-            else:
-                session = fw.get_session(proj_ses["_id"])
+            selected_sessions.append(proj_ses)
+
+        # Get all the acquisitions at once, rather than session after session
+        all_selected = (
+            container_type == "project"
+            and not subjects
+            and not sessions
+            and len(selected_sessions) == len(project_sessions)
+        )
+        session_acqs = load_session_acquisitions(
+            fw,
+            [ses["_id"] for ses in selected_sessions],
+            project_id=container_id if all_selected else None,
+        )
+
+        # Get true sessions if files aren't already retrieved, in order to access file info
+        for session in with_files_info(fw.get_session, selected_sessions):
             # Check if session contains files
             # Iterate over any session files
             for f in session.get("files", []):
@@ -402,24 +803,19 @@ def download_bids_dir(
                     "modified": f.get("modified"),
                 }
 
-            logger.info("Processing acquisition files")
-            # Get acquisitions
-            # session_acqs[ix]['files'][ix]['name'] is the originally uploaded series name
-            session_acqs = fw.get_session_acquisitions(proj_ses["_id"])
-            all_acqs += session_acqs
+            # session_acqs[id][ix]['files'][ix]['name'] is the originally uploaded series name
+            all_acqs += session_acqs.get(session["_id"], [])
     elif container_type == "acquisition":
         all_acqs = [fw.get_acquisition(container_id)]
     else:
         all_acqs = []
 
     if all_acqs:
-        for ses_acq in all_acqs:
-            # Skip if BIDS.Ignore is True
-            if is_container_excluded(ses_acq, namespace):
-                continue
-            # Get true acquisition if files aren't already retrieved, in order to access file info
-
-            acq = fw.get_acquisition(ses_acq["_id"])
+        logger.info("Processing acquisition files")
+        # Skip if BIDS.Ignore is True
+        all_acqs = [acq for acq in all_acqs if not is_container_excluded(acq, namespace)]
+        # Get true acquisitions if files aren't already retrieved, in order to access file info
+        for acq in with_files_info(fw.get_acquisition, all_acqs):
             # Iterate over acquistion files
             for f in acq.get("files", []):
 
@@ -437,6 +833,11 @@ def download_bids_dir(
 
                 # Don't exclude any files that specify exclusion
                 if is_file_excluded(f, path):
+                    # An up to date file may still have new info for its sidecar
+                    if not manifest.sidecar_is_current(path):
+                        filepath_downloads["sidecars"][path] = {
+                            "args": (f["info"], path, namespace)
+                        }
                     continue
 
                 if not os.path.exists(os.path.dirname(path)):
@@ -481,7 +882,13 @@ def download_bids_dir(
             "Error mapping files from Flywheel to BIDS.\n" "Hint: Check curation."
         )
 
-    download_bids_files(fw, filepath_downloads, dry_run)
+    download_bids_files(
+        fw, filepath_downloads, dry_run, workers=download_workers, cache=download_cache
+    )
+
+    if not dry_run:
+        manifest.prune()
+        manifest.save()
 
 
 def determine_container(fw, project_label, container_type, container_id, group_id=None):
@@ -524,6 +931,8 @@ def export_bids(
     container_id=None,
     source_data=False,
     validate=True,
+    download_workers=DOWNLOAD_WORKERS,
+    download_cache=None,
 ):
 
     ### Prep
@@ -548,6 +957,8 @@ def export_bids(
         sessions=sessions,
         folders=folders,
         validation_requested=validate,
+        download_workers=download_workers,
+        download_cache=download_cache,
     )
 
     # Validate the downloaded directory
@@ -658,6 +1069,23 @@ def main():
         default=None,
         help="Download single container in BIDS format. Must provide --container-type.",
     )
+    parser.add_argument(
+        "--download-workers",
+        dest="download_workers",
+        action="store",
+        type=int,
+        required=False,
+        default=DOWNLOAD_WORKERS,
+        help="Number of files to download at the same time",
+    )
+    parser.add_argument(
+        "--download-cache-dir",
+        dest="download_cache_dir",
+        action="store",
+        required=False,
+        default=None,
+        help="Directory shared by jobs on this node, where downloaded files are kept",
+    )
     args = parser.parse_args()
 
     # Check API key - raises Error if key is invalid
@@ -677,6 +1105,10 @@ def main():
             container_type=args.container_type,
             container_id=args.container_id,
             source_data=args.source_data,
+            download_workers=args.download_workers,
+            download_cache=DownloadCache(args.download_cache_dir)
+            if args.download_cache_dir
+            else None,
         )
     except errors.BIDSException as bids_exception:
         logger.error(bids_exception)
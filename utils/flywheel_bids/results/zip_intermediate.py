@@ -2,15 +2,146 @@
 
 import logging
 import os
-import shutil
-from pathlib import Path
-from zipfile import ZIP_DEFLATED, ZipFile
+import re
+from pathlib import Path, PurePosixPath
+
+from utils.compression import CompressionPolicy
+from utils.parallel_zip import ParallelZipWriter
 
-FWV0 = Path.cwd()
 log = logging.getLogger(__name__)
 
 
-def zip_selected(root_dir, dir_name, output_filename, selected_files, selected_dirs):
+def _glob_to_regex(part):
+    """Regex for one path component of a glob (never matches across a "/")."""
+    regex = ""
+    ii = 0
+    while ii < len(part):
+        char = part[ii]
+        ii += 1
+        if char == "*":
+            regex += "[^/]*"
+        elif char == "?":
+            regex += "[^/]"
+        elif char == "[":
+            # as in fnmatch, a "]" right after "[" or "[!" is part of the set
+            start = ii + 1 if part[ii : ii + 1] == "!" else ii
+            start += 1 if part[start : start + 1] == "]" else 0
+            close = part.find("]", start)
+            if close == -1:
+                regex += re.escape(char)
+            else:
+                chars = part[ii:close].replace("\\", "\\\\")
+                if chars.startswith("!"):
+                    chars = "^" + chars[1:]
+                elif chars.startswith("^"):
+                    chars = "\\" + chars
+                regex += f"(?!/)[{chars}]"
+                ii = close + 1
+        else:
+            regex += re.escape(char)
+    return regex
+
+
+class Selector:
+    """gear-intermediate-files/folders selectors, compiled once into regexes.
+
+    A file is selected if its name is one of the selected files, if its path ends
+    with one of them (as with Path.match), or if the directory it is in ends with
+    one of the selected dirs.  A selector that starts with dir_name is a full path,
+    it only matches from the top of dir_name.  If all the selectors are full paths,
+    the walk skips the directories that cannot lead to a match.
+
+    Args:
+        dir_name (str) name of directory where the selectors are looked for
+        selected_files (list) file names or partial paths to files
+        selected_dirs (list) dir names or partial paths to dirs
+    """
+
+    def __init__(self, dir_name, selected_files, selected_dirs):
+        self.dir_name = dir_name
+        self.selected_files = list(selected_files)
+        self.selected_dirs = list(selected_dirs)
+        self._file_res = [re.compile(self._compile(sel)) for sel in selected_files]
+        self._dir_res = [re.compile(self._compile(sel)) for sel in selected_dirs]
+        self._any_file = self._combine(self._file_res)
+        self._any_dir = self._combine(self._dir_res)
+        self.names = set(self.selected_files)
+
+        # component regexes of full path selectors, to prune the walk
+        self._prefixes = []
+        self.can_prune = True
+        for sel, is_dir in [(sel, False) for sel in self.selected_files] + [
+            (sel, True) for sel in self.selected_dirs
+        ]:
+            parts = PurePosixPath(sel).parts
+            if len(parts) < 2 or parts[0] != dir_name:
+                self.can_prune = False
+                break
+            # a selected dir can only be reached through its own path,
+            # a selected file through the path of the directory it is in
+            dir_parts = parts if is_dir else parts[:-1]
+            self._prefixes.append([re.compile(_glob_to_regex(pp)) for pp in dir_parts])
+
+    def _compile(self, sel):
+        parts = PurePosixPath(sel).parts
+        anchored = len(parts) > 1 and parts[0] == self.dir_name
+        regex = "/".join(_glob_to_regex(part) for part in parts)
+        return ("^" if anchored else "(?:^|/)") + regex + "$"
+
+    @staticmethod
+    def _combine(regexes):
+        if not regexes:
+            return None
+        return re.compile("|".join(f"(?:{regex.pattern})" for regex in regexes))
+
+    def match_file(self, rel_path, name):
+        """True if the file at rel_path (starting with dir_name) is selected."""
+        if name in self.names:
+            return True
+        return bool(self._any_file and self._any_file.search(rel_path))
+
+    def match_dir(self, rel_dir):
+        """True if the files directly in rel_dir are selected."""
+        return bool(self._any_dir and self._any_dir.search(rel_dir))
+
+    def found(self, rel_path, rel_dir, name):
+        """The selectors that match a selected file (to warn about the others)."""
+        found = [name] if name in self.names else []
+        found += [
+            sel
+            for sel, regex in zip(self.selected_files, self._file_res)
+            if regex.search(rel_path)
+        ]
+        if not found:
+            found += [
+                sel
+                for sel, regex in zip(self.selected_dirs, self._dir_res)
+                if regex.search(rel_dir)
+            ]
+        return found
+
+    def may_contain(self, rel_dir):
+        """False if nothing under rel_dir (starting with dir_name) can be selected."""
+        if not self.can_prune:
+            return True
+        dir_parts = rel_dir.split("/")
+        for prefix in self._prefixes:
+            if len(dir_parts) <= len(prefix) and all(
+                regex.fullmatch(part) for regex, part in zip(prefix, dir_parts)
+            ):
+                return True
+        return False
+
+
+def zip_selected(
+    root_dir,
+    dir_name,
+    output_filename,
+    selected_files,
+    selected_dirs,
+    policy=None,
+    workers=1,
+):
     """Zip selected files and directories into output_filename.
 
     The resulting zip file will unzip into directory dir_name and will maintain the
@@ -29,45 +160,45 @@ def zip_selected(root_dir, dir_name, output_filename, selected_files, selected_d
         output_filename (Path) path and name of zip file to save
         selected_files (list) file names or partial paths to files
         selected_dirs (list) dir names or partial paths to dirs
+        policy (CompressionPolicy) how to compress each file
+        workers (int) number of threads compressing the files
+
+    Returns:
+        summary (dict) compression decisions, see CompressionPolicy.summary()
     """
 
-    os.chdir(root_dir)
+    if policy is None:
+        policy = CompressionPolicy()
 
     if Path(output_filename).exists():
         Path(output_filename).unlink()
 
-    files_found = []
-    dirs_found = []
-    with ZipFile(output_filename, "w", ZIP_DEFLATED) as outzip:
-        for root, subdirs, files in os.walk(dir_name):
+    selector = Selector(dir_name, selected_files, selected_dirs)
+
+    found = set()
+    with ParallelZipWriter(output_filename, workers=workers, policy=policy) as outzip:
+        for root, subdirs, files in os.walk(os.path.join(root_dir, dir_name)):
+            rel_dir = Path(os.path.relpath(root, root_dir)).as_posix()
+            # don't go where nothing can be selected
+            subdirs[:] = [
+                sub for sub in subdirs if selector.may_contain(f"{rel_dir}/{sub}")
+            ]
+            dir_matched = selector.match_dir(rel_dir)
             for fl in files:
-                matched = False
-                file_path = Path(root) / fl
-                if fl in selected_files:
-                    matched = True
-                    files_found.append(fl)
-                else:
-                    for sel in selected_files:
-                        if file_path.match(sel):
-                            matched = True
-                            files_found.append(sel)
-                if not matched:
-                    for sel in selected_dirs:
-                        if Path(root).match(sel):
-                            dirs_found.append(sel)
-                            matched = True
-                if matched:
-                    log.info("Zipping %s", file_path)
-                    outzip.write(file_path)
+                rel_path = f"{rel_dir}/{fl}"
+                if dir_matched or selector.match_file(rel_path, fl):
+                    found.update(selector.found(rel_path, rel_dir, fl))
+                    log.info("Zipping %s", rel_path)
+                    outzip.write(os.path.join(root, fl), rel_path)
 
     for sel in selected_files:
-        if sel not in files_found:
+        if sel not in found:
             log.warning("Looked for %s but could not find it.", sel)
     for sel in selected_dirs:
-        if sel not in dirs_found:
+        if sel not in found:
             log.warning("Looked for %s but could not find it.", sel)
 
-    os.chdir(FWV0)  # Get back to where you once belonged
+    return policy.summary()
 
 
 def zip_intermediate_selected(
@@ -78,6 +209,8 @@ def zip_intermediate_selected(
     output_dir,
     work_dir,
     run_label,
+    policy=None,
+    workers=1,
 ):
     """Zip the listed files and folders in work/.
 
@@ -89,6 +222,11 @@ def zip_intermediate_selected(
         output_dir (str) path to where output will be written
         work_dir (str) path to temporary directory
         run_label (str) name of run to use in zip file name
+        policy (CompressionPolicy) how to compress each file
+        workers (int) number of threads compressing the files
+
+    Returns:
+        summary (dict) compression decisions, see CompressionPolicy.summary()
     """
 
     do_find = False
@@ -113,34 +251,70 @@ def zip_intermediate_selected(
         dest_zip = os.path.join(output_dir, file_name)
 
         log.info('Files and folders will be zipped to "' + dest_zip + '"')
-        zip_selected(work_dir.parents[0], work_dir.name, dest_zip, files, folders)
+        return zip_selected(
+            work_dir.parents[0],
+            work_dir.name,
+            dest_zip,
+            files,
+            folders,
+            policy,
+            workers=workers,
+        )
 
     else:
         log.debug("No files or folders specified in config to zip")
+        return {}
 
 
 def zip_all_intermediate_output(
-    destination_id, gear_name, output_dir, work_dir, run_label
+    destination_id,
+    gear_name,
+    output_dir,
+    work_dir,
+    run_label,
+    policy=None,
+    workers=1,
 ):
     """Zip all intermediate output in the "work/ directory into one archive.
 
+    The archive has the same members as shutil.make_archive would write, but the
+    files are compressed by a pool of threads (ZIP64 is used if the archive is
+    bigger than 2 GiB or has more than 65535 members).
+
     Args:
         destination_id (str) ID of analysis container that is the destination of the gear
         gear_name (str) name of gear from manifest "name"
         output_dir (str) path to where output will be written
         work_dir (str) path to temporary directory
         run_label (str) name of run to use in zip file name
+        policy (CompressionPolicy) how to compress each file
+        workers (int) number of threads compressing the files
+
+    Returns:
+        summary (dict) compression decisions, see CompressionPolicy.summary()
     """
 
+    if policy is None:
+        policy = CompressionPolicy()
+
     # Name of zip file has <subject> and <analysis>
     file_name = f"{gear_name}_work_{run_label}_{destination_id}"
     dest_zip = os.path.join(output_dir, file_name)
 
-    work_path, work_dir = os.path.split(work_dir)
-    os.chdir(work_path)
+    work_path, work_name = os.path.split(os.path.normpath(work_dir))
 
-    log.info("Zipping " + work_dir + " directory to " + dest_zip + ".")
+    log.info("Zipping " + work_name + " directory to " + dest_zip + ".")
 
-    shutil.make_archive(dest_zip, "zip", work_path, work_dir)
+    # Same members as shutil.make_archive(dest_zip, "zip", work_path, work_name)
+    with ParallelZipWriter(dest_zip + ".zip", workers=workers, policy=policy) as outzip:
+        outzip.write(work_dir, work_name)
+        for root, subdirs, files in os.walk(work_dir):
+            arc_root = os.path.join(work_name, os.path.relpath(root, work_dir))
+            for name in sorted(subdirs):
+                outzip.write(os.path.join(root, name), os.path.join(arc_root, name))
+            for name in files:
+                path = os.path.join(root, name)
+                if os.path.isfile(path):
+                    outzip.write(path, os.path.join(arc_root, name))
 
-    os.chdir(FWV0)
+    return policy.summary()
@@ -0,0 +1,93 @@
+"""Zip the gear output, compressing each file as the compression policy says."""
+
+import logging
+import os
+import os.path as op
+
+from utils.compression import CompressionPolicy
+from utils.incremental_zip import staged_for
+from utils.parallel_zip import ParallelZipWriter
+
+log = logging.getLogger(__name__)
+
+
+def zip_output(
+    root_dir,
+    source_dir,
+    output_zip_filename,
+    dry_run=False,
+    exclude_files=None,
+    policy=None,
+    staged=None,
+    workers=1,
+):
+    """Zip an output directory.
+
+    Same as flywheel_gear_toolkit.utils.zip_tools.zip_output, except that already
+    compressed files are stored instead of deflated (see CompressionPolicy), files
+    are compressed by a pool of threads, and files that were compressed while the
+    app ran (see IncrementalPackager) and have not changed since are not compressed
+    again.
+
+    Args:
+        root_dir (str): The root directory to zip relative to.
+        source_dir (str): subdirectory (of <root_dir>) to zip.
+        output_zip_filename (str): Path of the resultant output zip file, relative to
+            <root_dir> unless it is absolute.
+        dry_run (boolean, optional): Boolean value that determines whether or not to
+            execute a full zip compression of source_dir.
+        exclude_files (list, optional): Files in <root_dir>/<source_dir> to exclude
+            from the zip file. Defaults to `None`.
+        policy (CompressionPolicy, optional): how to compress each file
+        staged (dict, optional): StagedFile by path relative to root_dir
+        workers (int): number of threads compressing the files
+
+    Returns:
+        summary (dict): compression decisions, see CompressionPolicy.summary()
+
+    Raises:
+        FileNotFoundError: If `root_dir` does not exist.
+    """
+    if exclude_files:
+        exclude_from_output = exclude_files
+    else:
+        exclude_from_output = []
+
+    if policy is None:
+        policy = CompressionPolicy()
+
+    if not op.exists(root_dir):
+        raise FileNotFoundError(f"The directory, {root_dir}, does not exist.")
+
+    # (the toolkit's zip_output changes to root_dir, this runs in a pool's worker and
+    # does not, so relative paths are made absolute here)
+    output_zip_filename = op.join(root_dir, output_zip_filename)
+
+    log.info("Zipping output file %s", output_zip_filename)
+    if not dry_run:
+        try:
+            os.remove(output_zip_filename)
+        except FileNotFoundError:
+            pass
+
+        n_staged = 0
+        with ParallelZipWriter(
+            output_zip_filename, workers=workers, policy=policy
+        ) as outzip:
+            for root, subdirs, files in os.walk(op.join(root_dir, source_dir)):
+                rel_root = op.relpath(root, root_dir)
+                for fl in files + subdirs:
+                    fl_path = op.join(rel_root, fl)
+                    # only if the file is not to be excluded from output
+                    if fl_path not in exclude_from_output:
+                        path = op.join(root, fl)
+                        entry = staged_for(staged, fl_path, path)
+                        if entry:
+                            outzip.write_staged(path, fl_path, entry)
+                            n_staged += 1
+                        else:
+                            outzip.write(path, fl_path)
+        if staged:
+            log.info("%d of %d staged files were still up to date", n_staged, len(staged))
+
+    return policy.summary()
@@ -5,6 +5,8 @@ import logging
 
 from flywheel import ApiException
 
+from utils.containers import ContainerCache
+
 log = logging.getLogger(__name__)
 
 
@@ -12,7 +14,8 @@ def get_analysis_run_level_and_hierarchy(fw, destination_id):
     """Determine the level at which a job is running, given a destination
 
     Args:
-        fw (gear_toolkit.GearToolkitContext.client): flywheel client
+        fw (gear_toolkit.GearToolkitContext.client): flywheel client, or a
+            ContainerCache to reuse the containers it already fetched
         destination_id (id): id of the destination of the gear
 
     Returns:
@@ -31,9 +34,12 @@ def get_analysis_run_level_and_hierarchy(fw, destination_id):
         "acquisition_label": None,
     }
 
+    containers = fw if isinstance(fw, ContainerCache) else ContainerCache(fw)
+
     try:
 
-        destination = fw.get(destination_id)
+        # all the parents are fetched at the same time
+        destination, parents = containers.hierarchy(destination_id)
 
         if destination.container_type != "analysis":
             log.error("The destination_id must reference an analysis container.")
@@ -45,8 +51,8 @@ def get_analysis_run_level_and_hierarchy(fw, destination_id):
 
             for level in ["project", "subject", "session", "acquisition"]:
 
-                if destination.parents[level]:
-                    container = fw.get(destination.parents[level])
+                if level in parents:
+                    container = parents[level]
                     hierarchy[f"{level}_label"] = container.label
 
                     if hierarchy["run_level"] == level:
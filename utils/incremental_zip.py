@@ -0,0 +1,210 @@
+"""Compress the app's output while it is still running.
+
+The output archive is only built after qsirecon exits, but most of its output (the
+connectivity matrices of each atlas, the finished reports) is written long before
+the last node.  An IncrementalPackager thread watches the output directory while the
+app runs, and compresses each file that has not changed for a quiet period into a
+"fragment" file in a staging directory.  When the output is zipped, the compressed
+data of the files that are still as they were staged is copied as it is, and only
+the other files have to be compressed (see ParallelZipWriter.write_staged).
+
+Only files the CompressionPolicy deflates are staged: the others are copied as they
+are in any case.
+
+Example:
+    .. code-block:: python
+
+        packager = IncrementalPackager(output_dir, destination_id, staging_dir)
+        packager.start()
+        stream_command(command)
+        staged = packager.stop()
+        zip_output(output_dir, destination_id, zip_name, staged=staged)
+"""
+
+import logging
+import os
+import threading
+import time
+import zlib
+from dataclasses import dataclass
+from zipfile import ZIP_DEFLATED
+
+from utils.compression import CompressionPolicy
+
+log = logging.getLogger(__name__)
+
+FRAGMENT_NAME = "staged_output.fragment"
+CHUNK_SIZE = 1024 * 1024
+
+
+@dataclass
+class StagedFile:
+    """The compressed data of a file, in a fragment.
+
+    Attributes:
+        fragment: path of the fragment file
+        offset: where the compressed data starts in the fragment
+        compress_size: bytes of compressed data
+        crc: CRC-32 of the file
+        file_size: size of the file when it was compressed
+        mtime_ns: modification time of the file when it was compressed
+        compress_type: zip compression method
+        decision: the CompressionPolicy decision, for its statistics
+    """
+
+    fragment: str
+    offset: int
+    compress_size: int
+    crc: int
+    file_size: int
+    mtime_ns: int
+    compress_type: int
+    decision: str
+
+
+def staged_for(staged, rel_path, path):
+    """The staged data of a file, or None if it was not staged or changed since."""
+    entry = staged.get(rel_path) if staged else None
+    if entry is None:
+        return None
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    if stat.st_size != entry.file_size or stat.st_mtime_ns != entry.mtime_ns:
+        return None
+    return entry
+
+
+class IncrementalPackager(threading.Thread):
+    """Thread that compresses the files of a directory once they stop changing.
+
+    The files are looked for under root_dir/source_dir and known by their path
+    relative to root_dir, as zip_output names them in the archive.
+
+    Args:
+        root_dir (str): directory the archive paths are relative to
+        source_dir (str): subdirectory of root_dir to watch
+        staging_dir (str): where to write the fragment (not under root_dir/source_dir)
+        quiet_period (float): seconds a file must stay unchanged to be compressed
+        interval (float): seconds between looks at the directory
+        policy (CompressionPolicy): how to compress each file
+        exclude_files: paths (relative to root_dir) that are not zipped
+    """
+
+    def __init__(
+        self,
+        root_dir,
+        source_dir,
+        staging_dir,
+        quiet_period=60,
+        interval=10,
+        policy=None,
+        exclude_files=None,
+    ):
+        super().__init__(name="incremental-packager", daemon=True)
+        self.root_dir = str(root_dir)
+        self.source_dir = str(source_dir)
+        self.quiet_period = quiet_period
+        self.interval = interval
+        self.policy = policy or CompressionPolicy()
+        self.exclude_files = exclude_files or []
+        os.makedirs(staging_dir, exist_ok=True)
+        self.fragment = os.path.join(staging_dir, FRAGMENT_NAME)
+        self.staged = {}
+        # by relative path: ((size, mtime_ns), when it was first seen like that)
+        self._seen = {}
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        """Stop watching (the file being compressed is finished first).
+
+        Returns:
+            staged (dict): StagedFile by path relative to root_dir
+        """
+        self._stop_event.set()
+        if self.is_alive():
+            self.join()
+        log.info(
+            "%d files were compressed while the app ran (%.1f MiB)",
+            len(self.staged),
+            sum(entry.file_size for entry in self.staged.values()) / 1024**2,
+        )
+        return self.staged
+
+    def run(self):
+        with open(self.fragment, "wb") as out:
+            while not self._stop_event.wait(self.interval):
+                try:
+                    self.scan(out)
+                except Exception as exc:  # pylint: disable=broad-except
+                    # it is only a head start, the files are zipped anyway
+                    log.warning("Could not compress the output yet: %s", exc)
+
+    def scan(self, out):
+        """Stage the files that have not changed for the quiet period."""
+        now = time.time()
+        for root, _, files in os.walk(os.path.join(self.root_dir, self.source_dir)):
+            for name in files:
+                if self._stop_event.is_set():
+                    return  # the rest is zipped with the output
+                path = os.path.join(root, name)
+                rel_path = os.path.relpath(path, self.root_dir)
+                if rel_path in self.exclude_files:
+                    continue
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                key = (stat.st_size, stat.st_mtime_ns)
+                seen = self._seen.get(rel_path)
+                if seen is None or seen[0] != key:
+                    self._seen[rel_path] = (key, now)
+                    continue
+                if now - seen[1] < self.quiet_period:
+                    continue
+                if staged_for(self.staged, rel_path, path):
+                    continue
+                self._stage(out, path, rel_path, key)
+
+    def _stage(self, out, path, rel_path, key):
+        """Append the compressed file to the fragment, if the policy deflates it."""
+        decision, compress_type, level = self.policy.choose(path)
+        if compress_type != ZIP_DEFLATED:
+            # never worth staging, remember it so it is not looked at again
+            self._seen[rel_path] = (key, float("inf"))
+            return
+
+        offset = out.tell()
+        compressor = zlib.compressobj(
+            -1 if level is None else level, zlib.DEFLATED, -15
+        )
+        crc = 0
+        size = 0
+        with open(path, "rb") as fp:
+            for chunk in iter(lambda: fp.read(CHUNK_SIZE), b""):
+                crc = zlib.crc32(chunk, crc)
+                size += len(chunk)
+                out.write(compressor.compress(chunk))
+        out.write(compressor.flush())
+
+        stat = os.stat(path)
+        if (stat.st_size, stat.st_mtime_ns) != key or size != key[0]:
+            # it changed while it was compressed, try again later
+            out.seek(offset)
+            out.truncate()
+            self._seen[rel_path] = ((stat.st_size, stat.st_mtime_ns), time.time())
+            return
+
+        out.flush()
+        self.staged[rel_path] = StagedFile(
+            fragment=self.fragment,
+            offset=offset,
+            compress_size=out.tell() - offset,
+            crc=crc,
+            file_size=size,
+            mtime_ns=stat.st_mtime_ns,
+            compress_type=compress_type,
+            decision=decision,
+        )
+        log.debug("Compressed %s while the app runs", rel_path)
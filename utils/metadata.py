@@ -0,0 +1,30 @@
+"""Add information to the analysis metadata file (.metadata.json)."""
+
+import json
+import logging
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+
+def update_analysis_info(output_dir, info):
+    """Merge info into "analysis.info" in output_dir/.metadata.json.
+
+    The file is created if it does not exist.  Keys in info replace the keys
+    already there.
+
+    Args:
+        output_dir (str or Path): gear output directory
+        info (dict): information to add
+    """
+    metadata_file = Path(output_dir) / ".metadata.json"
+    metadata = {}
+    if metadata_file.exists():
+        with open(metadata_file) as fff:
+            metadata = json.load(fff)
+
+    metadata.setdefault("analysis", {}).setdefault("info", {}).update(info)
+
+    with open(metadata_file, "w") as fff:
+        json.dump(metadata, fff)
+    log.info("Wrote %s", metadata_file)
@@ -0,0 +1,149 @@
+"""Run the gear's output archive jobs at the same time.
+
+Every archive (the analysis output zip, the html report zips and the intermediate
+work zips) is built by its own function that changes directory and compresses on a
+single core.  Here, each of those functions is run as a job in a process pool, so
+they can run concurrently without sharing a working directory.  A job can name other
+jobs that must finish before it starts, e.g. when it modifies files another job is
+reading.
+
+The archives are exactly the same as when the functions are called one after the
+other.
+
+The worker processes are started by a fork server, not forked from the gear: the gear
+has threads running (the resource sampler, background deletions, other sessions of a
+batch), and a child forked while one of them holds a lock (logging, malloc) can
+deadlock.
+
+Example:
+    .. code-block:: python
+
+        jobs = [
+            ArchiveJob("output", zip_output, (root_dir, dest_id, zip_name)),
+            ArchiveJob("html", zip_htmls, (out_dir, dest_id, path), after=["output"]),
+        ]
+        timings, results = run_archive_jobs(jobs, n_workers=4)
+"""
+
+import logging
+import multiprocessing
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Tuple
+
+log = logging.getLogger(__name__)
+
+# how the worker processes are started (see above)
+MP_START_METHOD = "forkserver"
+DEFAULT_LOG_FORMAT = "%(levelname)s %(name)s %(message)s"
+
+
+@dataclass
+class ArchiveJob:
+    """One archive to build.
+
+    Attributes:
+        name: name of the job, used in logs and timings
+        func: function that builds the archive (must be picklable)
+        args: positional arguments for func
+        kwargs: keyword arguments for func
+        after: names of jobs that must finish before this one starts
+    """
+
+    name: str
+    func: Callable
+    args: tuple = ()
+    kwargs: dict = field(default_factory=dict)
+    after: List[str] = field(default_factory=list)
+
+
+def _init_worker(level, log_format):
+    """Log from the worker as the gear does (it is not forked, so it does not inherit
+    the gear's logging configuration)."""
+    logging.basicConfig(level=level, format=log_format)
+
+
+def _log_format():
+    for handler in logging.getLogger().handlers:
+        if handler.formatter is not None and handler.formatter._fmt:  # pylint: disable=W0212
+            return handler.formatter._fmt  # pylint: disable=W0212
+    return DEFAULT_LOG_FORMAT
+
+
+def _timed_call(func, args, kwargs):
+    """Call func, return how long it took and its result (run in the worker)."""
+    start = time.time()
+    result = func(*args, **kwargs)
+    return time.time() - start, result
+
+
+def run_archive_jobs(
+    jobs: List[ArchiveJob], n_workers: int
+) -> Tuple[Dict[str, float], Dict[str, Any]]:
+    """Run the archive jobs in a pool of n_workers processes.
+
+    If a job fails, the jobs that are running are allowed to finish, jobs waiting for
+    the failed one are not started, and the first error is raised at the end.
+
+    Args:
+        jobs: the archive jobs
+        n_workers: maximum number of jobs to run at the same time
+
+    Returns:
+        timings: seconds each job took, by job name
+        results: what each job's function returned, by job name
+    """
+    timings = {}
+    results = {}
+    if not jobs:
+        return timings, results
+
+    n_workers = max(1, min(n_workers, len(jobs)))
+    log.info("Building %d archives with %d processes", len(jobs), n_workers)
+
+    start = time.time()
+    waiting = list(jobs)
+    running = {}
+    finished = set()
+    failed = set()
+    errors = []
+
+    with ProcessPoolExecutor(
+        max_workers=n_workers,
+        mp_context=multiprocessing.get_context(MP_START_METHOD),
+        initializer=_init_worker,
+        initargs=(logging.getLogger().getEffectiveLevel(), _log_format()),
+    ) as pool:
+        while waiting or running:
+            for job in list(waiting):
+                if any(name in failed for name in job.after):
+                    log.error("Not building %s because a job it needs failed", job.name)
+                    waiting.remove(job)
+                    failed.add(job.name)
+                elif all(name in finished for name in job.after):
+                    waiting.remove(job)
+                    future = pool.submit(_timed_call, job.func, job.args, job.kwargs)
+                    running[future] = job
+
+            if not running:
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                job = running.pop(future)
+                try:
+                    timings[job.name], results[job.name] = future.result()
+                    finished.add(job.name)
+                    log.info("Built %s in %.1f s", job.name, timings[job.name])
+                except Exception as exc:  # pylint: disable=broad-except
+                    log.error("Building %s failed: %s", job.name, exc)
+                    failed.add(job.name)
+                    errors.append(exc)
+
+    log.info("All archives built in %.1f s", time.time() - start)
+
+    if errors:
+        raise errors[0]
+
+    return timings, results
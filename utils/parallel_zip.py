@@ -0,0 +1,335 @@
+"""Write zip files, compressing with many threads.
+
+ZipFile compresses one file after the other on one core.  A ParallelZipWriter cuts
+every file into blocks and compresses the blocks in a thread pool (zlib releases the
+GIL), while one thread writes the compressed blocks to the archive in order.  Each
+block is compressed as a raw DEFLATE stream primed with the end of the previous block
+(as pigz does) and ended with a sync flush, so the blocks of a file put together are
+one ordinary DEFLATE stream: the result is a standard zip file, with ZIP64 records
+where files or the archive are too big for the original format.
+
+How each file is compressed (stored, or the DEFLATE level) is decided by a
+CompressionPolicy, as for the other output archives.
+
+Example:
+    .. code-block:: python
+
+        with ParallelZipWriter(dest_zip, workers=32, policy=policy) as outzip:
+            for path in paths:
+                outzip.write(path, arcname)
+"""
+
+import logging
+import queue
+import struct
+import threading
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor
+from zipfile import ZIP64_LIMIT, ZIP_DEFLATED, ZIP_STORED, ZipInfo
+
+from utils.compression import CompressionPolicy
+
+log = logging.getLogger(__name__)
+
+BLOCK_SIZE = 1024 * 1024
+# DEFLATE can look back this far, so each block is primed with this much
+DICT_SIZE = 32 * 1024
+
+ZIP_FILECOUNT_LIMIT = (1 << 16) - 1
+
+STRUCT_CENTRAL_DIR = "<4s4B4HL2L5H2L"
+STRUCT_END_ARCHIVE = "<4s4H2LH"
+STRUCT_END_ARCHIVE64 = "<4sQ2H2L4Q"
+STRUCT_END_ARCHIVE64_LOCATOR = "<4sLQL"
+
+
+def _deflate_block(data, level, zdict, last):
+    """Compress one block as raw DEFLATE, ending on a byte boundary unless last."""
+    if zdict:
+        compressor = zlib.compressobj(
+            level, zlib.DEFLATED, -15, 9, zlib.Z_DEFAULT_STRATEGY, zdict
+        )
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15, 9)
+    return compressor.compress(data) + compressor.flush(
+        zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH
+    )
+
+
+def _done(value):
+    future = Future()
+    future.set_result(value)
+    return future
+
+
+class ParallelZipWriter:
+    """Write a zip file, compressing the files' blocks in a pool of threads.
+
+    Files are written in the order they are given.  Memory use is bounded by the
+    number of blocks waiting to be written (a few per worker).
+
+    Args:
+        filename (str or Path): the zip file to create
+        workers (int): number of compressing threads
+        policy (CompressionPolicy): how to compress each file
+        block_size (int): bytes of a file compressed by one task
+    """
+
+    def __init__(self, filename, workers=1, policy=None, block_size=BLOCK_SIZE):
+        self.filename = filename
+        self.policy = policy or CompressionPolicy()
+        self.block_size = block_size
+        self.filelist = []
+        self._fp = open(filename, "wb")
+        self._pool = ThreadPoolExecutor(max_workers=max(1, workers))
+        self._queue = queue.Queue(maxsize=4 * max(1, workers))
+        self._error = None
+        self._writer = threading.Thread(
+            target=self._write_loop, name="zip-writer", daemon=True
+        )
+        self._writer.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _put(self, item):
+        if self._error:
+            raise self._error
+        self._queue.put(item)
+
+    def write(self, filename, arcname=None):
+        """Add a file (or a directory entry) to the archive."""
+        zinfo = ZipInfo.from_file(filename, arcname)
+
+        if zinfo.is_dir():
+            zinfo.compress_type = ZIP_STORED
+            zinfo.CRC = zinfo.compress_size = zinfo.file_size = 0
+            self._put(("member", zinfo, False))
+            self._put(("end", zinfo, 0, 0, None, False))
+            return
+
+        decision, compress_type, level = self.policy.choose(filename)
+        zinfo.compress_type = compress_type
+        # filled in once the file is written
+        zinfo.CRC = zinfo.compress_size = 0
+        # as ZipFile does, use ZIP64 for files that could get near the limit
+        zip64 = zinfo.file_size * 1.05 > ZIP64_LIMIT
+        self._put(("member", zinfo, zip64))
+
+        try:
+            crc, size = self._queue_blocks(filename, zinfo, compress_type, level)
+        except Exception as exc:
+            # the member was started, so the archive cannot be finished
+            self._error = self._error or exc
+            raise
+        self._put(("end", zinfo, crc, size, decision, zip64))
+
+    def write_staged(self, filename, arcname, staged):
+        """Add a file that was already compressed (see utils.incremental_zip).
+
+        The compressed data is copied from the staged fragment as it is.
+
+        Args:
+            filename (str): the file (for its name, time and permissions)
+            arcname (str): its name in the archive
+            staged (StagedFile): where its compressed data is, its CRC and sizes
+        """
+        zinfo = ZipInfo.from_file(filename, arcname)
+        zinfo.compress_type = staged.compress_type
+        zinfo.CRC = zinfo.compress_size = 0
+        zinfo.file_size = staged.file_size
+        zip64 = staged.file_size * 1.05 > ZIP64_LIMIT
+        self._put(("member", zinfo, zip64))
+        try:
+            with open(staged.fragment, "rb") as fp:
+                fp.seek(staged.offset)
+                left = staged.compress_size
+                while left > 0:
+                    block = fp.read(min(left, self.block_size))
+                    if not block:
+                        raise EOFError(f"{staged.fragment} is truncated")
+                    left -= len(block)
+                    self._put(("block", zinfo, _done(block)))
+        except Exception as exc:
+            self._error = self._error or exc
+            raise
+        self._put(
+            ("end", zinfo, staged.crc, staged.file_size, staged.decision, zip64)
+        )
+
+    def _queue_blocks(self, filename, zinfo, compress_type, level):
+        """Read a file, queue its (compressing) blocks, return its CRC and size."""
+        crc = 0
+        size = 0
+        zdict = None
+        with open(filename, "rb") as fp:
+            block = fp.read(self.block_size)
+            while True:
+                next_block = fp.read(self.block_size) if block else b""
+                last = not next_block
+                crc = zlib.crc32(block, crc)
+                size += len(block)
+                if compress_type == ZIP_DEFLATED:
+                    future = self._pool.submit(
+                        _deflate_block,
+                        block,
+                        -1 if level is None else level,
+                        zdict,
+                        last,
+                    )
+                    zdict = block[-DICT_SIZE:]
+                else:
+                    future = _done(block)
+                self._put(("block", zinfo, future))
+                if last:
+                    break
+                block = next_block
+        return crc, size
+
+    def _write_loop(self):
+        """Write the queued headers and blocks in order (in the writer thread)."""
+        while True:
+            item = self._queue.get()
+            kind, zinfo = item[0], item[1]
+            if kind == "close":
+                return
+            if self._error:
+                continue  # keep draining, so write() does not block
+            try:
+                if kind == "member":
+                    self._start_member(zinfo, item[2])
+                elif kind == "block":
+                    data = item[2].result()
+                    self._fp.write(data)
+                    zinfo.compress_size += len(data)
+                else:
+                    self._end_member(zinfo, *item[2:])
+            except Exception as exc:  # pylint: disable=broad-except
+                self._error = exc
+
+    def _start_member(self, zinfo, zip64):
+        zinfo.header_offset = self._fp.tell()
+        self._fp.write(zinfo.FileHeader(zip64))
+
+    def _end_member(self, zinfo, crc, size, decision, zip64):
+        zinfo.CRC = crc
+        zinfo.file_size = size
+        if not zip64 and (size > ZIP64_LIMIT or zinfo.compress_size > ZIP64_LIMIT):
+            raise RuntimeError(f"{zinfo.filename} grew too big while it was zipped")
+        # go back and write the sizes and CRC in the local header
+        end = self._fp.tell()
+        self._fp.seek(zinfo.header_offset)
+        self._fp.write(zinfo.FileHeader(zip64))
+        self._fp.seek(end)
+        self.filelist.append(zinfo)
+        if decision:
+            self.policy.record(decision, zinfo)
+
+    def _write_central_directory(self):
+        start_dir = self._fp.tell()
+        for zinfo in self.filelist:
+            extra = []
+            file_size, compress_size = zinfo.file_size, zinfo.compress_size
+            header_offset = zinfo.header_offset
+            if file_size > ZIP64_LIMIT or compress_size > ZIP64_LIMIT:
+                extra += [file_size, compress_size]
+                file_size = compress_size = 0xFFFFFFFF
+            if header_offset > ZIP64_LIMIT:
+                extra.append(header_offset)
+                header_offset = 0xFFFFFFFF
+
+            extra_data = zinfo.extra
+            min_version = 0
+            if extra:
+                extra_data = (
+                    struct.pack("<HH" + "Q" * len(extra), 1, 8 * len(extra), *extra)
+                    + extra_data
+                )
+                min_version = 45
+            extract_version = max(min_version, zinfo.extract_version)
+            create_version = max(min_version, zinfo.create_version)
+            filename, flag_bits = zinfo._encodeFilenameFlags()  # pylint: disable=W0212
+            dostime = zinfo.date_time[3] << 11 | zinfo.date_time[4] << 5 | (
+                zinfo.date_time[5] // 2
+            )
+            dosdate = (
+                (zinfo.date_time[0] - 1980) << 9
+                | zinfo.date_time[1] << 5
+                | zinfo.date_time[2]
+            )
+            centdir = struct.pack(
+                STRUCT_CENTRAL_DIR,
+                b"PK\001\002",
+                create_version,
+                zinfo.create_system,
+                extract_version,
+                zinfo.reserved,
+                flag_bits,
+                zinfo.compress_type,
+                dostime,
+                dosdate,
+                zinfo.CRC,
+                compress_size,
+                file_size,
+                len(filename),
+                len(extra_data),
+                len(zinfo.comment),
+                0,
+                zinfo.internal_attr,
+                zinfo.external_attr,
+                header_offset,
+            )
+            self._fp.write(centdir + filename + extra_data + zinfo.comment)
+
+        end_dir = self._fp.tell()
+        count = len(self.filelist)
+        size_dir = end_dir - start_dir
+        if (
+            count > ZIP_FILECOUNT_LIMIT
+            or start_dir > ZIP64_LIMIT
+            or size_dir > ZIP64_LIMIT
+        ):
+            self._fp.write(
+                struct.pack(
+                    STRUCT_END_ARCHIVE64,
+                    b"PK\x06\x06",
+                    44,
+                    45,
+                    45,
+                    0,
+                    0,
+                    count,
+                    count,
+                    size_dir,
+                    start_dir,
+                )
+            )
+            self._fp.write(
+                struct.pack(STRUCT_END_ARCHIVE64_LOCATOR, b"PK\x06\x07", 0, end_dir, 1)
+            )
+            count = min(count, 0xFFFF)
+            size_dir = min(size_dir, 0xFFFFFFFF)
+            start_dir = min(start_dir, 0xFFFFFFFF)
+        self._fp.write(
+            struct.pack(
+                STRUCT_END_ARCHIVE, b"PK\005\006", 0, 0, count, count, size_dir, start_dir, 0
+            )
+        )
+
+    def close(self):
+        """Finish writing, then write the central directory."""
+        if self._fp is None:
+            return
+        try:
+            self._queue.put(("close", None))
+            self._writer.join()
+            self._pool.shutdown()
+            if self._error:
+                raise self._error
+            self._write_central_directory()
+        finally:
+            self._fp.close()
+            self._fp = None
@@ -0,0 +1,241 @@
+"""Report what each qsirecon node used, from nipype's resource monitor.
+
+The gear always runs qsirecon with --resource-monitor.  nipype then writes, for every
+workflow it ran, ``<work dir>/<workflow>/resource_monitor.json``: samples of the
+memory (GiB) and CPUs used by every node while it ran.  If the nodes' status
+callback was logged (``callback.log``, one JSON object per line), it also says how
+much memory and how many threads each node asked for.
+
+For every node, this adds up the runtime, peak memory and mean CPUs used, and flags
+the nodes that asked for far more memory or threads than they used: those are what
+to look at when tuning n_cpus and mem_mb for a recon-spec.  The report is written as
+JSON and as an HTML table (which is zipped with the other html reports).
+
+Example:
+    .. code-block:: python
+
+        summary = write_resource_report(work_dir, html_dir)
+"""
+
+import glob
+import html
+import json
+import logging
+import os
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+REPORT_NAME = "resource_report"
+
+# a node is flagged when it asked for at least this many times what it used...
+OVER_REQUEST_FACTOR = 2.0
+# ...and the difference is at least this much
+MIN_WASTED_GB = 1.0
+MIN_WASTED_THREADS = 2
+
+
+def find_profiles(work_dir):
+    """The resource monitor files and callback logs in the app's work dir.
+
+    nipype writes them at the top of each workflow's directory, so only the first
+    levels of the (big) work dir are searched.
+
+    Returns:
+        monitor_files (list of str), callback_logs (list of str)
+    """
+    monitor_files = []
+    callback_logs = []
+    for depth in ("", "*", os.path.join("*", "*")):
+        monitor_files += glob.glob(
+            os.path.join(work_dir, depth, "resource_monitor.json")
+        )
+        callback_logs += glob.glob(os.path.join(work_dir, depth, "callback.log"))
+    return sorted(monitor_files), sorted(callback_logs)
+
+
+def _node_entry(nodes, name):
+    return nodes.setdefault(
+        name,
+        {
+            "runtime (s)": 0.0,
+            "peak memory (GiB)": 0.0,
+            "mean cpus": 0.0,
+            "requested memory (GiB)": None,
+            "requested threads": None,
+            "samples": 0,
+        },
+    )
+
+
+def load_resource_monitor(path, nodes):
+    """Add the samples of a nipype resource_monitor.json to nodes (by node name).
+
+    A file that cannot be read (e.g. left truncated by a run that crashed) is
+    skipped, with a warning.
+    """
+    try:
+        with open(path) as fp:
+            data = json.load(fp)
+
+        samples = {}
+        for ii, name in enumerate(data.get("name", [])):
+            # iterables run the same node with different parameters
+            params = data.get("params", [""] * len(data["name"]))[ii]
+            key = f"{name}[{params}]" if params else name
+            samples.setdefault(key, []).append(
+                (data["time"][ii], data["rss_GiB"][ii], data["cpus"][ii])
+            )
+    except (OSError, ValueError, KeyError, IndexError) as exc:
+        log.warning("Skipping unreadable resource monitor file %s: %s", path, exc)
+        return
+
+    for name, node_samples in samples.items():
+        entry = _node_entry(nodes, name)
+        times = [ss[0] for ss in node_samples]
+        entry["runtime (s)"] = max(entry["runtime (s)"], max(times) - min(times))
+        entry["peak memory (GiB)"] = max(
+            entry["peak memory (GiB)"], max(ss[1] for ss in node_samples)
+        )
+        # cpus is a percentage in the monitor's samples
+        entry["mean cpus"] = sum(ss[2] for ss in node_samples) / len(node_samples) / 100
+        entry["samples"] += len(node_samples)
+
+
+def load_callback_log(path, nodes):
+    """Add what nodes asked for (and used) from a nipype status callback log."""
+    try:
+        with open(path) as fp:
+            records = []
+            for line in fp:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+    except OSError as exc:
+        log.warning("Skipping unreadable callback log %s: %s", path, exc)
+        return
+
+    for record in records:
+        if not isinstance(record, dict):
+            continue
+        if record.get("status") != "end" or "name" not in record:
+            continue
+        entry = _node_entry(nodes, record["name"])
+        entry["requested memory (GiB)"] = record.get("estimated_memory_gb")
+        entry["requested threads"] = record.get("num_threads")
+        if record.get("runtime_memory_gb"):
+            entry["peak memory (GiB)"] = max(
+                entry["peak memory (GiB)"], float(record["runtime_memory_gb"])
+            )
+        if record.get("runtime_threads") and not entry["samples"]:
+            entry["mean cpus"] = float(record["runtime_threads"])
+        if record.get("duration") and not entry["runtime (s)"]:
+            entry["runtime (s)"] = float(record["duration"])
+
+
+def flag_nodes(nodes):
+    """Mark the nodes that asked for far more memory or threads than they used."""
+    for entry in nodes.values():
+        flags = []
+        requested_gb = entry["requested memory (GiB)"]
+        used_gb = entry["peak memory (GiB)"]
+        if (
+            requested_gb
+            and requested_gb >= OVER_REQUEST_FACTOR * used_gb
+            and requested_gb - used_gb >= MIN_WASTED_GB
+        ):
+            flags.append("memory")
+        requested_threads = entry["requested threads"]
+        used_threads = max(entry["mean cpus"], 1.0)
+        if (
+            requested_threads
+            and requested_threads >= OVER_REQUEST_FACTOR * used_threads
+            and requested_threads - used_threads >= MIN_WASTED_THREADS
+        ):
+            flags.append("threads")
+        entry["over-requested"] = flags
+
+
+def _html_table(nodes):
+    columns = [
+        "runtime (s)",
+        "peak memory (GiB)",
+        "requested memory (GiB)",
+        "mean cpus",
+        "requested threads",
+        "over-requested",
+    ]
+    rows = []
+    for name, entry in nodes.items():
+        cells = [html.escape(name)]
+        for column in columns:
+            value = entry[column]
+            if isinstance(value, float):
+                value = f"{value:.2f}"
+            elif isinstance(value, list):
+                value = ", ".join(value)
+            cells.append(html.escape("" if value is None else str(value)))
+        style = ' style="background:#fdd"' if entry["over-requested"] else ""
+        rows.append(
+            f"<tr{style}>" + "".join(f"<td>{cell}</td>" for cell in cells) + "</tr>"
+        )
+    header = "".join(f"<th>{html.escape(col)}</th>" for col in ["node"] + columns)
+    return (
+        "<html>\n<head>\n<meta charset=\"UTF-8\">\n"
+        "<title>qsirecon resource report</title>\n</head>\n<body>\n"
+        "<h1>qsirecon resource report</h1>\n"
+        "<p>Nodes in red asked for at least "
+        f"{OVER_REQUEST_FACTOR:g} times the memory or threads they used.</p>\n"
+        f"<table border=\"1\">\n<tr>{header}</tr>\n" + "\n".join(rows) + "\n</table>\n"
+        "</body>\n</html>\n"
+    )
+
+
+def write_resource_report(work_dir, report_dir):
+    """Write resource_report.json and .html for the nodes qsirecon ran.
+
+    Args:
+        work_dir (str or Path): the app's (nipype) work directory
+        report_dir (str or Path): where to write the report (next to qsirecon's html)
+
+    Returns:
+        summary (dict) for the analysis metadata, or None if nipype did not record
+        any resources
+    """
+    monitor_files, callback_logs = find_profiles(work_dir)
+    nodes = {}
+    for path in monitor_files:
+        load_resource_monitor(path, nodes)
+    for path in callback_logs:
+        load_callback_log(path, nodes)
+    if not nodes:
+        log.info("No nipype resource monitor output found in %s", work_dir)
+        return None
+
+    flag_nodes(nodes)
+    # longest running first
+    nodes = dict(sorted(nodes.items(), key=lambda item: -item[1]["runtime (s)"]))
+
+    report_dir = Path(report_dir)
+    report_dir.mkdir(parents=True, exist_ok=True)
+    with open(report_dir / f"{REPORT_NAME}.json", "w") as fp:
+        json.dump(nodes, fp, indent=1)
+    with open(report_dir / f"{REPORT_NAME}.html", "w", encoding="utf8") as fp:
+        fp.write(_html_table(nodes))
+    log.info("Wrote resource report for %d nodes in %s", len(nodes), report_dir)
+
+    return {
+        "nodes": len(nodes),
+        "peak memory (GiB)": round(
+            max(entry["peak memory (GiB)"] for entry in nodes.values()), 2
+        ),
+        "over-requested memory": [
+            name for name, entry in nodes.items() if "memory" in entry["over-requested"]
+        ],
+        "over-requested threads": [
+            name
+            for name, entry in nodes.items()
+            if "threads" in entry["over-requested"]
+        ],
+    }
@@ -0,0 +1,214 @@
+"""Sample the resources used by the processes the gear starts.
+
+A background thread follows all descendants of the gear's process (so it does not
+need to know qsirecon's pid) and, every few seconds, records how many processes and
+threads are running, how much CPU they used since the last sample (processes that
+started and ended in between included), their resident memory and how many bytes
+they have read and written so far.  Each sample is
+appended to a CSV file right away, and a summary with percentiles is available at
+the end, which shows where the cores sat idle.
+
+Example:
+    .. code-block:: python
+
+        with ResourceSampler("output/resource_usage.csv", interval=10) as sampler:
+            exec_command(command)
+        summary = sampler.summary()
+"""
+
+import csv
+import logging
+import os
+import threading
+import time
+from array import array
+
+import psutil
+
+log = logging.getLogger(__name__)
+
+CSV_COLUMNS = [
+    "elapsed_s",
+    "processes",
+    "threads",
+    "cpu_percent",
+    "rss_mb",
+    "read_mb",
+    "write_mb",
+]
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a sequence of numbers (0 if empty)."""
+    if not values:
+        return 0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[rank]
+
+
+class ResourceSampler(threading.Thread):
+    """Thread that samples the resources used by the descendants of a process.
+
+    Args:
+        csv_path (str or Path): file to write the time series to
+        interval (float): seconds between samples
+        root_pid (int): process whose descendants are followed (default: this one)
+    """
+
+    def __init__(self, csv_path, interval=10, root_pid=None):
+        super().__init__(name="resource-sampler", daemon=True)
+        self.csv_path = csv_path
+        self.interval = interval
+        self.root = psutil.Process(root_pid or os.getpid())
+        self._stop_event = threading.Event()
+        self._start_time = None
+        self._last_time = None
+        # per (pid, create_time): (read bytes, write bytes) so far
+        self._seen = {}
+        # CPU seconds of the descendants at the last sample
+        self._last_cpu = 0.0
+        self.cpu_percent = array("f")
+        self.rss_mb = array("f")
+        self.threads = array("l")
+        self.processes = array("l")
+        self.read_mb = 0.0
+        self.write_mb = 0.0
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def stop(self):
+        """Take a last sample and wait for the thread to end."""
+        self._stop_event.set()
+        if self.is_alive():
+            self.join()
+
+    @staticmethod
+    def _cpu_seconds(proc, own=True):
+        """CPU time of a process (if own) and of the children it has waited for."""
+        times = proc.cpu_times()
+        cpu = times.children_user + times.children_system
+        return cpu + times.user + times.system if own else cpu
+
+    def run(self):
+        self._start_time = self._last_time = time.time()
+        self._last_cpu = self._tree_cpu_seconds()
+        with open(self.csv_path, "w", newline="") as fp:
+            writer = csv.writer(fp)
+            writer.writerow(CSV_COLUMNS)
+            while not self._stop_event.wait(self.interval):
+                writer.writerow(self.sample())
+                fp.flush()
+            writer.writerow(self.sample())
+
+    def _children(self):
+        try:
+            return self.root.children(recursive=True)
+        except psutil.Error:
+            return []
+
+    def _tree_cpu_seconds(self, children=None):
+        """CPU time used by the descendants of the root so far.
+
+        A process that ended counts in the children times of its parent once it was
+        waited for, and the root's children times hold all the ones that ended
+        below it: processes too short lived to be seen by a sample count as well.
+        """
+        try:
+            total = self._cpu_seconds(self.root, own=False)
+        except psutil.Error:
+            total = 0.0
+        for proc in self._children() if children is None else children:
+            try:
+                total += self._cpu_seconds(proc)
+            except psutil.Error:
+                continue
+        return total
+
+    def sample(self):
+        """Measure the current process tree and return a CSV row."""
+        now = time.time()
+        rss = 0
+        threads = 0
+        processes = 0
+        children = self._children()
+
+        for proc in children:
+            try:
+                with proc.oneshot():
+                    key = (proc.pid, proc.create_time())
+                    rss += proc.memory_info().rss
+                    threads += proc.num_threads()
+                    try:
+                        io = proc.io_counters()
+                        read, write = io.read_bytes, io.write_bytes
+                    except (psutil.AccessDenied, AttributeError):
+                        read = write = 0
+            except psutil.Error:
+                continue
+            processes += 1
+            last_read, last_write = self._seen.get(key, (0, 0))
+            self.read_mb += (read - last_read) / 1024**2
+            self.write_mb += (write - last_write) / 1024**2
+            self._seen[key] = (read, write)
+
+        cpu = self._tree_cpu_seconds(children)
+        # a zombie's time is missing until it is waited for, never count it twice
+        cpu_seconds = max(0.0, cpu - self._last_cpu)
+        self._last_cpu = max(cpu, self._last_cpu)
+        wall = max(now - self._last_time, 1e-6)
+        self._last_time = now
+        cpu_percent = 100 * cpu_seconds / wall
+
+        self.cpu_percent.append(cpu_percent)
+        self.rss_mb.append(rss / 1024**2)
+        self.threads.append(threads)
+        self.processes.append(processes)
+
+        return [
+            round(now - self._start_time, 1),
+            processes,
+            threads,
+            round(cpu_percent, 1),
+            round(rss / 1024**2, 1),
+            round(self.read_mb, 1),
+            round(self.write_mb, 1),
+        ]
+
+    def summary(self, n_cpus=None):
+        """Percentiles of the samples and totals, for the analysis metadata.
+
+        Args:
+            n_cpus (int): number of CPUs the app was given, to report idle cores
+
+        Returns:
+            summary (dict)
+        """
+        summary = {
+            "samples": len(self.cpu_percent),
+            "sample interval (s)": self.interval,
+            "total read (MiB)": round(self.read_mb, 1),
+            "total written (MiB)": round(self.write_mb, 1),
+        }
+        for name, values in [
+            ("cpu percent", self.cpu_percent),
+            ("rss (MiB)", self.rss_mb),
+            ("threads", self.threads),
+            ("processes", self.processes),
+        ]:
+            summary[name] = {
+                f"p{pct}": round(percentile(values, pct), 1) for pct in (50, 90, 99)
+            }
+            summary[name]["max"] = round(max(values, default=0), 1)
+
+        if n_cpus and self.cpu_percent:
+            mean_busy = sum(self.cpu_percent) / len(self.cpu_percent) / 100
+            summary["mean busy cores"] = round(mean_busy, 2)
+            summary["mean idle cores"] = round(max(0, n_cpus - mean_busy), 2)
+
+        return summary
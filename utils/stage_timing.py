@@ -0,0 +1,233 @@
+"""Time qsirecon's workflow nodes from its log, while it runs.
+
+nipype logs a line when a node is set up, when it finishes (with the elapsed time)
+and when its results are reused from the cache, e.g.::
+
+    241018-12:34:56,123 nipype.workflow INFO:
+         [Node] Setting-up "qsirecon_wf.sub-01_dwi_recon_wf.fit_dti" in "/work/..."
+    241018-12:41:02,456 nipype.workflow INFO:
+         [Node] Finished "fit_dti", elapsed time 366.33s.
+
+The command's output is read one line at a time (and echoed to the gear log), so it
+is never held in memory.  StageTimer keeps one entry per node, and at the end gives
+the nodes that took longest, the time spent in each workflow and the critical path:
+the longest chain of nodes that ran one after another.  That is what the run could
+not have gone faster than, however many CPUs it had.
+
+Example:
+    .. code-block:: python
+
+        timer = StageTimer()
+        stream_command(command, environ=os.environ, on_line=timer.feed)
+        timer.write_csv("output/stage_timings.csv")
+        summary = timer.summary()
+"""
+
+import bisect
+import collections
+import csv
+import datetime
+import logging
+import re
+import subprocess as sp
+import sys
+
+log = logging.getLogger(__name__)
+
+# 241018-12:34:56,123
+TIMESTAMP_RE = re.compile(r"^(\d{6}-\d{2}:\d{2}:\d{2},\d{3}) ")
+SETTING_UP_RE = re.compile(r'\[Node\] Setting-up "([^"]+)"')
+FINISHED_RE = re.compile(r'\[Node\] Finished "([^"]+)"(?:, elapsed time ([\d.]+)s)?')
+CACHED_RE = re.compile(r'\[Node\] Cached "([^"]+)"')
+
+CSV_COLUMNS = ["node", "workflow", "start", "end", "seconds", "cached"]
+
+# lines of output kept to explain a failure
+TAIL_LINES = 50
+
+
+def _parse_timestamp(text):
+    return datetime.datetime.strptime(text, "%y%m%d-%H:%M:%S,%f").timestamp()
+
+
+def stream_command(command, environ=None, on_line=None, shell=True):
+    """Run a command, passing each line of its output to on_line as it comes.
+
+    stdout and stderr are merged and echoed, like exec_command(cont_output=True)
+    does, but only the last TAIL_LINES lines are kept, for the error message.
+
+    Args:
+        command (list of str): command to run
+        environ (dict): environment for the command
+        on_line (callable): called with every line of output
+        shell (bool): run the command (joined with spaces) in a shell
+
+    Raises:
+        RuntimeError: if the command returns a non-zero exit status
+    """
+    run_command = " ".join(command) if shell else command
+    log.info("Executing command: \n %s", run_command)
+
+    tail = collections.deque(maxlen=TAIL_LINES)
+    with sp.Popen(
+        run_command,
+        stdout=sp.PIPE,
+        stderr=sp.STDOUT,
+        universal_newlines=True,
+        errors="replace",
+        env=environ,
+        shell=shell,
+    ) as proc:
+        for line in proc.stdout:
+            sys.stdout.write(line)
+            tail.append(line)
+            if on_line:
+                on_line(line)
+        returncode = proc.wait()
+
+    if returncode != 0:
+        log.error("The command:\n %s\nfailed with return code %d", run_command, returncode)
+        raise RuntimeError("".join(tail))
+
+
+class StageTimer:
+    """Collect the start and end time of every nipype node from its log lines."""
+
+    def __init__(self):
+        self._last_time = None
+        # by node name: [start, end, seconds, cached]
+        self.nodes = {}
+
+    def feed(self, line):
+        """Read one line of the app's output."""
+        match = TIMESTAMP_RE.match(line)
+        if match:
+            # the [Node] message follows the line with the time stamp
+            self._last_time = _parse_timestamp(match.group(1))
+            if "[Node]" not in line:
+                return
+
+        match = SETTING_UP_RE.search(line)
+        if match:
+            self.nodes[match.group(1)] = [self._last_time, None, None, False]
+            return
+
+        match = CACHED_RE.search(line)
+        if match:
+            node = self._node(match.group(1))
+            node[1], node[2], node[3] = self._last_time, 0.0, True
+            return
+
+        match = FINISHED_RE.search(line)
+        if match:
+            node = self._node(match.group(1))
+            node[1] = self._last_time
+            if match.group(2):
+                node[2] = float(match.group(2))
+            elif node[0] is not None and node[1] is not None:
+                node[2] = node[1] - node[0]
+
+    def _node(self, name):
+        """The entry of a node, matching the short names some messages use."""
+        if name in self.nodes:
+            return self.nodes[name]
+        # Finished messages may only have the last part of the name
+        for full_name in reversed(list(self.nodes)):
+            if full_name.endswith("." + name) and self.nodes[full_name][1] is None:
+                return self.nodes[full_name]
+        self.nodes[name] = [None, None, None, False]
+        return self.nodes[name]
+
+    def finished(self):
+        """(name, start, end, seconds, cached) of the nodes that finished."""
+        rows = []
+        for name, (start, end, seconds, cached) in self.nodes.items():
+            if seconds is None:
+                continue
+            if start is None and end is not None:
+                start = end - seconds
+            if end is None and start is not None:
+                end = start + seconds
+            rows.append((name, start, end, seconds, cached))
+        return rows
+
+    def critical_path(self):
+        """Longest (in time) chain of nodes that each started after the last ended.
+
+        Returns:
+            seconds (float), names (list of str)
+        """
+        rows = sorted(
+            (row for row in self.finished() if row[1] is not None and not row[4]),
+            key=lambda row: row[2],
+        )
+        ends = [row[2] for row in rows]
+        # best[i]: longest chain ending with one of the first i nodes
+        best = [(0.0, None)]
+        previous = {}
+        for ii, (name, start, _, seconds, _) in enumerate(rows):
+            jj = bisect.bisect_right(ends, start, 0, ii)
+            with_node = best[jj][0] + seconds
+            if with_node > best[ii][0]:
+                previous[ii] = best[jj][1]
+                best.append((with_node, ii))
+            else:
+                best.append(best[ii])
+
+        total, last = best[-1]
+        names = []
+        while last is not None:
+            names.append(rows[last][0])
+            last = previous[last]
+        return total, names[::-1]
+
+    def write_csv(self, csv_path):
+        """Write the nodes, longest first, to a CSV file."""
+        with open(csv_path, "w", newline="") as fp:
+            writer = csv.writer(fp)
+            writer.writerow(CSV_COLUMNS)
+            for name, start, end, seconds, cached in sorted(
+                self.finished(), key=lambda row: -row[3]
+            ):
+                writer.writerow(
+                    [
+                        name,
+                        name.rpartition(".")[0],
+                        "" if start is None else round(start, 3),
+                        "" if end is None else round(end, 3),
+                        round(seconds, 3),
+                        cached,
+                    ]
+                )
+        log.info("Wrote %s", csv_path)
+
+    def summary(self, top=10):
+        """Slowest nodes, time per workflow and the critical path, for the metadata.
+
+        Returns:
+            summary (dict)
+        """
+        rows = self.finished()
+        workflows = collections.Counter()
+        for name, _, _, seconds, _ in rows:
+            workflows[name.rpartition(".")[0] or name] += seconds
+
+        path_seconds, path = self.critical_path()
+        starts = [row[1] for row in rows if row[1] is not None]
+        ends = [row[2] for row in rows if row[2] is not None]
+        return {
+            "nodes": len(rows),
+            "cached nodes": sum(1 for row in rows if row[4]),
+            "wall time (s)": round(max(ends) - min(starts), 1) if starts else 0,
+            "slowest nodes (s)": {
+                name: round(seconds, 1)
+                for name, _, _, seconds, _ in sorted(rows, key=lambda row: -row[3])[
+                    :top
+                ]
+            },
+            "workflows (s)": {
+                name: round(seconds, 1) for name, seconds in workflows.most_common(top)
+            },
+            "critical path (s)": round(path_seconds, 1),
+            "critical path": path,
+        }
@@ -0,0 +1,147 @@
+"""Stage the TemplateFlow templates baked into the container.
+
+qsirecon needs a writable TEMPLATEFLOW_HOME, but the templates that ship in the
+image are several GB, so copying them on every job start is slow.  Instead, build
+a "link farm": real directories with symlinks to the baked-in files.  Only the
+files that TemplateFlow will write to (the empty placeholder files it fills in
+when a template is fetched on demand) are copied.
+
+A manifest of the baked-in templates is kept in the staged directory, so when the
+same directory is reused (e.g. a per-node shared directory), nothing is done unless
+the templates changed.
+
+Example:
+    .. code-block:: python
+
+        templateflow_dir = stage_templateflow(
+            Path("/home/qsiprep/.cache/templateflow/"), FWV0 / "templateflow"
+        )
+        os.environ["TEMPLATEFLOW_HOME"] = str(templateflow_dir)
+"""
+
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+MANIFEST_NAME = ".fw_templateflow_manifest"
+LOCK_NAME = ".fw_templateflow.lock"
+
+
+def build_manifest(source_dir):
+    """List all files in source_dir with their size and modification time.
+
+    Args:
+        source_dir (Path): directory with the baked-in templates
+
+    Returns:
+        manifest (list): [relative path, size, mtime_ns] for every file, sorted
+        digest (str): sha1 hex digest of the manifest
+    """
+    manifest = []
+    for root, _, files in os.walk(source_dir):
+        for name in files:
+            full_path = os.path.join(root, name)
+            stat = os.lstat(full_path)
+            rel_path = os.path.relpath(full_path, source_dir)
+            manifest.append([rel_path, stat.st_size, stat.st_mtime_ns])
+    manifest.sort()
+
+    digest = hashlib.sha1(json.dumps(manifest).encode("utf8")).hexdigest()
+
+    return manifest, digest
+
+
+def shared_templateflow_dir(shared_dir, digest):
+    """Name of the per-node directory that holds templates with this digest.
+
+    Args:
+        shared_dir (str or Path): node-local directory shared between jobs
+        digest (str): manifest digest from build_manifest()
+
+    Returns:
+        (Path) directory to use as TEMPLATEFLOW_HOME
+    """
+    return Path(shared_dir) / f"templateflow-{digest[:12]}"
+
+
+def _link_or_copy(src, dst, size):
+    """Symlink src to dst, or copy it if TemplateFlow is going to write to it."""
+    if os.path.lexists(dst):
+        # Already staged, or already fetched by TemplateFlow
+        return "kept"
+
+    if size == 0:
+        # Empty files are placeholders that TemplateFlow downloads into
+        shutil.copy2(src, dst)
+        return "copied"
+
+    os.symlink(src, dst)
+    return "linked"
+
+
+def stage_templateflow(source_dir, templateflow_dir, manifest=None):
+    """Fill templateflow_dir with the templates in source_dir.
+
+    If the manifest stored in templateflow_dir matches source_dir, this returns
+    right away.  Otherwise, directories are created and files are symlinked, except
+    for the empty placeholder files which are copied so TemplateFlow can write them.
+    A lock file makes this safe when several jobs on a node share templateflow_dir.
+
+    Args:
+        source_dir (Path): directory with the baked-in templates
+        templateflow_dir (Path): writable directory to use as TEMPLATEFLOW_HOME
+        manifest (tuple): (manifest, digest) from build_manifest(), if already known
+
+    Returns:
+        templateflow_dir (Path)
+    """
+    source_dir = Path(source_dir).absolute()
+    templateflow_dir = Path(templateflow_dir)
+    templateflow_dir.mkdir(parents=True, exist_ok=True)
+
+    if not source_dir.exists():
+        log.warning("No baked-in templates found at %s", source_dir)
+        return templateflow_dir
+
+    if manifest is None:
+        manifest = build_manifest(source_dir)
+    entries, digest = manifest
+
+    manifest_file = templateflow_dir / MANIFEST_NAME
+
+    with open(templateflow_dir / LOCK_NAME, "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        if manifest_file.exists() and manifest_file.read_text() == digest:
+            log.info("TemplateFlow already staged in %s", templateflow_dir)
+            return templateflow_dir
+
+        log.info(
+            "Staging %d TemplateFlow files from %s to %s",
+            len(entries),
+            source_dir,
+            templateflow_dir,
+        )
+
+        counts = {"linked": 0, "copied": 0, "kept": 0}
+        for rel_path, size, _ in entries:
+            dst = templateflow_dir / rel_path
+            dst.parent.mkdir(parents=True, exist_ok=True)
+            counts[_link_or_copy(source_dir / rel_path, dst, size)] += 1
+
+        log.info(
+            "TemplateFlow staged: %d linked, %d copied, %d already present",
+            counts["linked"],
+            counts["copied"],
+            counts["kept"],
+        )
+
+        manifest_file.write_text(digest)
+
+    return templateflow_dir
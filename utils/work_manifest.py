@@ -0,0 +1,145 @@
+"""Compact record of the files in a directory tree.
+
+The gear remembers which files were unzipped into work/ so they can be excluded
+when the output is zipped.  With 100k+ files, a list of absolute paths is slow to
+search and uses a lot of memory.  WorkDirManifest keeps the relative paths in one
+string and the size, modification time and inode of every file in arrays, with a
+hash table from a 64-bit digest of the path to its index, so "path in manifest"
+is O(1).
+
+Example:
+    .. code-block:: python
+
+        manifest = WorkDirManifest.scan(work_dir)
+        "qsiprep/sub-01/dwi/sub-01_dwi.nii.gz" in manifest  # True
+"""
+
+import hashlib
+import logging
+import os
+from array import array
+
+log = logging.getLogger(__name__)
+
+SEPARATOR = "\0"
+
+
+def _path_key(path):
+    """64-bit digest of a relative path, used as hash table key."""
+    return int.from_bytes(
+        hashlib.blake2b(path.encode("utf-8", "surrogateescape"), digest_size=8).digest(),
+        "little",
+    )
+
+
+class WorkDirManifest:
+    """Relative path, size, mtime and inode of every file under a directory.
+
+    Supports "in", len() and iteration over the relative paths, so it can be
+    passed where a list of paths to exclude is expected.
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self._paths = None
+        self._offsets = array("Q")
+        self._length = 0
+        self.sizes = array("q")
+        self.mtimes = array("q")
+        self.inodes = array("Q")
+        self._index = {}
+        self._collisions = {}
+
+    @classmethod
+    def scan(cls, root_dir):
+        """Record all files under root_dir (like os.walk, not following links).
+
+        Args:
+            root_dir (str or Path): directory to scan
+
+        Returns:
+            manifest (WorkDirManifest)
+        """
+        manifest = cls()
+        root_dir = os.fspath(root_dir)
+        stack = [""]
+        while stack:
+            rel_dir = stack.pop()
+            try:
+                entries = os.scandir(os.path.join(root_dir, rel_dir))
+            except OSError as exc:
+                log.warning("Cannot scan %s: %s", exc.filename, exc.strerror)
+                continue
+            with entries:
+                for entry in entries:
+                    rel_path = os.path.join(rel_dir, entry.name)
+                    try:
+                        is_dir = entry.is_dir()
+                    except OSError:
+                        is_dir = False
+                    if is_dir:
+                        if not entry.is_symlink():
+                            stack.append(rel_path)
+                        continue
+                    stat = entry.stat(follow_symlinks=False)
+                    manifest.add(
+                        rel_path, stat.st_size, stat.st_mtime_ns, stat.st_ino
+                    )
+        log.info("Found %d files in %s", len(manifest), root_dir)
+        return manifest
+
+    def add(self, rel_path, size, mtime_ns, inode):
+        """Record one file."""
+        index = len(self.sizes)
+        key = _path_key(rel_path)
+        if key in self._index:
+            if self.path(self._index[key]) == rel_path:
+                return
+            self._collisions[rel_path] = index
+        else:
+            self._index[key] = index
+        self._chunks.append(rel_path + SEPARATOR)
+        self._offsets.append(self._length)
+        self._length += len(rel_path) + 1
+        self.sizes.append(size)
+        self.mtimes.append(mtime_ns)
+        self.inodes.append(inode)
+
+    def _all_paths(self):
+        if self._chunks:
+            self._paths = (self._paths or "") + "".join(self._chunks)
+            self._chunks = []
+        return self._paths or ""
+
+    def path(self, index):
+        """Relative path of the file at index."""
+        paths = self._all_paths()
+        start = self._offsets[index]
+        return paths[start : paths.index(SEPARATOR, start)]
+
+    def index(self, rel_path):
+        """Index of rel_path, or -1 if it is not in the manifest."""
+        index = self._index.get(_path_key(rel_path))
+        if index is None:
+            return -1
+        if self.path(index) == rel_path:
+            return index
+        return self._collisions.get(rel_path, -1)
+
+    def stat(self, rel_path):
+        """(size, mtime_ns, inode) of rel_path, or None."""
+        index = self.index(rel_path)
+        if index < 0:
+            return None
+        return self.sizes[index], self.mtimes[index], self.inodes[index]
+
+    def __contains__(self, rel_path):
+        return isinstance(rel_path, str) and self.index(rel_path) >= 0
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def __iter__(self):
+        paths = self._all_paths()
+        if paths:
+            yield from paths[:-1].split(SEPARATOR)
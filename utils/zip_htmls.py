@@ -1,100 +1,155 @@
-"""Compress HTML files."""
+"""Compress HTML files.
 
-import datetime
-import glob
+Each html report is zipped (as "index.html", with the files it links to) into its own
+archive, so Flywheel can show it in the browser.  The report directory is not
+modified and the working directory is not changed, so several directories (and
+several reports in a directory) can be zipped at the same time, as long as they do
+not write archives of the same name (see html_archive_jobs).
+"""
+
+import html
 import logging
 import os
+import re
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from bs4 import BeautifulSoup
 from zipfile import ZIP_DEFLATED, ZipFile
 
+from utils.packaging import ArchiveJob
 
 log = logging.getLogger(__name__)
 
+# href of an <a> tag, quoted or not
+A_HREF_RE = re.compile(
+    rb"""<a\s[^>]*?\bhref\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>"']+))""",
+    re.IGNORECASE | re.DOTALL,
+)
+CHUNK_SIZE = 1024 * 1024
+# longest <a ...> tag kept across chunks
+MAX_TAG_SIZE = 64 * 1024
+
+
+def scan_links(html_path):
+    """Yield the href of every <a> tag in an html file, reading it in chunks.
 
-def zip_it_zip_it_good(output_dir, destination_id, name):
+    Only the end of the previous chunk (from its last "<") is kept, so a tag split
+    between two chunks is still found.
+    """
+    tail = b""
+    with open(html_path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(CHUNK_SIZE), b""):
+            data = tail + chunk
+            # a tag that is not closed in this chunk is scanned with the next one
+            cut = data.rfind(b"<")
+            if cut == -1 or data.find(b">", cut) != -1 or len(data) - cut > MAX_TAG_SIZE:
+                cut = len(data)
+            for match in A_HREF_RE.finditer(data, 0, cut):
+                href = match.group(1) or match.group(2) or match.group(3) or b""
+                yield html.unescape(href.decode("utf8", errors="replace"))
+            tail = data[cut:]
+    for match in A_HREF_RE.finditer(tail):
+        href = match.group(1) or match.group(2) or match.group(3) or b""
+        yield html.unescape(href.decode("utf8", errors="replace"))
+
+
+def zip_it_zip_it_good(output_dir, destination_id, html_path):
     """Compress html file into an appropriately named archive file *.html.zip
     files are automatically shown in another tab in the browser. These are
-    saved at the top level of the output folder."""
+    saved at the top level of the output folder.
 
-    name_no_html = name[:-5]  # remove ".html" from end
+    The html file is stored as "index.html", followed by the files it links to that
+    exist (with their paths relative to the html file).
+
+    Returns:
+        dest_zip (str): the archive
+    """
+    html_path = Path(html_path)
+    report_dir = html_path.parent
 
     dest_zip = os.path.join(
-        output_dir, name_no_html + "_" + destination_id + ".html.zip"
+        output_dir, html_path.name[:-5] + "_" + destination_id + ".html.zip"
     )
 
     log.info('Creating viewable archive "' + dest_zip + '"')
-    
-    logging.info("Zipping html at location: %s", os.path.abspath(os.curdir))
-    
-    # find all references in html and include in zip command
-    with open("index.html") as inf:
-        txt = inf.read()
-    soup = BeautifulSoup(txt, 'html.parser')
-
-    # Find the elements in the file and alter path so its relative
-    zipfiles=[]
-    for a in soup.find_all('a'):
-        if os.path.exists(a['href']):
-            zipfiles.append(os.path.relpath(Path(a['href'])))
-    
+
+    # find all references in html and include them
+    zipfiles = []
+    for href in dict.fromkeys(scan_links(html_path)):
+        if href and (report_dir / href).exists():
+            zipfiles.append(os.path.relpath(report_dir / href, report_dir))
+
     with ZipFile(dest_zip, "w", ZIP_DEFLATED) as outzip:
-        outzip.write("index.html")
+        outzip.write(html_path, arcname="index.html")
         for fl in zipfiles:
-            outzip.write(fl)
+            outzip.write(report_dir / fl, arcname=fl)
+
+    return dest_zip
 
 
-def zip_htmls(output_dir, destination_id, path):
+def zip_htmls(output_dir, destination_id, path, workers=1):
     """Zip all .html files at the given path so they can be displayed
     on the Flywheel platform.
-    Each html file must be converted into an archive individually:
-      rename each to be "index.html", then create a zip archive from it.
+    Each html file is converted into an archive individually, as "index.html".
+
+    Args:
+        output_dir (str): where to write the archives
+        destination_id (str): id of the analysis, in the archive names
+        path (str): directory with the html files
+        workers (int): number of archives built at the same time
     """
 
     log.info("Creating viewable archives for all html files")
 
-    if os.path.exists(path):
-
-        log.info("Found path: " + str(path))
-
-        FWV0 = Path.cwd()
-        os.chdir(path)
-
-        html_files = glob.glob("*.html")
-
-        if len(html_files) > 0:
-
-            # if there is an index.html, do it first and re-name it for safe
-            # keeping
-            save_name = ""
-            if os.path.exists("index.html"):
-                log.info("Found index.html")
-                zip_it_zip_it_good(output_dir, destination_id, "index.html")
+    if not os.path.exists(path):
+        log.error("Path NOT found: " + str(path))
+        return
 
-                now = datetime.datetime.now()
-                save_name = now.strftime("%Y-%m-%d_%H-%M-%S") + "_index.html"
-                os.rename("index.html", save_name)
+    log.info("Found path: " + str(path))
 
-                html_files.remove("index.html")  # don't do this one later
+    html_files = sorted(Path(path).glob("*.html"))
+    if not html_files:
+        log.warning("No *.html files at " + str(path))
+        return
 
-            for h_file in html_files:
-                os.rename(h_file, "index.html")
-                try:
-                    zip_it_zip_it_good(output_dir, destination_id, h_file)
-                except:
-                    raise
-                finally:
-                    os.rename("index.html", h_file)
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        archives = list(
+            pool.map(
+                lambda h_file: zip_it_zip_it_good(output_dir, destination_id, h_file),
+                html_files,
+            )
+        )
+    log.info("Created %d viewable archives: %s", len(archives), ", ".join(archives))
 
-            # reestore if necessary
-            if save_name != "":
-                os.rename(save_name, "index.html")
 
-        else:
-            log.warning("No *.html files at " + str(path))
+def html_archive_jobs(output_dir, destination_id, html_dirs):
+    """Archive jobs zipping the html files of each directory (see zip_htmls).
 
-        os.chdir(FWV0)
+    The archives are named after the html files, so two directories with a report
+    of the same name (e.g. sub-<label>.html) write the same archive: a job waits
+    for the last earlier job writing one of its names, and the last directory wins,
+    as when the directories were zipped one after the other.
 
-    else:
+    Args:
+        output_dir (str): where to write the archives
+        destination_id (str): id of the analysis, in the archive names
+        html_dirs (list): directories with html files, in order
 
-        log.error("Path NOT found: " + str(path))
+    Returns:
+        jobs (list of ArchiveJob)
+    """
+    jobs = []
+    writers = {}
+    for html_dir in html_dirs:
+        name = f"html {Path(html_dir).name}"
+        html_names = {path.name for path in Path(html_dir).glob("*.html")}
+        after = sorted({writers[html] for html in html_names if html in writers})
+        jobs.append(
+            ArchiveJob(
+                name,
+                zip_htmls,
+                (str(output_dir), destination_id, str(html_dir)),
+                after=after,
+            )
+        )
+        writers.update(dict.fromkeys(html_names, name))
+    return jobs
@@ -0,0 +1,262 @@
+"""Extract selected members of a remote zip file using HTTP range requests.
+
+A QSIPrep analysis zip can hold many subjects, reports and figures that the
+recon-spec never reads.  Instead of downloading the whole archive, the central
+directory at the end of the file is read with a couple of range requests, the
+members that are needed are picked from it, and only those are fetched.
+
+Any HTTP server that honors "Range" headers can be used, so this can be run
+against a local server as well as the Flywheel API.
+
+Example:
+    .. code-block:: python
+
+        select = member_selector(participant_label="TOME3024")
+        fetch_zip_members(url, work_dir, select, headers=headers, strip_top_dir=True)
+"""
+
+import logging
+import re
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from zipfile import ZipFile
+
+from utils.zip_stream import CHUNK_SIZE, apply_central_directory, member_destination
+
+log = logging.getLogger(__name__)
+
+READ_AHEAD = 64 * 1024
+
+# Files that qsirecon reads from QSIPrep derivatives: dataset level metadata, the
+# preprocessed dwi (with gradients, references and masks) and the preprocessed anat
+# (with masks, segmentations and transforms).  Reports, figures and logs are skipped.
+RECON_INPUT_PATTERNS = [
+    r"(^|/)dataset_description\.json$",
+    r"(^|/)\.bidsignore$",
+    r"/anat/[^/]+$",
+    r"/dwi/[^/]+$",
+]
+
+
+class RangeNotSupported(Exception):
+    """The server does not honor range requests."""
+
+
+class HttpRangeReader:
+    """Read-only, seekable file object backed by HTTP range requests.
+
+    Args:
+        url (str): URL of the file
+        headers (dict): extra headers to send with each request (e.g. authorization)
+        size (int): size of the file, if known
+        retries (int): number of times to retry a failed request
+    """
+
+    def __init__(self, url, headers=None, size=None, retries=3):
+        self.url = url
+        self.headers = headers or {}
+        self.retries = retries
+        self.position = 0
+        self.num_requests = 0
+        self.bytes_fetched = 0
+        self._buffer = b""
+        self._buffer_start = 0
+        self.size = size if size is not None else self._get_size()
+
+    def _request(self, first, last):
+        request = urllib.request.Request(
+            self.url, headers={**self.headers, "Range": f"bytes={first}-{last}"}
+        )
+        for attempt in range(self.retries):
+            try:
+                with urllib.request.urlopen(request) as response:
+                    if response.status != 206:
+                        raise RangeNotSupported(
+                            f"Range request returned HTTP {response.status}"
+                        )
+                    content_range = response.headers.get("Content-Range", "")
+                    data = response.read()
+                self.num_requests += 1
+                self.bytes_fetched += len(data)
+                return data, content_range
+            except OSError as exc:
+                if attempt == self.retries - 1:
+                    raise
+                log.warning("Range request failed (%s), retrying", exc)
+                time.sleep(2**attempt)
+
+    def _get_size(self):
+        _, content_range = self._request(0, 0)
+        # "bytes 0-0/<size>"
+        return int(content_range.rsplit("/", 1)[1])
+
+    def seekable(self):
+        return True
+
+    def readable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=0):
+        if whence == 0:
+            self.position = offset
+        elif whence == 1:
+            self.position += offset
+        else:
+            self.position = self.size + offset
+        return self.position
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size - self.position
+        size = min(size, self.size - self.position)
+        if size <= 0:
+            return b""
+
+        offset = self.position - self._buffer_start
+        if offset < 0 or offset + size > len(self._buffer):
+            last = min(self.size, self.position + max(size, READ_AHEAD)) - 1
+            self._buffer, _ = self._request(self.position, last)
+            self._buffer_start = self.position
+            offset = 0
+
+        data = self._buffer[offset : offset + size]
+        self.position += len(data)
+        return data
+
+    def close(self):
+        self._buffer = b""
+
+
+def member_selector(participant_label=None, patterns=None):
+    """Build a function that decides if a zip member is needed.
+
+    Args:
+        participant_label (str): only keep this subject ("sub-" is optional)
+        patterns (list): regular expressions for the files to keep, defaults to
+            RECON_INPUT_PATTERNS
+
+    Returns:
+        select (callable): select(name) -> bool
+    """
+    keep = re.compile("|".join(patterns or RECON_INPUT_PATTERNS))
+    subject = None
+    if participant_label:
+        label = participant_label
+        if label.startswith("sub-"):
+            label = label[len("sub-") :]
+        subject = f"sub-{label}"
+
+    def select(name):
+        if name.endswith("/"):
+            return False
+        if subject:
+            for part in name.split("/"):
+                if part.startswith("sub-") and not (
+                    part == subject or part.startswith(subject + "_")
+                ):
+                    return False
+        return bool(keep.search(name))
+
+    return select
+
+
+def _fetch_members(url, headers, size, members, dest_dir, strip_top_dir):
+    """Fetch and extract the given members (run by the workers)."""
+    reader = HttpRangeReader(url, headers=headers, size=size)
+    with ZipFile(reader) as zf:
+        for info in members:
+            target = member_destination(info.filename, dest_dir, strip_top_dir)
+            if target is None:
+                continue
+            target.parent.mkdir(parents=True, exist_ok=True)
+            with zf.open(info) as src, open(target, "wb") as dst:
+                while True:
+                    chunk = src.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    dst.write(chunk)
+    return reader.num_requests, reader.bytes_fetched
+
+
+def fetch_zip_members(
+    url, dest_dir, select, headers=None, strip_top_dir=False, workers=1
+):
+    """Extract the members of a remote zip file that select() keeps.
+
+    Args:
+        url (str): URL of the zip file
+        dest_dir (Path): directory to extract to
+        select (callable): select(name) -> bool, see member_selector()
+        headers (dict): extra headers to send with each request
+        strip_top_dir (bool): drop the first directory of every member
+        workers (int): number of members fetched at the same time
+
+    Returns:
+        names (list): names of the members that were extracted
+
+    Raises:
+        RangeNotSupported: if the server ignores range requests
+    """
+    start = time.time()
+    dest_dir = Path(dest_dir)
+    reader = HttpRangeReader(url, headers=headers)
+    with ZipFile(reader) as zf:
+        infos = zf.infolist()
+    members = [info for info in infos if select(info.filename)]
+
+    total = sum(info.compress_size for info in infos)
+    needed = sum(info.compress_size for info in members)
+    log.info(
+        "Fetching %d of %d zip members (%.1f of %.1f MiB)",
+        len(members),
+        len(infos),
+        needed / 1024**2,
+        total / 1024**2,
+    )
+
+    # Largest members first, spread round-robin so the workers finish together
+    members.sort(key=lambda info: info.compress_size, reverse=True)
+    workers = max(1, min(workers, len(members)))
+    batches = [members[ii::workers] for ii in range(workers)]
+    num_requests = 0
+    bytes_fetched = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            pool.submit(
+                _fetch_members,
+                url,
+                headers,
+                reader.size,
+                batch,
+                dest_dir,
+                strip_top_dir,
+            )
+            for batch in batches
+            if batch
+        ]
+        for future in futures:
+            requests, fetched = future.result()
+            num_requests += requests
+            bytes_fetched += fetched
+
+    # symbolic links and permissions
+
+    selected = {info.filename for info in members}
+    links = apply_central_directory(reader, dest_dir, strip_top_dir, names=selected)
+    num_requests += reader.num_requests
+    bytes_fetched += reader.bytes_fetched
+
+    log.info(
+        "Fetched %.1f MiB in %d range requests in %.1f s (%d symbolic links)",
+        bytes_fetched / 1024**2,
+        num_requests,
+        time.time() - start,
+        links,
+    )
+
+    return [info.filename for info in members]
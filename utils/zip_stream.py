@@ -0,0 +1,514 @@
+"""Extract zip archives while they are still being downloaded.
+
+The preprocessing-pipeline-zip input can be tens of GB.  Downloading it, unzipping
+it into a temporary directory and then moving the result into work/ goes over the
+data three times.  Here, the archive is read from the front, entry by entry (using
+the local file headers), as the download writes it, and each member is written
+straight to its final location.  Small members are handed to a pool of worker
+threads (zlib releases the GIL) while the reader moves on to the next entry.
+
+As the reader moves on, the disk space of the part of the archive it is done with is
+given back to the filesystem (by punching holes in the file, where the system and the
+filesystem can), so the archive and its extracted copy do not both have to fit on
+disk.
+
+Symbolic links and permissions are only recorded in the central directory at the
+end of the archive, so they are applied once the download is done.
+
+Anything the streaming reader does not understand (e.g. encrypted members or
+compression methods other than stored/deflated) makes it fall back to extracting the
+rest of the archive with zipfile after the download is done.
+
+Example:
+    .. code-block:: python
+
+        stream_download_and_extract(
+            lambda dest: file_obj.download(dest),
+            zip_path,
+            work_dir,
+            strip_top_dir=True,
+            workers=n_cpus,
+        )
+"""
+
+import ctypes
+import logging
+import os
+import stat
+import struct
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from zipfile import ZIP_DEFLATED, ZIP_STORED, BadZipFile, ZipFile
+
+log = logging.getLogger(__name__)
+
+LOCAL_HEADER_SIG = b"PK\x03\x04"
+DATA_DESCRIPTOR_SIG = b"PK\x07\x08"
+LOCAL_HEADER = struct.Struct("<5H3L2H")  # everything after the signature
+ZIP64_EXTRA_ID = 0x0001
+
+CHUNK_SIZE = 1024 * 1024
+# Members bigger than this are decompressed by the reader itself, so they are not
+# held in memory while waiting for a worker.
+MAX_POOLED_SIZE = 32 * 1024 * 1024
+# The disk space of the part of the archive that was read is freed this much at once
+RELEASE_SIZE = 64 * 1024 * 1024
+
+# fallocate() mode that frees the blocks of a range of a file, keeping its size
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+
+
+def _load_fallocate():
+    """The C library's fallocate(), or None where there is none (not Linux)."""
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+    except OSError:
+        return None
+    for name in ("fallocate64", "fallocate"):
+        try:
+            fallocate = getattr(libc, name)
+        except AttributeError:
+            continue
+        fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+        return fallocate
+    return None
+
+
+_FALLOCATE = _load_fallocate()
+
+
+def punch_hole(fd, offset, length):
+    """Free the disk blocks of a range of an open file, its size does not change.
+
+    Returns:
+        (bool) False if the system or the filesystem cannot do it
+    """
+    if _FALLOCATE is None:
+        return False
+    mode = FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE
+    if _FALLOCATE(fd, mode, offset, length) != 0:
+        err = ctypes.get_errno()
+        log.debug("Cannot free the space of read data: %s", os.strerror(err))
+        return False
+    return True
+
+
+class _UnsupportedEntry(Exception):
+    """The streaming reader cannot handle this entry."""
+
+
+class GrowingFileReader:
+    """Read a file that is still being written, blocking until data arrives.
+
+    Args:
+        path (Path): file being written
+        done (threading.Event): set when the writer is finished
+        poll_interval (float): seconds to wait before looking for more data
+        release_read (bool): let release() free the disk space of the data read
+    """
+
+    def __init__(self, path, done, poll_interval=0.05, release_read=False):
+        self.path = Path(path)
+        self.done = done
+        self.poll_interval = poll_interval
+        self.release_read = release_read
+        self.position = 0
+        self.released = 0
+        self._pushed_back = b""
+        self._fp = None
+        self._write_fd = None
+
+    def _open(self):
+        while self._fp is None:
+            if self.path.exists():
+                self._fp = open(self.path, "rb")
+            elif self.done.is_set():
+                raise FileNotFoundError(self.path)
+            else:
+                time.sleep(self.poll_interval)
+
+    def unread(self, data):
+        """Push data back so the next read returns it first."""
+        self._pushed_back = data + self._pushed_back
+        self.position -= len(data)
+
+    def read(self, size):
+        """Return exactly size bytes, unless the download ended first."""
+        self._open()
+        data = self._pushed_back[:size]
+        self._pushed_back = self._pushed_back[size:]
+        while len(data) < size:
+            # Check "done" before reading so no data written just before the
+            # download finished is missed.
+            finished = self.done.is_set()
+            more = self._fp.read(size - len(data))
+            if more:
+                data += more
+            elif finished:
+                break
+            else:
+                time.sleep(self.poll_interval)
+        self.position += len(data)
+        return data
+
+    def read_exactly(self, size):
+        """Like read(), but raise BadZipFile on a truncated archive."""
+        data = self.read(size)
+        if len(data) != size:
+            raise BadZipFile(f"Truncated zip archive at byte {self.position}")
+        return data
+
+    def release(self):
+        """Free the disk space of the data read so far, RELEASE_SIZE at a time.
+
+        Only call this once that data is no longer needed from the file.  A file
+        with other links to it (e.g. a file from a DownloadCache) is left alone.
+        """
+        end = self.position - self.position % RELEASE_SIZE
+        if not self.release_read or end <= self.released:
+            return
+        if self._write_fd is None:
+            try:
+                self._write_fd = os.open(self.path, os.O_WRONLY)
+            except OSError:
+                self.release_read = False
+                return
+            if os.fstat(self._write_fd).st_nlink > 1:
+                self.release_read = False
+                return
+        if punch_hole(self._write_fd, self.released, end - self.released):
+            self.released = end
+        else:
+            self.release_read = False
+
+    def close(self):
+        if self._fp is not None:
+            self._fp.close()
+        if self._write_fd is not None:
+            os.close(self._write_fd)
+
+
+def member_destination(name, dest_dir, strip_top_dir):
+    """Where a member of the archive is extracted to, or None to skip it.
+
+    Args:
+        name (str): name of the member in the archive
+        dest_dir (Path): directory to extract to
+        strip_top_dir (bool): drop the first directory of every member
+
+    Returns:
+        (Path) or None
+    """
+    parts = [p for p in Path(name).parts if p not in ("", ".", "..", "/")]
+    if strip_top_dir:
+        parts = parts[1:]
+    if not parts:
+        return None
+    return Path(dest_dir).joinpath(*parts)
+
+
+def _zip64_sizes(extra, csize, usize):
+    """Get sizes from the ZIP64 extra field when the header holds 0xFFFFFFFF."""
+    while len(extra) >= 4:
+        tag, length = struct.unpack("<2H", extra[:4])
+        if tag == ZIP64_EXTRA_ID:
+            values = extra[4 : 4 + length]
+            if usize == 0xFFFFFFFF:
+                usize = struct.unpack("<Q", values[:8])[0]
+                values = values[8:]
+            if csize == 0xFFFFFFFF:
+                csize = struct.unpack("<Q", values[:8])[0]
+            return csize, usize, True
+        extra = extra[4 + length :]
+    return csize, usize, False
+
+
+def _write_member(target, method, data, crc):
+    """Decompress a member held in memory and write it (run by the workers)."""
+    if method == ZIP_DEFLATED:
+        data = zlib.decompress(data, -15)
+    if zlib.crc32(data) != crc:
+        raise BadZipFile(f"Bad CRC-32 for {target}")
+    with open(target, "wb") as fp:
+        fp.write(data)
+
+
+def _stream_member(reader, target, method, csize):
+    """Copy a member of known compressed size from the reader to target."""
+    decompressor = zlib.decompressobj(-15) if method == ZIP_DEFLATED else None
+    crc = 0
+    remaining = csize
+    with open(target, "wb") as fp:
+        while remaining > 0:
+            chunk = reader.read_exactly(min(CHUNK_SIZE, remaining))
+            remaining -= len(chunk)
+            if decompressor:
+                chunk = decompressor.decompress(chunk)
+            crc = zlib.crc32(chunk, crc)
+            fp.write(chunk)
+            reader.release()
+        if decompressor:
+            chunk = decompressor.flush()
+            crc = zlib.crc32(chunk, crc)
+            fp.write(chunk)
+    return crc
+
+
+def _stream_member_until_eof(reader, target):
+    """Inflate a member whose size is only known from its data descriptor."""
+    decompressor = zlib.decompressobj(-15)
+    crc = 0
+    with open(target, "wb") as fp:
+        while not decompressor.eof:
+            chunk = reader.read(CHUNK_SIZE)
+            if not chunk:
+                raise BadZipFile(f"Truncated zip archive at byte {reader.position}")
+            chunk = decompressor.decompress(chunk)
+            crc = zlib.crc32(chunk, crc)
+            fp.write(chunk)
+            reader.release()
+    reader.unread(decompressor.unused_data)
+    return crc
+
+
+def _read_data_descriptor(reader, zip64):
+    """Read the data descriptor after a member and return its CRC-32."""
+    sig = reader.read_exactly(4)
+    if sig != DATA_DESCRIPTOR_SIG:
+        # The signature is optional
+        reader.unread(sig)
+    crc = struct.unpack("<L", reader.read_exactly(4))[0]
+    reader.read_exactly(16 if zip64 else 8)  # compressed and uncompressed sizes
+    return crc
+
+
+def _extract_stream(reader, dest_dir, strip_top_dir, pool, pending, names):
+    """Extract entries from the front of the archive until the central directory.
+
+    The name of each member that is extracted (or handed to the pool) is added to
+    names, so that whatever is left can be extracted later.  The space of the
+    archive is only released up to the end of a member that was handled: the
+    members after it are extracted from the file.
+    """
+    while True:
+        sig = reader.read(4)
+        if sig != LOCAL_HEADER_SIG:
+            # central directory (or end of archive) reached
+            return
+
+        (_, flags, method, _, _, crc, csize, usize, name_len, extra_len) = (
+            LOCAL_HEADER.unpack(reader.read_exactly(LOCAL_HEADER.size))
+        )
+        raw_name = reader.read_exactly(name_len)
+        name = raw_name.decode("utf-8" if flags & 0x800 else "cp437")
+        extra = reader.read_exactly(extra_len)
+        csize, usize, zip64 = _zip64_sizes(extra, csize, usize)
+        has_descriptor = bool(flags & 0x08)
+
+        if flags & 0x01:
+            raise _UnsupportedEntry(f"{name} is encrypted")
+        if method not in (ZIP_STORED, ZIP_DEFLATED):
+            raise _UnsupportedEntry(f"{name} uses compression method {method}")
+        if has_descriptor and method != ZIP_DEFLATED:
+            raise _UnsupportedEntry(f"{name} is stored with unknown size")
+
+        target = member_destination(name, dest_dir, strip_top_dir)
+        is_dir = name.endswith("/")
+
+        if target is not None:
+            if is_dir:
+                target.mkdir(parents=True, exist_ok=True)
+            else:
+                target.parent.mkdir(parents=True, exist_ok=True)
+
+        if target is None or is_dir:
+            if has_descriptor and method == ZIP_DEFLATED:
+                _stream_member_until_eof(reader, os.devnull)
+            else:
+                reader.read_exactly(csize)
+
+        elif has_descriptor:
+            actual_crc = _stream_member_until_eof(reader, target)
+            crc = _read_data_descriptor(reader, zip64)
+            if actual_crc != crc:
+                raise BadZipFile(f"Bad CRC-32 for {name}")
+            has_descriptor = False
+
+        elif csize > MAX_POOLED_SIZE:
+            if _stream_member(reader, target, method, csize) != crc:
+                raise BadZipFile(f"Bad CRC-32 for {name}")
+
+        else:
+            data = reader.read_exactly(csize)
+            pending.append(pool.submit(_write_member, target, method, data, crc))
+
+        if has_descriptor:
+            _read_data_descriptor(reader, zip64)
+
+        names.add(name)
+        reader.release()
+
+
+def _extract_members(zip_path, members, dest_dir, strip_top_dir):
+    """Extract the given members with zipfile (run by the workers)."""
+    with ZipFile(zip_path) as zf:
+        for info in members:
+            target = member_destination(info.filename, dest_dir, strip_top_dir)
+            if target is None:
+                continue
+            if info.is_dir():
+                target.mkdir(parents=True, exist_ok=True)
+                continue
+            target.parent.mkdir(parents=True, exist_ok=True)
+            with zf.open(info) as src, open(target, "wb") as dst:
+                while True:
+                    chunk = src.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    dst.write(chunk)
+
+
+def extract_zip(zip_path, dest_dir, strip_top_dir=False, workers=1, skip=()):
+    """Extract a downloaded zip file using several worker threads.
+
+    Args:
+        zip_path (Path): the zip file
+        dest_dir (Path): directory to extract to
+        strip_top_dir (bool): drop the first directory of every member
+        workers (int): number of threads to use
+        skip (set): names of members that are already extracted
+    """
+    with ZipFile(zip_path) as zf:
+        members = [info for info in zf.infolist() if info.filename not in skip]
+
+    workers = max(1, workers)
+    batches = [members[ii::workers] for ii in range(workers)]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            pool.submit(_extract_members, zip_path, batch, dest_dir, strip_top_dir)
+            for batch in batches
+            if batch
+        ]
+        for future in futures:
+            future.result()
+
+
+def apply_central_directory(zip_file, dest_dir, strip_top_dir=False, names=None):
+    """Restore symbolic links and permissions recorded in the central directory.
+
+    Like the "unzip" command, members whose mode says they are symbolic links are
+    turned into links pointing to the member's content.
+
+    Args:
+        zip_file (Path or file object): the zip file
+        dest_dir (Path): directory the zip file was extracted to
+        strip_top_dir (bool): drop the first directory of every member
+        names (set): only look at these members, if given
+
+    Returns:
+        num_links (int): number of symbolic links created
+    """
+    num_links = 0
+    with ZipFile(zip_file) as zf:
+        for info in zf.infolist():
+            mode = info.external_attr >> 16
+            if not mode or info.is_dir():
+                continue
+            if names is not None and info.filename not in names:
+                continue
+            target = member_destination(info.filename, dest_dir, strip_top_dir)
+            if target is None:
+                continue
+            if stat.S_ISLNK(mode):
+                if target.is_file() and not target.is_symlink():
+                    # extracted as a file holding the link's target (the member's
+                    # data may be gone from the archive, see GrowingFileReader)
+                    link_to = target.read_bytes().decode("utf-8")
+                else:
+                    link_to = zf.read(info).decode("utf-8")
+                if os.path.lexists(target):
+                    os.remove(target)
+                os.symlink(link_to, target)
+                num_links += 1
+            elif stat.S_IMODE(mode):
+                os.chmod(target, stat.S_IMODE(mode))
+    return num_links
+
+
+def stream_download_and_extract(
+    download, zip_path, dest_dir, strip_top_dir=False, workers=1
+):
+    """Download a zip file and extract it at the same time.
+
+    Args:
+        download (callable): called with zip_path, writes the archive there
+        zip_path (Path): where the archive is downloaded to
+        dest_dir (Path): directory to extract to
+        strip_top_dir (bool): drop the first directory of every member
+        workers (int): number of threads that write extracted members
+    """
+    zip_path = Path(zip_path)
+    dest_dir = Path(dest_dir)
+    dest_dir.mkdir(parents=True, exist_ok=True)
+
+    done = threading.Event()
+    download_error = []
+
+    def _download():
+        try:
+            download(str(zip_path))
+        except Exception as exc:  # pylint: disable=broad-except
+            download_error.append(exc)
+        finally:
+            done.set()
+
+    downloader = threading.Thread(target=_download, name="zip-download", daemon=True)
+    downloader.start()
+
+    start = time.time()
+    reader = GrowingFileReader(zip_path, done, release_read=True)
+    pending = []
+    extracted = set()
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            try:
+                _extract_stream(
+                    reader, dest_dir, strip_top_dir, pool, pending, extracted
+                )
+            except _UnsupportedEntry as exc:
+                log.warning("Cannot extract while downloading: %s", exc)
+            for future in pending:
+                future.result()
+    except Exception:
+        # a failed download leaves a truncated archive: report why it failed
+        downloader.join()
+        if download_error:
+            raise download_error[0]  # pylint: disable=raise-missing-from
+        raise
+    finally:
+        reader.close()
+        downloader.join()
+
+    if download_error:
+        raise download_error[0]
+
+    log.info(
+        "Extracted %d members while downloading %s in %.1f s (%.1f MiB freed)",
+        len(extracted),
+        zip_path.name,
+        time.time() - start,
+        reader.released / 1024**2,
+    )
+
+    with ZipFile(zip_path) as zf:
+        remaining = len(set(zf.namelist()) - extracted)
+    if remaining > 0:
+        log.info("Extracting the remaining %d members", remaining)
+        extract_zip(zip_path, dest_dir, strip_top_dir, workers, skip=extracted)
+
+    num_links = apply_central_directory(zip_path, dest_dir, strip_top_dir)
+    log.info("Restored %d symbolic links", num_links)